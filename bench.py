@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# bench
+
+# CC0 1.0 Universal
+
+# This script benchmarks the freepcb2pretty conversion pipeline, stage by
+# stage, on FreePCB zips (by default the three bundled IPC7351 zips), using
+# the same options as 'make ipc'. The stages are:
+#
+#   zip_read     decompress every zip member
+#   tokenize     decode and split into lines (FreePCBfile)
+#   parse        Library parse of every member, and merging
+#   strip_lmn    Library.strip_lmn
+#   3dmap        process_3dmap
+#   courtyard    add_courtyards
+#   hash_time    set_hash_time
+#   sexp         PCBmodule.kicad_sexp
+#   dump         SexpDump into memory
+#   write        writing the .kicad_mod files
+#
+# Each zip is converted in a fresh child process so that peak memory is per
+# variant. Results are printed, can be saved as JSON, and can be compared
+# with a saved baseline: a stage slower than the baseline by more than its
+# threshold is a regression, and makes the script exit with status 1.
+#
+# Memory budgets work the same way: --memory-budget caps the peak RSS of each
+# variant, --stage-memory-budget caps the peak traced (tracemalloc) memory of
+# one stage, and --pin-budget caps the memory parsing keeps per pin, which is
+# what the data model costs. Tracing memory slows every stage down, so times
+# measured with --trace-memory shouldn't be compared with times measured
+# without it.
+#
+# Examples:
+#   bench.py --save baseline.json
+#   bench.py --baseline baseline.json --threshold 0.15 --stage-threshold write=0.5
+#   bench.py --memory-budget 250 --stage-memory-budget parse=60 --pin-budget 650
+
+import io
+import os
+import sys
+import time
+import json
+import shutil
+import zipfile
+import platform
+import tempfile
+import datetime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import freepcb2pretty
+from freepcb2pretty import Library, FreePCBfile, SexpDump
+
+VERSION = "1.0"
+
+DEFAULT_ZIPS = ["IPC7351-Least_v2.zip", "IPC7351-Nominal_v2.zip",
+        "IPC7351-Most_v2.zip"]
+
+# Courtyard spacing per variant, as in the Makefile
+COURTYARDS = {"Least": 0.1, "Nominal": 0.25, "Most": 0.5}
+DEFAULT_COURTYARD = 0.25
+
+STAGES = ["zip_read", "tokenize", "parse", "strip_lmn", "3dmap", "courtyard",
+        "hash_time", "sexp", "dump", "write"]
+
+# Stages faster than this (s) in the baseline are too noisy to compare
+MIN_TIME = 0.01
+
+class StageTimer (object):
+    """Records wall and CPU time of named stages, and optionally their peak
+    and retained traced memory.
+    """
+
+    def __init__ (self, trace_memory=False):
+        self.stages = {}
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start ()
+
+    def start (self):
+        if self.trace_memory:
+            tracemalloc.reset_peak ()
+            self.memory = tracemalloc.get_traced_memory ()[0]
+        self.wall = time.perf_counter ()
+        self.cpu = time.process_time ()
+
+    def stop (self, name, nbytes=0):
+        wall = time.perf_counter () - self.wall
+        cpu = time.process_time () - self.cpu
+        self.stages[name] = {"wall": wall, "cpu": cpu, "bytes": nbytes}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory ()
+            self.stages[name]["peak_mb"] = peak / (1024. * 1024.)
+            self.stages[name]["retained_mb"] = (current - self.memory) / (1024. * 1024.)
+        self.start ()
+
+def converter_args (zippath, outdir, threedmap=True):
+    """Converter arguments matching the Makefile's for this zip."""
+    courtyard = DEFAULT_COURTYARD
+    for key, value in COURTYARDS.items ():
+        if key in os.path.basename (zippath):
+            courtyard = value
+    args = ["--strip-lmn", "--rounded-pads", "--hash-time",
+            "--rounded-pad-exceptions", "config/rpexceptions",
+            "--rounded-center-exceptions", "config/rcexceptions",
+            "--add-courtyard", str (courtyard)]
+    if threedmap:
+        args.extend (["--3dmap", "config/3dmap"])
+    return args + [outdir]
+
+def run_pipeline (zippath, threedmap=True, trace_memory=False):
+    """Convert one zip, timing each stage. Returns a result dict."""
+    outdir = tempfile.mkdtemp (prefix="bench-")
+    try:
+        args = freepcb2pretty.parse_args (converter_args (zippath, outdir,
+            threedmap))
+        timer = StageTimer (trace_memory)
+        if trace_memory:
+            base_memory = tracemalloc.get_traced_memory ()[0]
+        timer.start ()
+
+        with zipfile.ZipFile (zippath) as zf:
+            members = [(info, zf.read (info)) for info in zf.infolist ()]
+        input_bytes = sum (len (data) for info, data in members)
+        timer.stop ("zip_read", input_bytes)
+
+        files = []
+        for info, data in members:
+            files.append ((info, FreePCBfile.from_text (data.decode ('utf8'))))
+        timer.stop ("tokenize", input_bytes)
+
+        library = Library ()
+        for info, ff in files:
+            sublibrary = Library (ff, args)
+            sublibrary.set_origin (info.filename, info.CRC)
+            library += sublibrary
+        timer.stop ("parse", input_bytes)
+        del members, files
+
+        # Memory kept by the library once the inputs are gone, which is what
+        # the data model costs
+        if trace_memory:
+            library_bytes = tracemalloc.get_traced_memory ()[0] - base_memory
+            timer.start ()
+
+        if args.strip_lmn:
+            library.strip_lmn ()
+        timer.stop ("strip_lmn")
+
+        if args.threedmap is not None:
+            freepcb2pretty.process_3dmap (args.threedmap, library)
+        timer.stop ("3dmap")
+
+        freepcb2pretty.add_courtyards (library.Modules, args)
+        timer.stop ("courtyard")
+
+        for i in library.Modules:
+            freepcb2pretty.set_hash_time (i)
+        timer.stop ("hash_time")
+
+        sexps = [i.kicad_sexp () for i in library.Modules]
+        timer.stop ("sexp")
+
+        texts = []
+        for sexp in sexps:
+            f = io.StringIO ()
+            SexpDump (sexp, f)
+            texts.append (f.getvalue ())
+        output_bytes = sum (len (i) for i in texts)
+        timer.stop ("dump", output_bytes)
+
+        for module, text in zip (library.Modules, texts):
+            path = os.path.join (outdir, freepcb2pretty.module_filename (module))
+            with open (path, 'w') as f:
+                f.write (text)
+        timer.stop ("write", output_bytes)
+
+        pins = sum (i.pin_count () for i in library.Modules)
+        bytes_per_pin = None
+        if trace_memory and pins:
+            bytes_per_pin = library_bytes / float (pins)
+
+        return {"modules": len (library.Modules),
+                "pins": pins,
+                "input_bytes": input_bytes,
+                "output_bytes": output_bytes,
+                "stages": timer.stages,
+                "bytes_per_pin": bytes_per_pin,
+                "peak_rss_mb": peak_rss_mb ()}
+    finally:
+        shutil.rmtree (outdir)
+
+def peak_rss_mb ():
+    """Peak resident memory of this process, in MB, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024. * 1024.)
+    return peak / 1024.
+
+def _run_pipeline_star (args):
+    return run_pipeline (*args)
+
+def bench_variant (zippath, repeat=1, threedmap=True, trace_memory=False):
+    """Run the pipeline 'repeat' times, each in a fresh process, keeping
+    the best time of each stage.
+    """
+
+    import multiprocessing
+    pool = multiprocessing.Pool (1, maxtasksperchild=1)
+    try:
+        runs = pool.map (_run_pipeline_star,
+                [(zippath, threedmap, trace_memory)] * repeat, chunksize=1)
+    finally:
+        pool.close ()
+        pool.join ()
+
+    result = runs[0]
+    for run in runs[1:]:
+        for name, stage in run["stages"].items ():
+            best = result["stages"][name]
+            if stage["wall"] < best["wall"]:
+                result["stages"][name] = stage
+    result["peak_rss_mb"] = max (i["peak_rss_mb"] or 0 for i in runs) or None
+
+    modules = result["modules"]
+    for stage in result["stages"].values ():
+        stage["modules_per_s"] = modules / stage["wall"] if stage["wall"] else None
+        stage["mb_per_s"] = (stage["bytes"] / 1e6 / stage["wall"]
+                if stage["bytes"] and stage["wall"] else None)
+    wall = sum (i["wall"] for i in result["stages"].values ())
+    cpu = sum (i["cpu"] for i in result["stages"].values ())
+    result["total"] = {"wall": wall, "cpu": cpu,
+            "modules_per_s": modules / wall if wall else None,
+            "mb_per_s": result["input_bytes"] / 1e6 / wall if wall else None}
+    return result
+
+def variant_name (zippath):
+    name = os.path.basename (zippath)
+    return name[:-4] if name.endswith (".zip") else name
+
+def run_benchmarks (zips, repeat=1, threedmap=True, trace_memory=False):
+    results = {
+        "meta": {
+            "date": datetime.datetime.utcnow ().strftime ("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version (),
+            "platform": platform.platform (),
+            "converter": freepcb2pretty.converter_hash (),
+            "repeat": repeat,
+            "trace_memory": trace_memory,
+        },
+        "variants": {},
+    }
+    for zippath in zips:
+        results["variants"][variant_name (zippath)] = \
+                bench_variant (zippath, repeat, threedmap, trace_memory)
+    return results
+
+def print_results (results, f=sys.stdout):
+    for name, result in sorted (results["variants"].items ()):
+        f.write ("%s: %d modules, %.2f MB in, %.2f MB out, peak RSS %s\n" % (
+            name, result["modules"], result["input_bytes"] / 1e6,
+            result["output_bytes"] / 1e6,
+            "%.1f MB" % result["peak_rss_mb"] if result["peak_rss_mb"] else "?"))
+        if result.get ("bytes_per_pin") is not None:
+            f.write ("  %d pins, %.0f bytes per pin after parsing\n" % (
+                result["pins"], result["bytes_per_pin"]))
+        f.write ("  %-10s %9s %9s %11s %9s %10s %10s\n" % ("stage", "wall (s)",
+            "cpu (s)", "modules/s", "MB/s", "peak (MB)", "kept (MB)"))
+        for stage in STAGES + ["total"]:
+            s = result["total"] if stage == "total" else result["stages"][stage]
+            f.write ("  %-10s %9.4f %9.4f %11s %9s %10s %10s\n" % (stage, s["wall"],
+                s["cpu"],
+                "%.0f" % s["modules_per_s"] if s["modules_per_s"] else "-",
+                "%.2f" % s["mb_per_s"] if s["mb_per_s"] else "-",
+                "%.1f" % s["peak_mb"] if "peak_mb" in s else "-",
+                "%.1f" % s["retained_mb"] if "retained_mb" in s else "-"))
+
+def compare (results, baseline, threshold, stage_thresholds, min_time=MIN_TIME):
+    """Compare results against a baseline. Returns a list of regressions as
+    (variant, stage, baseline seconds, new seconds, allowed ratio).
+    """
+
+    regressions = []
+    for name, result in sorted (results["variants"].items ()):
+        base = baseline["variants"].get (name)
+        if base is None:
+            continue
+        for stage in STAGES + ["total"]:
+            new = result["total"] if stage == "total" else result["stages"].get (stage)
+            old = base["total"] if stage == "total" else base["stages"].get (stage)
+            if new is None or old is None or old["wall"] < min_time:
+                continue
+            allowed = 1. + stage_thresholds.get (stage, threshold)
+            if new["wall"] > old["wall"] * allowed:
+                regressions.append ((name, stage, old["wall"], new["wall"], allowed))
+    return regressions
+
+def check_budgets (results, memory_budget, stage_budgets, pin_budget=None):
+    """Check results against memory budgets in MB, and bytes per pin.
+    Returns a list of overruns as (variant, stage, "rss" or "pin", budget,
+    measured).
+    """
+
+    overruns = []
+    for name, result in sorted (results["variants"].items ()):
+        rss = result["peak_rss_mb"]
+        if memory_budget is not None and rss is not None and rss > memory_budget:
+            overruns.append ((name, "rss", memory_budget, rss))
+        per_pin = result.get ("bytes_per_pin")
+        if pin_budget is not None and per_pin is not None and per_pin > pin_budget:
+            overruns.append ((name, "pin", pin_budget, per_pin))
+        for stage, budget in sorted (stage_budgets.items ()):
+            peak = result["stages"][stage].get ("peak_mb")
+            if peak is not None and peak > budget:
+                overruns.append ((name, stage, budget, peak))
+    return overruns
+
+def parse_stage_threshold (s):
+    stage, delim, value = s.partition ("=")
+    if not delim or (stage not in STAGES and stage != "total"):
+        raise ValueError ("expected STAGE=FRACTION, stage one of: %s" %
+                ", ".join (STAGES + ["total"]))
+    return stage, float (value)
+
+def parse_stage_budget (s):
+    stage, delim, value = s.partition ("=")
+    if not delim or stage not in STAGES:
+        raise ValueError ("expected STAGE=MB, stage one of: %s" % ", ".join (STAGES))
+    return stage, float (value)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Benchmark the freepcb2pretty conversion pipeline stage by stage."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("zips", metavar="ZIP", type=str, nargs="*",
+            default=DEFAULT_ZIPS,
+            help="FreePCB zips to convert (default: the bundled IPC7351 zips)")
+    p.add_argument ("--repeat", dest="repeat", type=int, default=1,
+            help="Runs per zip; the best time of each stage is kept")
+    p.add_argument ("--no-3dmap", dest="threedmap", action="store_const",
+            const=False, default=True,
+            help="Don't apply config/3dmap (for zips it doesn't match)")
+    p.add_argument ("--save", dest="save", type=str, default=None,
+            help="Save results to this JSON file")
+    p.add_argument ("--baseline", dest="baseline", type=str, default=None,
+            help="Compare against results saved with --save")
+    p.add_argument ("--threshold", dest="threshold", type=float, default=0.10,
+            help="Allowed slowdown of any stage, as a fraction (default: 0.10)")
+    p.add_argument ("--stage-threshold", dest="stage_thresholds",
+            type=parse_stage_threshold, action="append", default=[],
+            metavar="STAGE=FRACTION", help="Allowed slowdown of one stage")
+    p.add_argument ("--min-time", dest="min_time", type=float, default=MIN_TIME,
+            help="Ignore stages faster than this in the baseline (default: %g s)"
+            % MIN_TIME)
+    p.add_argument ("--trace-memory", dest="trace_memory", action="store_const",
+            const=True, default=False,
+            help="Record each stage's peak and retained memory with tracemalloc")
+    p.add_argument ("--memory-budget", dest="memory_budget", type=float,
+            default=None, metavar="MB", help="Fail if a variant's peak RSS exceeds this")
+    p.add_argument ("--stage-memory-budget", dest="stage_budgets",
+            type=parse_stage_budget, action="append", default=[],
+            metavar="STAGE=MB",
+            help="Fail if a stage's peak traced memory exceeds this (implies --trace-memory)")
+    p.add_argument ("--pin-budget", dest="pin_budget", type=float, default=None,
+            metavar="BYTES",
+            help="Fail if parsing keeps more than this per pin (implies --trace-memory)")
+    args = p.parse_args ()
+
+    if args.stage_budgets or args.pin_budget is not None:
+        args.trace_memory = True
+    if args.trace_memory and (tracemalloc is None or
+            not hasattr (tracemalloc, "reset_peak")):
+        p.error ("--trace-memory needs Python 3.9 or later")
+
+    results = run_benchmarks (args.zips, args.repeat, args.threedmap,
+            args.trace_memory)
+    print_results (results)
+    failed = False
+
+    if args.save is not None:
+        with open (args.save, 'w') as f:
+            json.dump (results, f, indent=1, sort_keys=True)
+            f.write ("\n")
+
+    if args.baseline is not None:
+        with open (args.baseline) as f:
+            baseline = json.load (f)
+        regressions = compare (results, baseline, args.threshold,
+                dict (args.stage_thresholds), args.min_time)
+        for name, stage, old, new, allowed in regressions:
+            print ("REGRESSION %s %s: %.4f s -> %.4f s (%.0f%% slower, %.0f%% allowed)"
+                    % (name, stage, old, new, (new / old - 1) * 100,
+                    (allowed - 1) * 100))
+        if regressions:
+            failed = True
+        else:
+            print ("No regressions against %s" % args.baseline)
+
+    if args.memory_budget is not None or args.stage_budgets or \
+            args.pin_budget is not None:
+        overruns = check_budgets (results, args.memory_budget,
+                dict (args.stage_budgets), args.pin_budget)
+        for name, stage, budget, measured in overruns:
+            unit = "bytes per pin" if stage == "pin" else "MB"
+            print ("OVER BUDGET %s %s: %.1f %s (budget %.1f %s)" % (name, stage,
+                measured, unit, budget, unit))
+        if overruns:
+            failed = True
+        else:
+            print ("Within memory budgets")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# build
+
+# CC0 1.0 Universal
+
+# This script rebuilds the generated parts of the library: the IPC7351
+# libraries converted from the FreePCB zips, the connector libraries written
+# by the gen-conn-*.py scripts, and the 3D models. Each is a target with its
+# input files, the targets it needs first, and the outputs it makes, and the
+# targets form a graph:
+#
+#   IPC7351-*_v2.zip  ->  ipc-least, ipc-nominal, ipc-most
+#   conn-100mil, conn-2mm
+#   3d
+#
+# A target's signature is a hash of its command, the hashes of its input
+# files, the Python version and the signatures of the targets it needs. It
+# is up to date if its signature matches the one stored in .build-state.json
+# after its last successful run and its outputs exist, and is skipped then.
+# File hashes are kept in the same file, and trusted while the size and
+# modification time of the file don't change, so a build with nothing to do
+# only stats the inputs. An input that is a directory, like the 3D models
+# conn-100mil looks for, stands for the list of files under it. Targets
+# whose dependencies are done run in parallel, each in its own process.
+#
+# The 3D models and the zips are downloaded, so they are only built when
+# asked for or missing. The connector libraries are committed, and the
+# gen-conn scripts stamp every footprint with the time they ran, so they
+# are only built when asked for too: after a fresh clone, record them as
+# current with --touch, and build them by name when their scripts change.
+# 'make ipc' and the gen-conn scripts still work as before; --touch records
+# the current outputs as up to date without running anything, for a
+# checkout that is known to be current.
+#
+# Examples:
+#   build.py
+#   build.py --dry-run
+#   build.py --touch conn-100mil conn-2mm
+#   build.py -j 2 ipc-nominal conn-2mm
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+VERSION = "1.0"
+
+STATE_NAME = ".build-state.json"
+STATE_VERSION = 1
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+
+# Converter options shared by the IPC libraries; each adds its courtyard
+IPC_OPTIONS = ["--no-confirm-license", "--atomic",
+        "--3dmap", "config/3dmap",
+        "--rounded-pad-exceptions", "config/rpexceptions",
+        "--rounded-center-exceptions", "config/rcexceptions",
+        "--rounded-pads", "--hash-time"]
+
+IPC_CONFIG = ["config/3dmap", "config/rpexceptions", "config/rcexceptions"]
+
+# Variant, courtyard clearance (mm)
+IPC_VARIANTS = [("Least", "0.1"), ("Nominal", "0.25"), ("Most", "0.5")]
+
+IPC_URL = "http://www.freepcb.com/downloads/%s"
+
+CONVERTER = ["freepcb2pretty.py", "download_ipc.py"]
+
+# Where gen-conn-100mil.py looks for the header models
+CONN_MODELS = os.path.join (os.path.expanduser ("~"), "git/kicad-pcblib/3d")
+
+class Target (object):
+    """Something to build: 'run' is a function of no arguments returning
+    (success, output text); 'inputs' are files, 'needs' other targets and
+    'outputs' files or directories it makes.
+    """
+
+    def __init__ (self, name, run, inputs=(), needs=(), outputs=(),
+            command=None, default=True):
+        self.name = name
+        self.run = run
+        self.inputs = list (inputs)
+        self.needs = list (needs)
+        self.outputs = list (outputs)
+        # What the target does, as text, for its signature
+        self.command = command
+        self.default = default
+
+def command (argv, cwd=None):
+    """A run function for a command line, run from 'cwd'."""
+    def run ():
+        proc = subprocess.Popen (argv, cwd=cwd, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        out = proc.communicate ()[0]
+        return proc.returncode == 0, out.decode ("utf8", "replace")
+    return run
+
+def download (url, path):
+    def run ():
+        temp = path + ".part"
+        try:
+            f = urlopen (url)
+            with open (temp, 'wb') as out:
+                shutil.copyfileobj (f, out)
+            f.close ()
+            getattr (os, "replace", os.rename) (temp, path)
+        except (IOError, OSError) as e:
+            if os.path.exists (temp):
+                os.remove (temp)
+            return False, "%s: %s\n" % (url, e)
+        return True, "Downloaded %s\n" % path
+    return run
+
+def download_3d (python):
+    def run ():
+        if not os.path.isdir ("3d"):
+            os.mkdir ("3d")
+        for i in os.listdir ("3d"):
+            if os.path.isdir (os.path.join ("3d", i)):
+                shutil.rmtree (os.path.join ("3d", i))
+        return command ([python, "download_3d.py"]) ()
+    return run
+
+def targets (python):
+    """Return the build graph, as a list of Targets in a usable order."""
+    graph = []
+    for variant, courtyard in IPC_VARIANTS:
+        zipname = "IPC7351-%s_v2.zip" % variant
+        graph.append (Target (zipname, download (IPC_URL % zipname, zipname),
+            outputs=[zipname], command="download %s" % (IPC_URL % zipname),
+            default=False))
+
+        pretty = "IPC7351-%s.pretty" % variant
+        manifest = "IPC7351-%s.manifest.json" % variant
+        argv = [python, "download_ipc.py"] + IPC_OPTIONS + \
+                ["--add-courtyard", courtyard, "--manifest", manifest,
+                    "--quiet", zipname, pretty, "freepcb2pretty.py"]
+        graph.append (Target ("ipc-%s" % variant.lower (), command (argv),
+            inputs=[zipname] + IPC_CONFIG + CONVERTER, needs=[zipname],
+            outputs=[pretty, manifest], command=" ".join (argv[1:])))
+
+    for name in ("conn-100mil", "conn-2mm"):
+        directory = name + ".pretty"
+        script = "gen-%s.py" % name
+        argv = [python, script]
+        inputs = [os.path.join (directory, script), "freepcb2pretty.py"]
+        if name == "conn-100mil":
+            inputs += ["check_models.py", CONN_MODELS]
+        graph.append (Target (name, command (argv, cwd=directory),
+            inputs=inputs, outputs=[directory],
+            command="cd %s && %s" % (directory, script), default=False))
+
+    graph.append (Target ("3d", download_3d (python),
+        inputs=["download_3d.py"], outputs=["3d"], command="download_3d.py",
+        default=False))
+    return graph
+
+def tree_hash (root):
+    """SHA-1 of the relative paths of the files under a directory."""
+    h = hashlib.sha1 ()
+    for dirpath, dirnames, filenames in os.walk (root):
+        dirnames.sort ()
+        rel = os.path.relpath (dirpath, root)
+        for i in sorted (filenames):
+            h.update (("%s\n" % os.path.join (rel, i)).encode ("utf8"))
+    return h.hexdigest ()
+
+class State (object):
+    """The signatures of built targets and the hashes of input files,
+    kept between runs.
+    """
+
+    def __init__ (self, path):
+        self.path = path
+        try:
+            with open (path) as f:
+                data = json.load (f)
+            if data.get ("version") != STATE_VERSION:
+                raise ValueError
+        except (IOError, ValueError):
+            data = {"files": {}, "targets": {}}
+        self.files = data["files"]
+        self.built = data["targets"]
+        self.lock = threading.Lock ()
+
+    def file_hash (self, path):
+        """SHA-1 of a file, or None if it is missing. Unchanged size and
+        modification time mean an unchanged file. For a directory, this is
+        the hash of the names of the files under it.
+        """
+        try:
+            st = os.stat (path)
+        except OSError:
+            return None
+        if os.path.isdir (path):
+            return tree_hash (path)
+        entry = self.files.get (path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        h = hashlib.sha1 ()
+        with open (path, 'rb') as f:
+            while True:
+                block = f.read (1 << 20)
+                if not block:
+                    break
+                h.update (block)
+        digest = h.hexdigest ()
+        self.files[path] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def save (self):
+        with self.lock:
+            temp = self.path + ".tmp"
+            with open (temp, "w") as f:
+                json.dump ({"version": STATE_VERSION, "files": self.files,
+                    "targets": self.built}, f, indent=1, sort_keys=True)
+            getattr (os, "replace", os.rename) (temp, self.path)
+
+def signature (target, state, signatures):
+    """Hash of everything a target's result depends on."""
+    h = hashlib.sha1 ()
+    h.update (("%s\n%s\n%s\n" % (target.name, target.command,
+        sys.version.split ()[0])).encode ("utf8"))
+    for path in sorted (target.inputs):
+        h.update (("%s %s\n" % (path, state.file_hash (path))).encode ("utf8"))
+    for name in sorted (target.needs):
+        h.update (("%s %s\n" % (name, signatures[name])).encode ("utf8"))
+    return h.hexdigest ()
+
+def select (graph, names):
+    """The targets to consider: those named and everything they need, or
+    the default ones.
+    """
+    by_name = dict ((i.name, i) for i in graph)
+    wanted = set ()
+    stack = list (names) if names else [i.name for i in graph if i.default]
+    while stack:
+        name = stack.pop ()
+        if name not in by_name:
+            raise Exception ("no target \"%s\" (see --list)" % name)
+        if name not in wanted:
+            wanted.add (name)
+            stack.extend (by_name[name].needs)
+    return [i for i in graph if i.name in wanted]
+
+def outputs_exist (target):
+    return all (os.path.exists (i) for i in target.outputs)
+
+def build (graph, state, jobs, force=(), dry_run=False, touch=False):
+    """Build the stale targets of 'graph', running up to 'jobs' at once.
+    Returns the number of failed targets.
+    """
+
+    signatures = {}
+    stale = set ()
+    for target in graph:
+        sig = signature (target, state, signatures)
+        signatures[target.name] = sig
+        # A download target is up to date while its output exists
+        if not target.inputs and not target.needs and outputs_exist (target) \
+                and target.name not in force:
+            continue
+        if target.name in force or state.built.get (target.name) != sig or \
+                not outputs_exist (target) or \
+                any (i in stale for i in target.needs):
+            stale.add (target.name)
+
+    if touch:
+        for target in graph:
+            if outputs_exist (target):
+                state.built[target.name] = signatures[target.name]
+                print ("%s: marked up to date" % target.name)
+        state.save ()
+        return 0
+
+    todo = [i for i in graph if i.name in stale]
+    if not todo:
+        print ("Nothing to do.")
+        state.save ()
+        return 0
+    if dry_run:
+        for i in todo:
+            print ("%s: would run %s" % (i.name, i.command))
+        return 0
+
+    results = Queue ()
+    def worker (target):
+        try:
+            ok, out = target.run ()
+        except Exception as e:
+            ok, out = False, "%s\n" % e
+        results.put ((target, ok, out))
+
+    pending = list (todo)
+    done = set (i.name for i in graph if i.name not in stale)
+    failed = set ()
+    running = 0
+    while pending or running:
+        for target in list (pending):
+            if running >= jobs:
+                break
+            if any (i in failed for i in target.needs):
+                pending.remove (target)
+                failed.add (target.name)
+                print ("%s: skipped, a dependency failed" % target.name)
+                continue
+            if not all (i in done for i in target.needs):
+                continue
+            pending.remove (target)
+            # Inputs made by the targets it needs have changed since
+            signatures[target.name] = signature (target, state, signatures)
+            print ("%s: building" % target.name)
+            sys.stdout.flush ()
+            thread = threading.Thread (target=worker, args=(target,))
+            thread.daemon = True
+            thread.start ()
+            running += 1
+
+        if not running:
+            break
+        target, ok, out = results.get ()
+        running -= 1
+        if out:
+            sys.stdout.write ("".join ("%s: %s\n" % (target.name, i)
+                for i in out.rstrip ("\n").split ("\n")))
+        if ok:
+            done.add (target.name)
+            # Outputs can be inputs of other targets; hash them afresh
+            for i in target.outputs:
+                state.files.pop (i, None)
+            state.built[target.name] = signatures[target.name]
+            state.save ()
+            print ("%s: done" % target.name)
+        else:
+            failed.add (target.name)
+            state.built.pop (target.name, None)
+            print ("%s: FAILED" % target.name)
+        sys.stdout.flush ()
+
+    state.save ()
+    return len (failed)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Rebuild the generated libraries that are out of date."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("targets", metavar="TARGET", type=str, nargs="*",
+            help="Targets to build, with what they need (default: all but downloads)")
+    p.add_argument ("-j", "--jobs", dest="jobs", type=int,
+            default=multiprocessing.cpu_count (),
+            help="Targets to run at once (default: one per CPU)")
+    p.add_argument ("-n", "--dry-run", dest="dry_run", action="store_const",
+            const=True, default=False, help="Only show what would be built")
+    p.add_argument ("-B", "--force", dest="force", action="store_const",
+            const=True, default=False,
+            help="Build the targets asked for (or the default ones) even if up to date")
+    p.add_argument ("--touch", dest="touch", action="store_const",
+            const=True, default=False,
+            help="Record the selected targets as up to date, without building")
+    p.add_argument ("--list", dest="list", action="store_const",
+            const=True, default=False, help="List the targets")
+    p.add_argument ("--python", dest="python", type=str, default=sys.executable,
+            help="Python to run the converters with (default: this one)")
+    args = p.parse_args ()
+
+    os.chdir (HERE)
+    graph = targets (args.python)
+    if args.list:
+        for i in graph:
+            print ("%-24s %s%s" % (i.name, ", ".join (i.outputs),
+                "" if i.default else " (not built by default)"))
+        return 0
+
+    selected = select (graph, args.targets)
+    force = ()
+    if args.force:
+        force = args.targets or [i.name for i in graph if i.default]
+    state = State (STATE_NAME)
+    failed = build (selected, state, max (1, args.jobs), force,
+            args.dry_run, args.touch)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
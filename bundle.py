@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# bundle
+
+# CC0 1.0 Universal
+
+# This script packs .pretty libraries into a single bundle file, unpacks them
+# again, and fetches single footprints from a bundle. Reading one footprint
+# out of a big library directory means listing and opening files, which is
+# slow on network filesystems; a bundle is one file, and a reader only
+# touches the pages it needs.
+#
+# Layout (all integers little-endian):
+#
+#   header   magic "FPBUNDLE", version, entry count, index offset, names
+#            offset
+#   data     footprint files, each stored as is or zlib-compressed
+#   index    one fixed-size entry per footprint, sorted by name: name offset
+#            and length (in the names table), data offset, stored length,
+#            length, flags
+#   names    the footprint names, "LIBRARY:FOOTPRINT" in UTF-8, where
+#            LIBRARY is the .pretty directory name without its extension
+#
+# The reader maps the file with mmap and finds a name by binary search over
+# the index, so a lookup reads O(log n) index entries and one footprint.
+# Bundles are written to a temporary file and renamed into place, and the
+# same libraries always give the same bytes.
+#
+# Examples:
+#   bundle.py pack ipc.bundle IPC7351-Least.pretty IPC7351-Nominal.pretty
+#   bundle.py get ipc.bundle IPC7351-Nominal:SOIC127P600X175-8N
+#   bundle.py unpack ipc.bundle /tmp/libs
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import tempfile
+
+from freepcb2pretty import find_footprints, set_default_mode
+
+VERSION = "1.0"
+
+MAGIC = b"FPBUNDLE"
+BUNDLE_VERSION = 1
+
+# magic, version, count, index offset, names offset
+HEADER = struct.Struct ("<8sIIQQ")
+
+# name offset, name length, data offset, stored length, length, flags
+ENTRY = struct.Struct ("<IIQIII")
+
+# Entry flags
+COMPRESSED = 1
+
+EXTENSION = ".kicad_mod"
+
+def library_name (path):
+    """The library nickname of a .pretty directory."""
+    name = os.path.basename (os.path.normpath (path))
+    if name.endswith (".pretty"):
+        name = name[:-len (".pretty")]
+    return name
+
+class Bundle (object):
+    """A bundle opened for reading. Footprints are looked up by
+    "LIBRARY:FOOTPRINT" name and returned as text.
+    """
+
+    def __init__ (self, path):
+        self.path = path
+        self.file = open (path, 'rb')
+        try:
+            self.map = mmap.mmap (self.file.fileno (), 0,
+                    access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can't be mapped
+            self.file.close ()
+            raise Exception ("%s: not a footprint bundle" % path)
+        magic, version, self.count, self.index, self.names = \
+                HEADER.unpack_from (self.map, 0)
+        if magic != MAGIC:
+            self.close ()
+            raise Exception ("%s: not a footprint bundle" % path)
+        if version != BUNDLE_VERSION:
+            self.close ()
+            raise Exception ("%s: unsupported bundle version %d" %
+                    (path, version))
+
+    def close (self):
+        self.map.close ()
+        self.file.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close ()
+
+    def __len__ (self):
+        return self.count
+
+    def __contains__ (self, name):
+        return self.find (name) is not None
+
+    def entry (self, i):
+        return ENTRY.unpack_from (self.map, self.index + i * ENTRY.size)
+
+    def name (self, i):
+        offset, length = self.entry (i)[:2]
+        start = self.names + offset
+        return self.map[start:start + length].decode ("utf8")
+
+    def find (self, name):
+        """Return the index of a footprint, or None."""
+        key = name.encode ("utf8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length = self.entry (mid)[:2]
+            start = self.names + offset
+            if self.map[start:start + length] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.name (lo) == name:
+            return lo
+        return None
+
+    def data (self, i):
+        """Return the text of footprint number i."""
+        offset, stored, length, flags = self.entry (i)[2:]
+        data = self.map[offset:offset + stored]
+        if flags & COMPRESSED:
+            data = zlib.decompress (data)
+        return data.decode ("utf8")
+
+    def get (self, name, default=None):
+        """Return the text of a footprint, or 'default'."""
+        i = self.find (name)
+        if i is None:
+            return default
+        return self.data (i)
+
+    def __getitem__ (self, name):
+        i = self.find (name)
+        if i is None:
+            raise KeyError (name)
+        return self.data (i)
+
+    def names_list (self):
+        """Return all footprint names, sorted."""
+        return [self.name (i) for i in range (self.count)]
+
+    def libraries (self):
+        """Return the library names, sorted."""
+        return sorted (set (i.split (":", 1)[0] for i in self.names_list ()))
+
+    def items (self):
+        """Yield (name, text) for every footprint, sorted by name."""
+        for i in range (self.count):
+            yield self.name (i), self.data (i)
+
+def write_bundle (path, footprints, compress=False):
+    """Write a bundle from an iterable of (name, text). The footprints are
+    streamed to the file; only the index is kept in memory.
+    """
+
+    directory = os.path.dirname (os.path.abspath (path))
+    fd, temp = tempfile.mkstemp (prefix=".%s." % os.path.basename (path),
+            suffix=".tmp", dir=directory)
+    set_default_mode (temp, 0o666)
+    try:
+        with os.fdopen (fd, 'wb') as f:
+            f.write (b"\0" * HEADER.size)
+            offset = HEADER.size
+            entries = {}
+            for name, text in footprints:
+                if name in entries:
+                    raise Exception ("duplicate footprint \"%s\"" % name)
+                data = text.encode ("utf8")
+                stored, flags = data, 0
+                if compress:
+                    packed = zlib.compress (data, 9)
+                    if len (packed) < len (data):
+                        stored, flags = packed, COMPRESSED
+                f.write (stored)
+                entries[name] = (offset, len (stored), len (data), flags)
+                offset += len (stored)
+
+            names = sorted (entries, key=lambda i: i.encode ("utf8"))
+            index = offset
+            table = []
+            table_size = 0
+            for name in names:
+                key = name.encode ("utf8")
+                f.write (ENTRY.pack (table_size, len (key), *entries[name]))
+                table.append (key)
+                table_size += len (key)
+            f.write (b"".join (table))
+
+            f.seek (0)
+            f.write (HEADER.pack (MAGIC, BUNDLE_VERSION, len (names), index,
+                index + len (names) * ENTRY.size))
+        getattr (os, "replace", os.rename) (temp, path)
+    except:
+        os.remove (temp)
+        raise
+
+def read_pretty (paths):
+    """Yield (name, text) for the footprints of .pretty directories."""
+    for path in paths:
+        library = library_name (path)
+        for filename in find_footprints ([path]):
+            with open (filename, 'rb') as f:
+                text = f.read ().decode ("utf8")
+            name = os.path.basename (filename)[:-len (EXTENSION)]
+            yield "%s:%s" % (library, name), text
+
+def pack (args):
+    for i in args.libraries:
+        if not os.path.isdir (i):
+            raise Exception ("%s: not a directory" % i)
+    write_bundle (args.bundle, read_pretty (args.libraries), args.compress)
+
+def unpack (args):
+    with Bundle (args.bundle) as bundle:
+        for name, text in bundle.items ():
+            library, footprint = name.split (":", 1)
+            directory = os.path.join (args.outdir, library + ".pretty")
+            if not os.path.isdir (directory):
+                os.makedirs (directory)
+            with open (os.path.join (directory, footprint + EXTENSION),
+                    'wb') as f:
+                f.write (text.encode ("utf8"))
+
+def get (args):
+    with Bundle (args.bundle) as bundle:
+        for name in args.names:
+            text = bundle.get (name)
+            if text is None:
+                raise Exception ("%s: no footprint \"%s\"" % (args.bundle, name))
+            sys.stdout.write (text)
+
+def list_names (args):
+    with Bundle (args.bundle) as bundle:
+        for i in bundle.names_list ():
+            print (i)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Pack .pretty libraries into a single-file bundle, and " + \
+            "read footprints back out."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    sub = p.add_subparsers (dest="command")
+    sub.required = True
+
+    packp = sub.add_parser ("pack", help="Pack .pretty directories into a bundle")
+    packp.add_argument ("bundle", metavar="BUNDLE", type=str)
+    packp.add_argument ("libraries", metavar="DIR", type=str, nargs="+")
+    packp.add_argument ("--compress", dest="compress", action="store_const",
+            const=True, default=False,
+            help="Compress each footprint with zlib")
+    packp.set_defaults (run=pack)
+
+    unpackp = sub.add_parser ("unpack", help="Unpack a bundle into .pretty directories")
+    unpackp.add_argument ("bundle", metavar="BUNDLE", type=str)
+    unpackp.add_argument ("outdir", metavar="DIR", type=str)
+    unpackp.set_defaults (run=unpack)
+
+    getp = sub.add_parser ("get", help="Print footprints, by LIBRARY:FOOTPRINT name")
+    getp.add_argument ("bundle", metavar="BUNDLE", type=str)
+    getp.add_argument ("names", metavar="NAME", type=str, nargs="+")
+    getp.set_defaults (run=get)
+
+    listp = sub.add_parser ("list", help="List the footprints in a bundle")
+    listp.add_argument ("bundle", metavar="BUNDLE", type=str)
+    listp.set_defaults (run=list_names)
+
+    args = p.parse_args ()
+    args.run (args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
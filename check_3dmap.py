@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# check_3dmap
+
+# CC0 1.0 Universal
+
+# This script checks the 3D map against the models it names. config/3dmap is
+# written by hand, and nothing else checks that a model fits its footprint.
+# For every mapped module, the model's bounding box, scaled, rotated and
+# offset as the map says, is compared with the module's bounding_box () in
+# the board plane, and rotation, offset and scale mismatches are reported
+# with the map lines that would fix them. Modules with no model get a few
+# candidate models of about the right size, from the directories used by
+# modules of the same family (the letters the name starts with).
+#
+# Model bounding boxes come from a streaming VRML scanner: it reads the file
+# in blocks, follows Transform/Separator nesting (and DEF/USE) and takes the
+# extent of each Coordinate point list as it passes, without keeping any
+# mesh. Other number arrays are skipped in bulk. Boxes are cached by file
+# hash in the 3D directory, and the cache is trusted while a file's size and
+# modification time don't change, so a warm run doesn't read the models.
+# Models are scanned in a pool of processes.
+#
+# Models are in KiCad's VRML units of 0.1", and 3D map offsets in inches, as
+# in the legacy footprint format. Rotation about Z is clockwise seen from
+# above, as in KiCad's 3D viewer. Footprint boxes include silk, so some
+# slack between the two is normal; see --tolerance.
+#
+# Examples:
+#   check_3dmap.py
+#   check_3dmap.py --3d-dir 3d --json 3dmap.json IPC7351-Nominal_v2.zip
+
+import os
+import re
+import sys
+import json
+import math
+import zipfile
+import hashlib
+
+import freepcb2pretty
+
+VERSION = "1.0"
+
+# Millimetres per VRML unit, and per 3D map offset unit
+VRML_UNIT = 2.54
+OFFSET_UNIT = 25.4
+
+# Default relative size difference taken as a mismatch
+TOLERANCE = 0.5
+
+# Default offset taken as a mismatch (mm), besides a share of the size
+OFFSET_TOLERANCE = 0.25
+
+CACHE_NAME = ".bbox-cache.json"
+CACHE_VERSION = 1
+
+BLOCK_SIZE = 1 << 20
+
+SCAN = re.compile (r'#[^\n]*|"(?:[^"\\\n]|\\.)*"|([^\s\[\]{}#",]+)|([\[\]{}])')
+NUMBER = re.compile (r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$")
+COMMENT = re.compile (r"#[^\n]*")
+ARRAY_END = re.compile (r"#[^\n]*|\]")
+
+# Nodes whose 'point' field is a list of 3D coordinates
+COORDINATE_NODES = ("Coordinate", "Coordinate3")
+
+# Transform fields and how many numbers each takes
+TRANSFORM_FIELDS = {"translation": 3, "scale": 3, "scaleFactor": 3,
+        "rotation": 4, "center": 3}
+
+# VRML 1 nodes that change the transform of the nodes after them
+VRML1_TRANSFORMS = ("Transform", "Translation", "Rotation", "Scale")
+
+IDENTITY = ((1., 0., 0., 0.), (0., 1., 0., 0.), (0., 0., 1., 0.))
+
+def multiply (a, b):
+    """Product of two 3x4 affine matrices."""
+    return tuple (tuple (sum (a[r][k] * b[k][c] for k in range (3)) +
+        (a[r][3] if c == 3 else 0.) for c in range (4)) for r in range (3))
+
+def translation (x, y, z):
+    return ((1., 0., 0., x), (0., 1., 0., y), (0., 0., 1., z))
+
+def rotation (x, y, z, angle):
+    """Rotation by 'angle' radians about the axis (x, y, z)."""
+    length = math.sqrt (x * x + y * y + z * z)
+    if length == 0:
+        return IDENTITY
+    x, y, z = x / length, y / length, z / length
+    c, s = math.cos (angle), math.sin (angle)
+    t = 1 - c
+    return ((t * x * x + c, t * x * y - s * z, t * x * z + s * y, 0.),
+            (t * x * y + s * z, t * y * y + c, t * y * z - s * x, 0.),
+            (t * x * z - s * y, t * y * z + s * x, t * z * z + c, 0.))
+
+def scaling (x, y, z):
+    return ((x, 0., 0., 0.), (0., y, 0., 0.), (0., 0., z, 0.))
+
+def transform_box (m, box):
+    """Bounding box of the eight corners of 'box' under 'm'."""
+    if box is None or m is IDENTITY:
+        return box
+    lo, hi = box
+    corners = [(x, y, z) for x in (lo[0], hi[0]) for y in (lo[1], hi[1])
+            for z in (lo[2], hi[2])]
+    points = [tuple (r[0] * x + r[1] * y + r[2] * z + r[3] for r in m)
+            for x, y, z in corners]
+    return (tuple (min (p[i] for p in points) for i in range (3)),
+            tuple (max (p[i] for p in points) for i in range (3)))
+
+def merge_box (a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (tuple (min (a[0][i], b[0][i]) for i in range (3)),
+            tuple (max (a[1][i], b[1][i]) for i in range (3)))
+
+class Frame (object):
+    """A node being read: its type, its own transform fields, and the box
+    of what it holds so far.
+    """
+
+    __slots__ = ("node", "name", "fields", "box", "state")
+
+    def __init__ (self, node, name):
+        self.node = node
+        self.name = name
+        self.fields = {}
+        self.box = None
+        # VRML 1: transform applied to the nodes that follow
+        self.state = IDENTITY
+
+    def matrix (self):
+        """The node's transform: T * C * R * S * -C."""
+        f = self.fields
+        if not f:
+            return IDENTITY
+        m = IDENTITY
+        if "translation" in f:
+            m = multiply (m, translation (*f["translation"]))
+        if "center" in f:
+            m = multiply (m, translation (*f["center"]))
+        if "rotation" in f:
+            m = multiply (m, rotation (*f["rotation"]))
+        for key in ("scale", "scaleFactor"):
+            if key in f:
+                m = multiply (m, scaling (*f[key]))
+        if "center" in f:
+            m = multiply (m, translation (*[-i for i in f["center"]]))
+        return m
+
+class VrmlScanner (object):
+    """Reads a VRML file in blocks, as a stream of tokens, and returns the
+    bounding box of its geometry.
+    """
+
+    def __init__ (self, f):
+        self.file = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill (self, need=4096):
+        """Make sure at least 'need' characters are buffered past pos."""
+        while not self.eof and len (self.buffer) - self.pos < need:
+            block = self.file.read (BLOCK_SIZE)
+            if not block:
+                self.eof = True
+                break
+            self.buffer = self.buffer[self.pos:] + block.decode ("latin-1")
+            self.pos = 0
+
+    def tokens (self):
+        """Yield (word, bracket) tokens; one of the two is None."""
+        while True:
+            self.fill ()
+            m = SCAN.search (self.buffer, self.pos)
+            if m is None:
+                return
+            self.pos = m.end ()
+            if m.group (1) is not None or m.group (2) is not None:
+                yield m.group (1), m.group (2)
+
+    def array (self):
+        """Return the text of a [ ... ] array whose '[' was just read. A ']'
+        in a comment doesn't end it.
+        """
+        done = 0        # characters past pos known to hold no ']'
+        while True:
+            for m in ARRAY_END.finditer (self.buffer, self.pos + done):
+                if m.group () == "]":
+                    text = self.buffer[self.pos:m.start ()]
+                    self.pos = m.end ()
+                    return text
+                if m.end () == len (self.buffer) and not self.eof:
+                    # The comment may go on in the next block
+                    break
+                done = m.end () - self.pos
+            else:
+                done = len (self.buffer) - self.pos
+            if self.eof:
+                text = self.buffer[self.pos:]
+                self.pos = len (self.buffer)
+                return text
+            self.fill (len (self.buffer) - self.pos + BLOCK_SIZE)
+
+    def scan (self):
+        version = 2
+        self.fill ()
+        if self.buffer.startswith ("#VRML V1"):
+            version = 1
+
+        stack = [Frame (None, None)]
+        defs = {}
+        last_word = None        # the word before a '{' names its node
+        def_name = None         # DEF name of the next node
+        pending_def = False
+        use_next = False
+        field = None            # transform field being read, and its numbers
+        values = []
+        bracket_field = None    # field a '[' belongs to
+
+        for word, bracket in self.tokens ():
+            frame = stack[-1]
+            if word is not None:
+                if field is not None and NUMBER.match (word):
+                    values.append (float (word))
+                    if len (values) == TRANSFORM_FIELDS[field]:
+                        frame.fields[field] = values
+                        field = None
+                    continue
+                field = None
+                if pending_def:
+                    def_name = word
+                    pending_def = False
+                elif use_next:
+                    frame.box = merge_box (frame.box,
+                            transform_box (frame.state, defs.get (word)))
+                    use_next = False
+                elif word == "DEF":
+                    pending_def = True
+                elif word == "USE":
+                    use_next = True
+                elif word in TRANSFORM_FIELDS and (frame.node == "Transform" or
+                        version == 1 and frame.node in VRML1_TRANSFORMS):
+                    field = word
+                    values = []
+                last_word = word
+                bracket_field = word
+                continue
+
+            field = None
+            if bracket == "{":
+                stack.append (Frame (last_word, def_name))
+                def_name = None
+            elif bracket == "}":
+                if len (stack) == 1:
+                    continue
+                done = stack.pop ()
+                parent = stack[-1]
+                if version == 1 and done.node in VRML1_TRANSFORMS:
+                    parent.state = multiply (parent.state, done.matrix ())
+                    box = None
+                elif version == 2 and done.node == "Transform":
+                    box = transform_box (done.matrix (), done.box)
+                else:
+                    box = done.box
+                if done.name is not None:
+                    defs[done.name] = box
+                parent.box = merge_box (parent.box,
+                        transform_box (parent.state, box))
+            elif bracket == "[":
+                if bracket_field == "point" and frame.node in COORDINATE_NODES:
+                    frame.box = merge_box (frame.box, points_box (self.array ()))
+                elif bracket_field not in ("children", "choice", "level"):
+                    # A number or string array: nothing to nest in it
+                    self.array ()
+            last_word = None
+
+        return stack[0].box
+
+def points_box (text):
+    """Bounding box of a VRML list of 3D points."""
+    if "#" in text:
+        text = COMMENT.sub ("", text)
+    values = text.replace (",", " ").split ()
+    try:
+        xs = [float (i) for i in values[0::3]]
+        ys = [float (i) for i in values[1::3]]
+        zs = [float (i) for i in values[2::3]]
+    except ValueError:
+        return None
+    n = min (len (xs), len (ys), len (zs))
+    if n == 0:
+        return None
+    xs, ys, zs = xs[:n], ys[:n], zs[:n]
+    return ((min (xs), min (ys), min (zs)), (max (xs), max (ys), max (zs)))
+
+def model_box (path):
+    """Return the bounding box of a VRML file, in VRML units, or None."""
+    with open (path, 'rb') as f:
+        return VrmlScanner (f).scan ()
+
+def _scan_file (work):
+    path, digest = work
+    box = model_box (path)
+    return path, digest, box
+
+def find_models (root):
+    models = []
+    for dirpath, dirnames, filenames in os.walk (root):
+        dirnames.sort ()
+        for i in sorted (filenames):
+            if i.lower ().endswith (".wrl"):
+                models.append (os.path.join (dirpath, i))
+    return models
+
+def model_boxes (root, cache_path, jobs=None):
+    """Return {model name relative to root: box in VRML units}, reading only
+    the files whose hash isn't in the cache.
+    """
+    try:
+        with open (cache_path) as f:
+            cache = json.load (f)
+        if cache.get ("version") != CACHE_VERSION:
+            raise ValueError
+    except (IOError, ValueError):
+        cache = {"version": CACHE_VERSION, "files": {}, "hashes": {}}
+
+    files, hashes = cache["files"], cache["hashes"]
+    boxes = {}
+    work = []
+    seen = set ()
+    changed = not os.path.exists (cache_path)
+    for path in find_models (root):
+        name = os.path.relpath (path, root).replace (os.sep, "/")
+        seen.add (name)
+        st = os.stat (path)
+        entry = files.get (name)
+        if entry is not None and entry["size"] == st.st_size and \
+                entry["mtime"] == st.st_mtime and entry["sha1"] in hashes:
+            boxes[name] = hashes[entry["sha1"]]
+            continue
+        with open (path, 'rb') as f:
+            digest = hashlib.sha1 (f.read ()).hexdigest ()
+        files[name] = {"size": st.st_size, "mtime": st.st_mtime, "sha1": digest}
+        changed = True
+        if digest in hashes:
+            boxes[name] = hashes[digest]
+        else:
+            work.append ((path, digest))
+
+    if work:
+        if jobs == 1 or len (work) < 8:
+            results = map (_scan_file, work)
+            pool = None
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool (jobs)
+            results = pool.imap_unordered (_scan_file, work, chunksize=4)
+        for path, digest, box in results:
+            hashes[digest] = box
+            name = os.path.relpath (path, root).replace (os.sep, "/")
+            boxes[name] = box
+        if pool is not None:
+            pool.close ()
+            pool.join ()
+
+    for name in set (files) - seen:
+        del files[name]
+        changed = True
+    used = set (i["sha1"] for i in files.values ())
+    for digest in set (hashes) - used:
+        del hashes[digest]
+
+    if changed:
+        temp = cache_path + ".tmp"
+        with open (temp, "w") as f:
+            json.dump (cache, f, sort_keys=True)
+        getattr (os, "replace", os.rename) (temp, cache_path)
+    return boxes
+
+def placed_box (box, entries):
+    """Return the (left, right, bottom, top) board-plane extent in mm of a
+    model box placed by a module's 3D map entries.
+    """
+    scale = [1., 1., 1.]
+    rot = [0., 0., 0.]
+    offset = [0., 0., 0.]
+    for key, value, lineno in entries:
+        if key[:3] in ("sca", "rot", "off") and len (key) == 4:
+            index = ord (key[3]) - ord ('x')
+            {"sca": scale, "rot": rot, "off": offset}[key[:3]][index] = float (value)
+
+    lo, hi = box
+    lo = [lo[i] * scale[i] * VRML_UNIT for i in range (3)]
+    hi = [hi[i] * scale[i] * VRML_UNIT for i in range (3)]
+    m = IDENTITY
+    m = multiply (m, translation (*[i * OFFSET_UNIT for i in offset]))
+    for axis, angle in ((2, rot[2]), (1, rot[1]), (0, rot[0])):
+        if angle:
+            m = multiply (m, rotation (*([1. if i == axis else 0.
+                for i in range (3)] + [-math.radians (angle)])))
+    lo, hi = transform_box (m, (tuple (min (a, b) for a, b in zip (lo, hi)),
+        tuple (max (a, b) for a, b in zip (lo, hi))))
+    return (lo[0], hi[0], lo[1], hi[1]), scale, rot, offset
+
+def size_error (a, b):
+    """How far apart two (width, height) sizes are: the sum of the log
+    ratios, 0 for a match.
+    """
+    if min (a) <= 0 or min (b) <= 0:
+        return float ("inf")
+    return abs (math.log (a[0] / b[0])) + abs (math.log (a[1] / b[1]))
+
+def family (name):
+    m = re.match (r"[A-Za-z]+", name)
+    return m.group () if m else name
+
+def entry_value (entries, key):
+    for k, value, lineno in entries:
+        if k == key:
+            return value, lineno
+    return None, None
+
+def check_module (name, fp_box, entries, boxes, tolerance, offset_tolerance):
+    """Compare a mapped module with its model. Return a list of problem
+    dicts.
+    """
+    model, lineno = entry_value (entries, "3dmod")
+    problems = []
+    if model not in boxes:
+        return [{"module": name, "problem": "missing model", "model": model,
+            "line": lineno}]
+    if boxes[model] is None:
+        return [{"module": name, "problem": "empty model", "model": model,
+            "line": lineno}]
+
+    (left, right, bottom, top), scale, rot, offset = placed_box (boxes[model],
+            entries)
+    fleft, fright, ftop, fbottom = fp_box
+    model_size = (right - left, top - bottom)
+    fp_size = (fright - fleft, ftop - fbottom)
+    base = {"module": name, "model": model, "line": lineno,
+            "model_size": [round (i, 3) for i in model_size],
+            "footprint_size": [round (i, 3) for i in fp_size]}
+
+    error = size_error (model_size, fp_size)
+    swapped = size_error (model_size[::-1], fp_size)
+    limit = 2 * math.log (1 + tolerance)
+    if error > limit and swapped < error / 2:
+        problem = dict (base, problem="rotation",
+                fix=["rotz: %g" % ((rot[2] + 90) % 360)])
+        problems.append (problem)
+        return problems
+
+    fixes = []
+    for axis, key in ((0, "scax"), (1, "scay")):
+        if min (model_size[axis], fp_size[axis]) <= 0:
+            continue
+        ratio = fp_size[axis] / model_size[axis]
+        if abs (math.log (ratio)) > math.log (1 + tolerance):
+            # Scale is applied before rotation
+            k = key if rot[2] % 180 == 0 else ("scay" if axis == 0 else "scax")
+            index = ord (k[3]) - ord ('x')
+            fixes.append ("%s: %g" % (k, round (scale[index] * ratio, 2)))
+    if fixes:
+        problems.append (dict (base, problem="scale", fix=fixes))
+
+    dx = (fleft + fright) / 2 - (left + right) / 2
+    dy = (ftop + fbottom) / 2 - (top + bottom) / 2
+    limit = max (offset_tolerance, 0.1 * min (fp_size))
+    if math.hypot (dx, dy) > limit:
+        problems.append (dict (base, problem="offset",
+            offset=[round (dx, 3), round (dy, 3)],
+            fix=["offx: %g" % round (offset[0] + dx / OFFSET_UNIT, 4),
+                "offy: %g" % round (offset[1] + dy / OFFSET_UNIT, 4)]))
+    return problems
+
+def candidates (name, fp_box, boxes, directories, count):
+    """Return up to 'count' (error, model, rotz) guesses for a module with
+    no model, preferring the directories in 'directories'.
+    """
+    fleft, fright, ftop, fbottom = fp_box
+    fp_size = (fright - fleft, ftop - fbottom)
+    pool = [i for i in boxes if boxes[i] is not None and
+            i.split ("/")[0] in directories]
+    if not pool:
+        pool = [i for i in boxes if boxes[i] is not None]
+    guesses = []
+    for model in pool:
+        lo, hi = boxes[model]
+        size = ((hi[0] - lo[0]) * VRML_UNIT, (hi[1] - lo[1]) * VRML_UNIT)
+        guesses.append ((size_error (size, fp_size), model, 0))
+        guesses.append ((size_error (size[::-1], fp_size), model, 90))
+    guesses.sort ()
+    best = []
+    for guess in guesses:
+        if guess[0] == float ("inf"):
+            break
+        if all (guess[1] != i[1] for i in best):
+            best.append (guess)
+        if len (best) == count:
+            break
+    return best
+
+def describe (p):
+    text = "%s: %s" % (p["module"], p["problem"])
+    if p.get ("model") is not None:
+        text += " (%s, 3D map line %s)" % (p["model"], p["line"])
+    if "model_size" in p:
+        text += ": model %g x %g mm, footprint %g x %g mm" % tuple (
+                p["model_size"] + p["footprint_size"])
+    if "offset" in p:
+        text += ", %g, %g mm off centre" % tuple (p["offset"])
+    if "fix" in p:
+        text += "; try " + ", ".join (p["fix"])
+    return text
+
+def load_modules (paths):
+    """Load FreePCB zips, returning {name: module}, with L/M/N stripped."""
+    opts = freepcb2pretty.parse_args (["--strip-lmn", "unused"])
+    modules = {}
+    for path in paths:
+        with zipfile.ZipFile (path) as zf:
+            library = freepcb2pretty.load_zip (zf, opts)
+        library.strip_lmn ()
+        for i in library.Modules:
+            modules.setdefault (i.Name, i)
+    return modules
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Check the 3D map against the sizes of the models it " + \
+            "names, and suggest models for unmapped modules."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("zips", metavar="ZIP", type=str, nargs="*",
+            default=["IPC7351-Nominal_v2.zip"],
+            help="FreePCB zips (default: IPC7351-Nominal_v2.zip)")
+    p.add_argument ("--3dmap", dest="threedmap", type=str,
+            default=os.path.join ("config", "3dmap"),
+            help="3D map to check (default: config/3dmap)")
+    p.add_argument ("--3d-dir", dest="threeddir", type=str, default="3d",
+            help="Directory of VRML models (default: 3d)")
+    p.add_argument ("--cache", dest="cache", type=str, default=None,
+            help="Bounding box cache (default: %s in the 3D directory)" % CACHE_NAME)
+    p.add_argument ("--tolerance", dest="tolerance", type=float,
+            default=TOLERANCE,
+            help="Relative size difference to report (default: %g)" % TOLERANCE)
+    p.add_argument ("--offset-tolerance", dest="offset_tolerance", type=float,
+            default=OFFSET_TOLERANCE,
+            help="Off-centre distance in mm to report (default: %g)" % OFFSET_TOLERANCE)
+    p.add_argument ("--suggest", dest="suggest", type=int, default=3,
+            help="Candidate models per unmapped module (default: 3; 0 for none)")
+    p.add_argument ("--json", dest="json", type=str, default=None,
+            help="Also write the problems and suggestions to this JSON file")
+    p.add_argument ("-j", "--jobs", dest="jobs", type=int, default=None,
+            help="Worker processes for reading models (default: one per CPU)")
+    args = p.parse_args ()
+
+    if not os.path.isdir (args.threeddir):
+        raise Exception ("%s: no 3D models; run 'make 3d' first" % args.threeddir)
+    cache = args.cache or os.path.join (args.threeddir, CACHE_NAME)
+    boxes = model_boxes (args.threeddir, cache, args.jobs)
+    blocks = freepcb2pretty.read_3dmap (args.threedmap)
+    modules = load_modules (args.zips)
+
+    problems = []
+    for name in sorted (blocks):
+        if name not in modules:
+            problems.append ({"module": name, "problem": "unknown module",
+                "line": blocks[name][0][2]})
+            continue
+        problems.extend (check_module (name, modules[name].bounding_box (),
+            blocks[name], boxes, args.tolerance, args.offset_tolerance))
+    for i in problems:
+        print (describe (i))
+
+    # Model directories used by each family of mapped modules
+    directories = {}
+    for name, entries in blocks.items ():
+        model, _ = entry_value (entries, "3dmod")
+        if model is not None:
+            directories.setdefault (family (name), set ()).add (model.split ("/")[0])
+
+    suggestions = {}
+    if args.suggest > 0:
+        for name in sorted (set (modules) - set (blocks)):
+            guesses = candidates (name, modules[name].bounding_box (), boxes,
+                    directories.get (family (name), ()), args.suggest)
+            if not guesses:
+                continue
+            suggestions[name] = [{"model": model, "rotz": rotz,
+                "error": round (error, 3)} for error, model, rotz in guesses]
+            error, model, rotz = guesses[0]
+            print ("\nmod: %s\n3dmod: %s%s" % (name, model,
+                "\nrotz: %d" % rotz if rotz else ""))
+            for error, model, rotz in guesses[1:]:
+                print ("# or %s%s" % (model, ", rotz: %d" % rotz if rotz else ""))
+
+    print ("%d models, %d mapped modules, %d problems, %d unmapped modules" %
+            (len (boxes), len (blocks), len (problems),
+                len (set (modules) - set (blocks))))
+
+    if args.json is not None:
+        with open (args.json, "w") as f:
+            json.dump ({"problems": problems, "suggestions": suggestions}, f,
+                    indent=1, sort_keys=True)
+
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# check_models
+
+# CC0 1.0 Universal
+
+# This script checks that every 3D model the library refers to exists: the
+# 3dmod: entries of config/3dmap and the (model ...) of every committed
+# .kicad_mod file. The 3D directory is walked once into a ModelIndex, and
+# every reference is looked up in it; nothing else touches the filesystem.
+#
+# A reference that only matches with different case, or with another model
+# extension (.wrl/.step/.stp/...), is reported as such, since it works on
+# some systems and not on others. A missing one gets the nearest model
+# names by edit distance. Models nothing refers to are counted, and listed
+# with --unused.
+#
+# References through an environment variable, like ${KISYS3DMOD}/..., point
+# outside the 3D directory. They are checked if the variable is given with
+# --env or set in the environment, and otherwise only counted.
+#
+# Examples:
+#   check_models.py
+#   check_models.py --env KISYS3DMOD=/usr/share/kicad/modules/packages3d --unused
+
+import io
+import os
+import re
+import sys
+import json
+import subprocess
+
+import freepcb2pretty
+
+VERSION = "1.0"
+
+# Extensions that name the same model in another format
+MODEL_EXTENSIONS = (".wrl", ".wings", ".step", ".stp", ".x3d", ".igs", ".iges")
+
+MODEL_REF = re.compile (r'\(model\s+("(?:[^"\\]|\\.)*"|[^\s()]+)')
+ENV_VAR = re.compile (r'^\$(?:\{([^}]+)\}|\(([^)]+)\))/?')
+
+def split_ext (path):
+    base, ext = os.path.splitext (path)
+    if ext.lower () in MODEL_EXTENSIONS:
+        return base, ext
+    return path, ""
+
+def edit_distance (a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 if it is over
+    'limit'.
+    """
+    if abs (len (a) - len (b)) > limit:
+        return limit + 1
+    previous = list (range (len (b) + 1))
+    for i, ca in enumerate (a, 1):
+        current = [i]
+        for j, cb in enumerate (b, 1):
+            current.append (min (previous[j] + 1, current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)))
+        if min (current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class ModelIndex (object):
+    """The model files under a directory, by path relative to it, with
+    lookups that ignore case or extension. Built from one walk.
+    """
+
+    def __init__ (self, root):
+        self.root = root
+        self.paths = set ()
+        self.lower = {}
+        self.stems = {}
+        self.nearest = {}
+        for dirpath, dirnames, filenames in os.walk (root):
+            dirnames.sort ()
+            rel = os.path.relpath (dirpath, root)
+            for i in sorted (filenames):
+                if not split_ext (i)[1]:
+                    continue
+                path = i if rel == "." else "%s/%s" % (rel.replace (os.sep, "/"), i)
+                self.paths.add (path)
+                self.lower.setdefault (path.lower (), []).append (path)
+                self.stems.setdefault (split_ext (path)[0].lower (), []).append (path)
+
+    def __len__ (self):
+        return len (self.paths)
+
+    def __contains__ (self, path):
+        return path in self.paths
+
+    def exists (self, path):
+        return path in self.paths
+
+    def find (self, path):
+        """Look up a model. Returns (kind, matches), where kind is "ok",
+        "case" (matches differ in case only), "extension" (matches have
+        another extension) or "missing".
+        """
+        if path in self.paths:
+            return "ok", [path]
+        matches = self.lower.get (path.lower ())
+        if matches:
+            return "case", matches
+        matches = self.stems.get (split_ext (path)[0].lower ())
+        if matches:
+            return "extension", matches
+        return "missing", []
+
+    def near (self, path, count=3):
+        """Return up to 'count' models with names near 'path', nearest first.
+        Models in the same directory are tried first.
+        """
+        path = path.lower ()
+        if (path, count) in self.nearest:
+            return self.nearest[path, count]
+        directory = path.rsplit ("/", 1)[0] if "/" in path else ""
+        limit = max (2, len (path.rsplit ("/", 1)[-1]) // 4)
+        pool = [i for i in self.lower
+                if (i.rsplit ("/", 1)[0] if "/" in i else "") == directory]
+        scored = []
+        for candidates in (pool, self.lower):
+            for i in candidates:
+                d = edit_distance (path, i, limit)
+                if d <= limit:
+                    scored.append ((d, i))
+            if scored:
+                break
+        scored.sort ()
+        near = [self.lower[i][0] for d, i in scored[:count]]
+        self.nearest[path, count] = near
+        return near
+
+def committed_footprints ():
+    """The .kicad_mod files in git, or in the .pretty directories here if
+    this isn't a git checkout.
+    """
+    try:
+        out = subprocess.check_output (["git", "ls-files", "-z", "*.kicad_mod"],
+                stderr=open (os.devnull, "w"))
+        return [i for i in out.decode ("utf8").split ("\0") if i]
+    except (OSError, subprocess.CalledProcessError):
+        dirs = sorted (i for i in os.listdir (".") if i.endswith (".pretty"))
+        return freepcb2pretty.find_footprints (dirs)
+
+def footprint_refs (path):
+    """Yield (line number, model) for the models of a .kicad_mod file."""
+    with io.open (path, encoding="utf8") as f:
+        text = f.read ()
+    for m in MODEL_REF.finditer (text):
+        model = m.group (1)
+        if model.startswith ('"'):
+            model = model[1:-1].replace ('\\"', '"')
+        yield text.count ("\n", 0, m.start ()) + 1, model
+
+def resolve (model, env):
+    """Split a reference into (variable, path). 'variable' is None for
+    references into the 3D directory, else the variable's name, and 'path'
+    is relative to its directory, or None if the variable isn't known.
+    """
+    m = ENV_VAR.match (model)
+    if m is None:
+        return None, model.replace ("\\", "/")
+    name = m.group (1) or m.group (2)
+    if name not in env:
+        return name, None
+    return name, model[m.end ():].replace ("\\", "/")
+
+def check_ref (index, model, where, env, externals):
+    """Check one reference. Return a problem dict or None."""
+    variable, path = resolve (model, env)
+    if variable is not None:
+        if path is None:
+            return None
+        if variable not in externals:
+            externals[variable] = ModelIndex (env[variable])
+        index = externals[variable]
+    kind, matches = index.find (path)
+    if kind == "ok":
+        return None
+    problem = dict (where, model=model, problem=kind)
+    if kind == "missing":
+        problem["near"] = index.near (path)
+    else:
+        problem["matches"] = matches
+    return problem
+
+def describe (p):
+    text = "%s:%d: %s model %s" % (p["file"], p["line"], p["problem"], p["model"])
+    if p.get ("matches"):
+        text += " (found %s)" % ", ".join (p["matches"])
+    elif p.get ("near"):
+        text += "; did you mean %s?" % " or ".join (p["near"])
+    return text
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Check that the 3D models named by the 3D map and the " + \
+            "footprints exist."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("--3d-dir", dest="threeddir", type=str, default="3d",
+            help="Directory of 3D models (default: 3d)")
+    p.add_argument ("--3dmap", dest="threedmap", type=str,
+            default=os.path.join ("config", "3dmap"),
+            help="3D map to check (default: config/3dmap)")
+    p.add_argument ("--env", dest="env", type=str, action="append", default=[],
+            metavar="NAME=DIR",
+            help="Directory of a path variable such as KISYS3DMOD; can be repeated")
+    p.add_argument ("--unused", dest="unused", action="store_const",
+            const=True, default=False,
+            help="List the models nothing refers to")
+    p.add_argument ("--json", dest="json", type=str, default=None,
+            help="Also write the problems to this JSON file")
+    p.add_argument ("footprints", metavar="FILE", type=str, nargs="*",
+            help=".kicad_mod files or .pretty directories (default: all committed)")
+    args = p.parse_args ()
+
+    if not os.path.isdir (args.threeddir):
+        raise Exception ("%s: no 3D models; run 'make 3d' first" % args.threeddir)
+
+    env = {}
+    for i in args.env:
+        if "=" not in i:
+            p.error ("--env needs NAME=DIR")
+        name, value = i.split ("=", 1)
+        env[name] = value
+    index = ModelIndex (args.threeddir)
+    externals = {}
+
+    refs = []
+    for name, entries in sorted (freepcb2pretty.read_3dmap (args.threedmap).items ()):
+        for key, value, lineno in entries:
+            if key == "3dmod":
+                refs.append (({"file": args.threedmap, "line": lineno}, value))
+    if args.footprints:
+        files = freepcb2pretty.find_footprints (args.footprints)
+    else:
+        files = committed_footprints ()
+    for path in files:
+        for lineno, model in footprint_refs (path):
+            refs.append (({"file": path, "line": lineno}, model))
+
+    # Variables not given are looked up in the environment
+    for where, model in refs:
+        m = ENV_VAR.match (model)
+        if m is not None:
+            name = m.group (1) or m.group (2)
+            if name not in env and os.environ.get (name):
+                env[name] = os.environ[name]
+
+    problems = []
+    used = set ()
+    unchecked = 0
+    for where, model in refs:
+        variable, path = resolve (model, env)
+        if variable is None:
+            used.add (path)
+        elif path is None:
+            unchecked += 1
+            continue
+        problem = check_ref (index, model, where, env, externals)
+        if problem is not None:
+            problems.append (problem)
+            used.update (problem.get ("matches", ()))
+
+    for i in problems:
+        print (describe (i))
+    unused = sorted (index.paths - used)
+    if args.unused:
+        for i in unused:
+            print ("unused model %s" % i)
+
+    print ("%d references in %d files, %d models; %d problems, %d unused models%s" %
+            (len (refs), len (files) + 1, len (index), len (problems),
+                len (unused), ", %d references through unknown variables" %
+                unchecked if unchecked else ""))
+
+    if args.json is not None:
+        with open (args.json, "w") as f:
+            json.dump ({"problems": problems, "unused": unused}, f,
+                    indent=1, sort_keys=True)
+
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
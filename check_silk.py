@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# check_silk
+
+# CC0 1.0 Universal
+
+# This script checks KiCad footprints for silkscreen lines and arcs that
+# cross exposed copper pads. Pad shapes change depending on converter options
+# (--rounded-pads in particular), and freepcb2pretty copies the FreePCB outline
+# straight to silk without looking at them.
+#
+# Each footprint's pads are inserted into a uniform grid index, and every
+# fp_line/fp_arc on a silk layer is tested, widened by half its line width
+# plus the clearance, against only the pads in the cells it passes through.
+# Pads are treated as rounded rectangles (rect, roundrect, oval and circle
+# are all special cases of one), so segment/pad intersection is exact and
+# gives a single parameter interval per pad, which is what the --fix option
+# uses to clip the silk.
+#
+# Arcs are checked as short chords. When clipped, the remaining pieces are
+# written back as arcs with the same center, in the syntax they were read
+# in: legacy arcs (start is the center, with an angle) or KiCad 6 and later
+# arcs (start, mid and end points), with the line width as (width) or
+# (stroke (width)).
+
+import os
+import sys
+import math
+
+from freepcb2pretty import S, SexpLoad, SexpDump, find_footprints, arc_through
+from freepcb2pretty import sexp_head as head, sexp_child as child
+
+VERSION = "1.0"
+
+# Grid cell size for the pad index, in mm
+CELL_SIZE = 1.0
+
+# Arc chords are no longer than this many degrees
+ARC_STEP = 5.0
+
+# Default roundrect corner ratio when a pad doesn't specify one
+RRATIO = 0.25
+
+# Pieces of a clipped silk line shorter than this (mm) are dropped
+MIN_PIECE = 0.01
+
+# Overlaps shorter than this (mm) are rounding noise, not violations
+EPSILON = 1e-4
+
+SILK_LAYERS = {"F.SilkS": ("F.Cu", "F.Mask"), "B.SilkS": ("B.Cu", "B.Mask")}
+
+# Children of a silk item that clipped pieces don't copy: the geometry, and
+# the timestamp, which has to be unique
+GEOMETRY = ("start", "mid", "end", "angle", "tstamp", "uuid")
+
+def node_point (node, name):
+    point = child (node, name)
+    if point is None:
+        raise ValueError ("%s without (%s)" % (head (node), name))
+    return float (point[1]), float (point[2])
+
+def line_width (node):
+    """Line width of a silk item, old style or new."""
+    width = child (node, "width")
+    if width is None:
+        stroke = child (node, "stroke")
+        if stroke is not None:
+            width = child (stroke, "width")
+    return float (width[1]) if width is not None else 0.
+
+def pad_layers (node):
+    layers = child (node, "layers")
+    if layers is None:
+        return []
+    return [str (i) for i in layers[1:]]
+
+def pad_exposed (layers, copper, mask):
+    """Check whether a pad has exposed copper on one side."""
+    side = copper[0]
+    has_copper = copper in layers or "*.Cu" in layers
+    has_mask = mask in layers or "*.Mask" in layers or \
+            (side + ".Mask") in layers
+    return has_copper and has_mask
+
+class RoundRect (object):
+    """A pad outline in its own frame: a rectangle of half-size (a, b) with
+    corner radius r, centred at (x, y) and rotated by 'angle' degrees.
+    """
+
+    __slots__ = ("name", "x", "y", "cos", "sin", "a", "b", "r")
+
+    def __init__ (self, name, x, y, angle, a, b, r):
+        self.name = name
+        self.x = x
+        self.y = y
+        theta = math.radians (angle)
+        self.cos = math.cos (theta)
+        self.sin = math.sin (theta)
+        self.a = a
+        self.b = b
+        self.r = min (r, a, b)
+
+    @classmethod
+    def from_sexp (cls, node):
+        """Build from a (pad ...) node, or return None for unsupported pads."""
+        if len (node) < 4:
+            return None
+        shape = str (node[3])
+        at = child (node, "at")
+        size = child (node, "size")
+        if at is None or size is None:
+            return None
+        x, y = float (at[1]), float (at[2])
+        angle = float (at[3]) if len (at) > 3 else 0.
+        a, b = float (size[1]) / 2, float (size[2]) / 2
+
+        if shape == "circle":
+            a = b = r = max (a, b)
+        elif shape == "oval":
+            r = min (a, b)
+        elif shape == "roundrect":
+            ratio = child (node, "roundrect_rratio")
+            ratio = float (ratio[1]) if ratio is not None else RRATIO
+            r = 2 * min (a, b) * ratio
+        else:
+            # rect, trapezoid, custom: use the bounding rectangle
+            r = 0.
+        return cls (str (node[1]), x, y, angle, a, b, r)
+
+    def extent (self):
+        """Return the (left, right, top, bottom) box of the pad."""
+        c, s = abs (self.cos), abs (self.sin)
+        hx = self.a * c + self.b * s
+        hy = self.a * s + self.b * c
+        return (self.x - hx, self.x + hx, self.y - hy, self.y + hy)
+
+    def to_local (self, x, y):
+        dx, dy = x - self.x, y - self.y
+        return (dx * self.cos - dy * self.sin, dx * self.sin + dy * self.cos)
+
+    def interval (self, p0, p1, grow):
+        """Return the (t0, t1) parameter range of segment p0-p1 that lies
+        within 'grow' of the pad, or None.
+        """
+
+        x0, y0 = self.to_local (p0[0], p0[1])
+        x1, y1 = self.to_local (p1[0], p1[1])
+        dx, dy = x1 - x0, y1 - y0
+
+        a = self.a + grow
+        b = self.b + grow
+        r = self.r + grow
+        ca, cb = a - r, b - r
+
+        parts = [
+            clip_box (x0, y0, dx, dy, -a, a, -cb, cb),
+            clip_box (x0, y0, dx, dy, -ca, ca, -b, b)]
+        if r > 0:
+            for cx in (-ca, ca):
+                for cy in (-cb, cb):
+                    parts.append (clip_circle (x0 - cx, y0 - cy, dx, dy, r))
+
+        parts = [i for i in parts if i is not None]
+        if not parts:
+            return None
+        return (min (i[0] for i in parts), max (i[1] for i in parts))
+
+def clip_box (x0, y0, dx, dy, left, right, top, bottom):
+    """Liang-Barsky clip of x0+t*dx, y0+t*dy (0 <= t <= 1) to a box."""
+    t0, t1 = 0., 1.
+    for p, q in ((-dx, x0 - left), (dx, right - x0),
+                 (-dy, y0 - top), (dy, bottom - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+        else:
+            t = q / p
+            if p < 0:
+                if t > t1:
+                    return None
+                t0 = max (t0, t)
+            else:
+                if t < t0:
+                    return None
+                t1 = min (t1, t)
+    if t0 >= t1 and not (dx == 0 and dy == 0):
+        return None
+    return (t0, t1)
+
+def clip_circle (x0, y0, dx, dy, r):
+    """Clip x0+t*dx, y0+t*dy (0 <= t <= 1) to a circle at the origin."""
+    a = dx * dx + dy * dy
+    b = 2 * (x0 * dx + y0 * dy)
+    c = x0 * x0 + y0 * y0 - r * r
+    if a == 0:
+        return (0., 1.) if c <= 0 else None
+    disc = b * b - 4 * a * c
+    if disc <= 0:
+        return None
+    root = math.sqrt (disc)
+    t0 = (-b - root) / (2 * a)
+    t1 = (-b + root) / (2 * a)
+    t0, t1 = max (t0, 0.), min (t1, 1.)
+    if t0 >= t1:
+        return None
+    return (t0, t1)
+
+class PadIndex (object):
+    """Uniform grid spatial index of pads."""
+
+    def __init__ (self, cell=CELL_SIZE):
+        self.cell = cell
+        self.cells = {}
+        self.pads = []
+
+    def cell_range (self, left, right, top, bottom):
+        cell = self.cell
+        return (int (math.floor (left / cell)), int (math.floor (right / cell)),
+                int (math.floor (top / cell)), int (math.floor (bottom / cell)))
+
+    def insert (self, pad):
+        index = len (self.pads)
+        self.pads.append (pad)
+        x0, x1, y0, y1 = self.cell_range (*pad.extent ())
+        for i in range (x0, x1 + 1):
+            for j in range (y0, y1 + 1):
+                self.cells.setdefault ((i, j), []).append (index)
+
+    def query (self, p0, p1, grow):
+        """Return the pads whose cells a grown segment touches."""
+        left = min (p0[0], p1[0]) - grow
+        right = max (p0[0], p1[0]) + grow
+        top = min (p0[1], p1[1]) - grow
+        bottom = max (p0[1], p1[1]) + grow
+        x0, x1, y0, y1 = self.cell_range (left, right, top, bottom)
+
+        found = set ()
+        cells = self.cells
+        for i in range (x0, x1 + 1):
+            for j in range (y0, y1 + 1):
+                hit = cells.get ((i, j))
+                if hit:
+                    found.update (hit)
+        return [self.pads[i] for i in sorted (found)]
+
+class SilkItem (object):
+    """A silk line or arc, flattened into chords for checking. Raises
+    ValueError if the item can't be read.
+    """
+
+    def __init__ (self, node, layer, width):
+        self.node = node
+        self.layer = layer
+        self.width = width
+        self.center = None
+        self.start_angle = 0.
+        self.sweep = 0.
+        self.radius = 0.
+        self.mid = False
+        # Layer, width and anything else the pieces keep
+        self.rest = [i for i in node[1:] if head (i) not in GEOMETRY]
+
+        start, end = node_point (node, "start"), node_point (node, "end")
+        center = None
+        if head (node) == "fp_arc":
+            if child (node, "mid") is not None:
+                # KiCad 6 and later: an arc through three points
+                self.mid = True
+                arc = arc_through (start, node_point (node, "mid"), end)
+                if arc is not None:
+                    center, sweep = arc
+            elif child (node, "angle") is not None:
+                # Legacy: start is the center, end is the first point
+                center, start = start, end
+                sweep = float (child (node, "angle")[1])
+            else:
+                raise ValueError ("fp_arc without (angle) or (mid)")
+
+        if center is None:
+            # A line, or an arc through three points in line
+            self.points = [start, end]
+            self.slop = 0.
+        else:
+            cx, cy = center
+            sx, sy = start
+            self.center = (cx, cy)
+            self.radius = math.hypot (sx - cx, sy - cy)
+            self.start_angle = math.atan2 (sy - cy, sx - cx)
+            self.sweep = math.radians (sweep)
+            steps = max (1, int (math.ceil (abs (math.degrees (self.sweep))
+                / ARC_STEP)))
+            self.points = [self.arc_point (float (k) / steps)
+                    for k in range (steps + 1)]
+            # Sagitta of one chord: covers the gap between chord and arc
+            self.slop = self.radius * (1 - math.cos (self.sweep / steps / 2))
+
+    def arc_point (self, u):
+        theta = self.start_angle + u * self.sweep
+        return (self.center[0] + self.radius * math.cos (theta),
+                self.center[1] + self.radius * math.sin (theta))
+
+    def chords (self):
+        return list (zip (self.points[:-1], self.points[1:]))
+
+    def pieces (self, covered):
+        """Return new silk nodes for the parts of this item outside the
+        sorted, merged 'covered' intervals of the item's parameter (0..1).
+        """
+
+        keep = []
+        last = 0.
+        for t0, t1 in covered:
+            if t0 > last:
+                keep.append ((last, t0))
+            last = max (last, t1)
+        if last < 1.:
+            keep.append ((last, 1.))
+
+        nodes = []
+        if self.center is None:
+            (x0, y0), (x1, y1) = self.points
+            length = math.hypot (x1 - x0, y1 - y0)
+            for t0, t1 in keep:
+                if (t1 - t0) * length < MIN_PIECE:
+                    continue
+                nodes.append ([S("fp_line"),
+                    [S("start"), x0 + t0 * (x1 - x0), y0 + t0 * (y1 - y0)],
+                    [S("end"), x0 + t1 * (x1 - x0), y0 + t1 * (y1 - y0)]] +
+                    self.rest)
+        else:
+            length = abs (self.sweep) * self.radius
+            for t0, t1 in keep:
+                if (t1 - t0) * length < MIN_PIECE:
+                    continue
+                sx, sy = self.arc_point (t0)
+                if self.mid:
+                    mx, my = self.arc_point ((t0 + t1) / 2)
+                    ex, ey = self.arc_point (t1)
+                    nodes.append ([S("fp_arc"),
+                        [S("start"), sx, sy],
+                        [S("mid"), mx, my],
+                        [S("end"), ex, ey]] + self.rest)
+                else:
+                    nodes.append ([S("fp_arc"),
+                        [S("start"), self.center[0], self.center[1]],
+                        [S("end"), sx, sy],
+                        [S("angle"), math.degrees ((t1 - t0) * self.sweep)]] +
+                        self.rest)
+        return nodes
+
+def merge_intervals (intervals):
+    merged = []
+    for t0, t1 in sorted (intervals):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max (merged[-1][1], t1))
+        else:
+            merged.append ((t0, t1))
+    return merged
+
+def check_module (sexp, clearance=0., fix=False):
+    """Check one footprint s-expression. Return a list of
+    (layer, item head, pad name) violations. If 'fix' is set, offending silk
+    items are replaced in 'sexp' by their clipped pieces.
+    """
+
+    # One pass to sort out pads and silk items
+    pads = []
+    silk = {}
+    for position, node in enumerate (sexp):
+        name = head (node)
+        if name == "pad":
+            pads.append (node)
+        elif name == "fp_line" or name == "fp_arc":
+            layer = child (node, "layer")
+            if layer is not None and str (layer[1]) in SILK_LAYERS:
+                silk.setdefault (str (layer[1]), []).append ((position, node))
+
+    violations = []
+    replacements = {}
+    for silk_layer, items in sorted (silk.items ()):
+        copper, mask = SILK_LAYERS[silk_layer]
+        index = PadIndex ()
+        for node in pads:
+            if not pad_exposed (pad_layers (node), copper, mask):
+                continue
+            pad = RoundRect.from_sexp (node)
+            if pad is not None:
+                index.insert (pad)
+        if not index.pads:
+            continue
+
+        for position, node in items:
+            width = line_width (node)
+            item = SilkItem (node, silk_layer, width)
+            grow = width / 2 + clearance + item.slop
+            chords = item.chords ()
+            covered = []
+            hit_pads = []
+            for k, (p0, p1) in enumerate (chords):
+                length = math.hypot (p1[0] - p0[0], p1[1] - p0[1])
+                for pad in index.query (p0, p1, grow):
+                    t = pad.interval (p0, p1, grow)
+                    # Ignore silk that only touches the pad outline
+                    if t is None or (t[1] - t[0]) * length < EPSILON:
+                        continue
+                    if pad.name not in hit_pads:
+                        hit_pads.append (pad.name)
+                    covered.append (((k + t[0]) / len (chords),
+                                     (k + t[1]) / len (chords)))
+
+            for name in hit_pads:
+                violations.append ((silk_layer, head (node), name))
+            if fix and covered:
+                replacements[position] = item.pieces (merge_intervals (covered))
+
+    for position in sorted (replacements, reverse=True):
+        sexp[position:position + 1] = replacements[position]
+
+    return violations
+
+def check_file (path, clearance=0., fixdir=None):
+    """Check one .kicad_mod file, writing a fixed copy into fixdir if given
+    and needed. Return (path, violations, error), where 'error' says why
+    the file couldn't be checked, or is None.
+    """
+
+    try:
+        with open (path) as f:
+            sexp = SexpLoad (f)
+        violations = check_module (sexp, clearance, fix=fixdir is not None)
+    except ValueError as e:
+        return path, [], str (e)
+    if violations and fixdir is not None:
+        with open (os.path.join (fixdir, os.path.basename (path)), 'w') as f:
+            SexpDump (sexp, f)
+    return path, violations, None
+
+def _check_file_star (args):
+    return check_file (*args)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Check KiCad footprints for silkscreen crossing exposed " + \
+            "pads, optionally writing clipped copies."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("paths", metavar="PATH", type=str, nargs="+",
+            help=".pretty directories or .kicad_mod files")
+    p.add_argument ("--clearance", dest="clearance", type=float, default=0.,
+            help="Minimum silk to pad clearance in mm (default: 0)")
+    p.add_argument ("--fix", dest="fixdir", type=str, default=None,
+            help="Write clipped copies of offending footprints to this directory")
+    p.add_argument ("-j", "--jobs", dest="jobs", type=int, default=None,
+            help="Number of worker processes (default: one per CPU)")
+    args = p.parse_args ()
+
+    files = find_footprints (args.paths)
+    if args.fixdir is not None and not os.path.isdir (args.fixdir):
+        os.makedirs (args.fixdir)
+
+    work = [(i, args.clearance, args.fixdir) for i in files]
+    if args.jobs == 1:
+        results = map (_check_file_star, work)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool (args.jobs)
+        results = pool.imap (_check_file_star, work, chunksize=32)
+
+    nbad = 0
+    nerrors = 0
+    for path, violations, error in results:
+        if error is not None:
+            nerrors += 1
+            print ("%s: can't check: %s" % (path, error))
+        if violations:
+            nbad += 1
+        for layer, item, pad in violations:
+            print ("%s: %s on %s crosses pad %s" % (path, item, layer, pad))
+
+    if pool is not None:
+        pool.close ()
+        pool.join ()
+
+    print ("%d of %d footprints have silk over pads%s" % (nbad, len (files),
+            ", %d could not be checked" % nerrors if nerrors else ""))
+    return 1 if nbad or nerrors else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# check_variants
+
+# CC0 1.0 Universal
+
+# This script checks that the IPC7351 Least/Nominal/Most libraries agree with
+# each other. The three density levels should contain the same footprints,
+# with the same pad names, pad counts and pad centres; only pad sizes and
+# courtyard margins are expected to differ.
+#
+# Each variant can be given either as a FreePCB zip (loaded through Library)
+# or as a .pretty directory. All variants are loaded into one table keyed by
+# footprint name (L/M/N suffixes stripped), so every footprint is compared
+# once across all variants with no pairwise scans. The first variant given
+# is the reference the others are compared against.
+#
+# Coordinates are compared in KiCad millimeters (Y down) whatever the source,
+# so a zip can be checked against a .pretty directory.
+
+import io
+import os
+import sys
+import json
+import argparse
+import zipfile
+from collections import Counter
+
+import freepcb2pretty
+from freepcb2pretty import SexpLoad, sexp_head, sexp_child, to_mm
+
+VERSION = "1.0"
+
+# Pads moving less than this (mm) are considered to be in the same place
+TOLERANCE = 0.001
+
+def strip_lmn (name):
+    if name and name[-1] in "LMNlmn":
+        return name[:-1]
+    return name
+
+def load_zip (path):
+    """Load a FreePCB zip, returning {name: [(pad name, x, y), ...]}."""
+    opts = argparse.Namespace ()
+    with zipfile.ZipFile (path) as zf:
+        library = freepcb2pretty.load_zip (zf, opts)
+
+    footprints = {}
+    for module in library.Modules:
+        pads = []
+        for i in module.pins ():
+            # + 0. turns -0.0 into 0.0, so equal pads print the same
+            pads.append ((i.Name, to_mm (i.Coords[0], i.Units) + 0.,
+                    -to_mm (i.Coords[1], i.Units) + 0.))
+        footprints[strip_lmn (module.Name)] = pads
+    return footprints
+
+def load_kicad_mod (path):
+    """Load one .kicad_mod file, returning (name, [(pad name, x, y), ...])."""
+    with io.open (path, encoding="utf8") as f:
+        sexp = SexpLoad (f)
+    pads = []
+    for node in sexp[1:]:
+        if sexp_head (node) != "pad":
+            continue
+        at = sexp_child (node, "at")
+        pads.append ((str (node[1]), float (at[1]) + 0., float (at[2]) + 0.))
+    name = os.path.basename (path)[:-len (".kicad_mod")]
+    return strip_lmn (name), pads
+
+def load_pretty (path, pool=None):
+    """Load a .pretty directory, returning {name: [(pad name, x, y), ...]}."""
+    files = freepcb2pretty.find_footprints ([path])
+    if pool is None:
+        results = map (load_kicad_mod, files)
+    else:
+        results = pool.imap (load_kicad_mod, files, chunksize=32)
+    return dict (results)
+
+def load_variant (path, pool=None):
+    if os.path.isdir (path):
+        return load_pretty (path, pool)
+    return load_zip (path)
+
+def variant_name (path):
+    name = os.path.basename (os.path.normpath (path))
+    for ext in (".pretty", ".zip"):
+        if name.endswith (ext):
+            name = name[:-len (ext)]
+    return name
+
+def pad_centres (pads):
+    """Group pad centres by pad name, sorted so duplicates pair up."""
+    centres = {}
+    for name, x, y in pads:
+        centres.setdefault (name, []).append ((x, y))
+    for i in centres.values ():
+        i.sort ()
+    return centres
+
+def compare (variants, names, tolerance=TOLERANCE):
+    """Compare loaded variants. 'variants' is a list of {name: pads} dicts
+    and 'names' their labels. Return a list of problem dicts.
+    """
+
+    # Hash join: one row per footprint, one column per variant
+    table = {}
+    for column, footprints in enumerate (variants):
+        for name, pads in footprints.items ():
+            table.setdefault (name, [None] * len (variants))[column] = pads
+
+    problems = []
+    for fpname in sorted (table):
+        row = table[fpname]
+        missing = [names[i] for i, pads in enumerate (row) if pads is None]
+        if missing:
+            problems.append ({"footprint": fpname, "problem": "missing",
+                "variants": missing})
+
+        present = [i for i, pads in enumerate (row) if pads is not None]
+        if len (present) < 2:
+            continue
+        ref = present[0]
+        ref_names = Counter (i[0] for i in row[ref])
+        ref_centres = pad_centres (row[ref])
+
+        for other in present[1:]:
+            pads = row[other]
+            if len (pads) != len (row[ref]):
+                problems.append ({"footprint": fpname, "problem": "pad count",
+                    "variants": [names[ref], names[other]],
+                    "counts": [len (row[ref]), len (pads)]})
+
+            other_names = Counter (i[0] for i in pads)
+            if other_names != ref_names:
+                problems.append ({"footprint": fpname, "problem": "pad names",
+                    "variants": [names[ref], names[other]],
+                    "only_in_reference": sorted ((ref_names - other_names).elements ()),
+                    "only_in_other": sorted ((other_names - ref_names).elements ())})
+
+            other_centres = pad_centres (pads)
+            for padname in sorted (set (ref_centres) & set (other_centres)):
+                for a, b in zip (ref_centres[padname], other_centres[padname]):
+                    dx, dy = b[0] - a[0], b[1] - a[1]
+                    if abs (dx) > tolerance or abs (dy) > tolerance:
+                        problems.append ({"footprint": fpname,
+                            "problem": "pad moved", "pad": padname,
+                            "variants": [names[ref], names[other]],
+                            "from": list (a), "to": list (b)})
+    return problems
+
+def describe (problem):
+    p = problem
+    if p["problem"] == "missing":
+        return "%s: missing from %s" % (p["footprint"], ", ".join (p["variants"]))
+    elif p["problem"] == "pad count":
+        return "%s: %s has %d pads, %s has %d" % (p["footprint"],
+                p["variants"][0], p["counts"][0], p["variants"][1], p["counts"][1])
+    elif p["problem"] == "pad names":
+        return "%s: pad names differ between %s and %s (%s / %s)" % (
+                p["footprint"], p["variants"][0], p["variants"][1],
+                " ".join (p["only_in_reference"]) or "-",
+                " ".join (p["only_in_other"]) or "-")
+    else:
+        return "%s: pad %s moves from (%g, %g) in %s to (%g, %g) in %s" % (
+                p["footprint"], p["pad"], p["from"][0], p["from"][1],
+                p["variants"][0], p["to"][0], p["to"][1], p["variants"][1])
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Check that IPC7351 Least/Nominal/Most libraries contain " + \
+            "the same footprints with the same pads in the same places."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("variants", metavar="VARIANT", type=str, nargs="+",
+            help="FreePCB zips or .pretty directories; the first is the reference")
+    p.add_argument ("--tolerance", dest="tolerance", type=float,
+            default=TOLERANCE,
+            help="Pad centre tolerance in mm (default: %g)" % TOLERANCE)
+    p.add_argument ("--ignore-moves", dest="ignore_moves", action="store_const",
+            const=True, default=False,
+            help="Only report missing footprints and pad name/count mismatches")
+    p.add_argument ("--json", dest="json", type=str, default=None,
+            help="Also write the problems to this JSON file")
+    p.add_argument ("-j", "--jobs", dest="jobs", type=int, default=None,
+            help="Worker processes for .pretty directories (default: one per CPU)")
+    args = p.parse_args ()
+
+    if len (args.variants) < 2:
+        p.error ("at least two variants are needed")
+
+    pool = None
+    if args.jobs != 1 and any (os.path.isdir (i) for i in args.variants):
+        import multiprocessing
+        pool = multiprocessing.Pool (args.jobs)
+
+    variants = [load_variant (i, pool) for i in args.variants]
+    names = [variant_name (i) for i in args.variants]
+    if pool is not None:
+        pool.close ()
+        pool.join ()
+
+    problems = compare (variants, names, args.tolerance)
+    if args.ignore_moves:
+        problems = [i for i in problems if i["problem"] != "pad moved"]
+
+    for i in problems:
+        print (describe (i))
+
+    counts = Counter (i["problem"] for i in problems)
+    print ("%d footprints; %s" % (len (set ().union (*variants)),
+        ", ".join ("%d %s" % (counts[i], i) for i in sorted (counts)) or "no problems"))
+
+    if args.json is not None:
+        with open (args.json, "w") as f:
+            json.dump (problems, f, indent=1, sort_keys=True)
+
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -1,30 +1,36 @@
 import os
+import sys
 import time
 
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), ".."))
+from freepcb2pretty import format_number as n
+from check_models import ModelIndex
+
 PAD_W = 1.524
 PAD_H = 2.286
 PAD_DRILL = 1.
 
 def line (f, sx, sy, ex, ey, layer, width):
-    f.write ("  (fp_line (start %f %f) (end %f %f) (layer %s) (width %f))\n" %
-            (sx, sy, ex, ey, layer, width))
+    f.write ("  (fp_line (start %s %s) (end %s %s) (layer %s) (width %s))\n" %
+            (n (sx), n (sy), n (ex), n (ey), layer, n (width)))
 
 def pthpad (f, num, shape, x, y, width, height, drill,
         offsetx=0, offsety=0, layers="*.Cu *.Mask F.SilkS"):
 
     if offsetx == 0 and offsety == 0:
-        f.write ("  (pad %d thru_hole %s (at %f %f) (size %f %f) (drill %f) (layers %s))\n" %
-                (num, shape, x, y, width, height, drill, layers))
+        f.write ("  (pad %d thru_hole %s (at %s %s) (size %s %s) (drill %s) (layers %s))\n" %
+                (num, shape, n (x), n (y), n (width), n (height), n (drill), layers))
     else:
-        f.write ("  (pad %d thru_hole %s (at %f %f) (size %f %f) (drill %f (offset %f %f)) (layers %s))\n" %
-                (num, shape, x, y, width, height, drill, offsetx, offsety, layers))
+        f.write ("  (pad %d thru_hole %s (at %s %s) (size %s %s) (drill %s (offset %s %s)) (layers %s))\n" %
+                (num, shape, n (x), n (y), n (width), n (height), n (drill),
+                    n (offsetx), n (offsety), layers))
 
 def gen_fp (f, name, npins, model=None, shrouded=False, dual=False):
     """Generate a header connector given an output file to receive the
     footprint, a footprint name, and a number of pins.
     """
 
-    f.write ("(module %s (layer F.Cu) (tedit %08X)\n" % (name, time.time ()))
+    f.write ("(module %s (layer F.Cu) (tedit %08X)\n" % (name, int (time.time ())))
     f.write ("  (fp_text reference REF** (at 0 0) (layer F.SilkS)\n")
     f.write ("    (effects (font (size 0.8 0.8) (thickness 0.15)))\n")
     f.write ("  )\n")
@@ -131,14 +137,14 @@ for i in range (1, 25):
     with open (fpname + ".kicad_mod", 'w') as f:
         gen_fp (f, fpname, i, model)
 
+models = ModelIndex (os.path.join (os.environ["HOME"], 'git/kicad-pcblib/3d'))
+
 for i in range (1, 25):
     fpname = "CONN-100MIL-M-1x%d-SHROUD" % i
 
     # Shrouded 3D models aren't available in all sizes
     model = "conn_strip/vasch_strip_%d.wrl" % i
-    mfile = os.path.join (os.environ["HOME"],
-            'git/kicad-pcblib/3d', model)
-    if not os.path.exists (mfile):
+    if not models.exists (model):
         model = 'pin_strip/pin_strip_%d.wrl' % i
 
     with open (fpname + ".kicad_mod", 'w') as f:
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# diff_libs
+
+# CC0 1.0 Universal
+
+# This script compares two snapshots of the footprint libraries and reports
+# what changed in footprint terms (pads added, moved or resized, 3D model
+# changed, courtyard resized...) rather than as line diffs of one-line
+# s-expressions.
+#
+# A snapshot is either a directory (a .pretty library, or a directory
+# containing .pretty libraries) or, with --git, a git revision. Footprints are
+# matched by library and name and compared by content hash first; only the
+# ones that differ are read and parsed. Directory files are hashed the way git
+# hashes blobs, so with --git the hashes come straight from 'git ls-tree' and
+# unchanged files are never read, and a directory can be compared with a
+# revision.
+#
+# Examples:
+#   diff_libs.py /tmp/old-libs .
+#   diff_libs.py --git HEAD~1 HEAD
+#   diff_libs.py --git HEAD .              (working tree against HEAD)
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+from freepcb2pretty import SexpLoads, sexp_head, sexp_child
+
+VERSION = "1.0"
+
+# Coordinates closer than this (mm) are considered equal
+TOLERANCE = 1e-6
+
+# Graphic items are compared with their coordinates rounded to this many
+# decimals (mm)
+DIGITS = 6
+
+COURTYARD_LAYERS = ("F.CrtYd", "B.CrtYd")
+
+def blob_hash (data):
+    """Hash bytes the way git hashes a blob."""
+    sha = hashlib.sha1 (("blob %d\0" % len (data)).encode ("ascii"))
+    sha.update (data)
+    return sha.hexdigest ()
+
+class DirTree (object):
+    """A snapshot read from a directory."""
+
+    def __init__ (self, path):
+        self.path = path
+
+    def entries (self):
+        """Return {relative path: content hash} of every footprint."""
+        entries = {}
+        if self.path.rstrip ("/").endswith (".pretty"):
+            libs = [(os.path.basename (self.path.rstrip ("/")), self.path)]
+        else:
+            libs = [(i, os.path.join (self.path, i))
+                    for i in sorted (os.listdir (self.path))
+                    if i.endswith (".pretty")]
+        for lib, libpath in libs:
+            for name in sorted (os.listdir (libpath)):
+                if not name.endswith (".kicad_mod"):
+                    continue
+                with open (os.path.join (libpath, name), "rb") as f:
+                    entries[lib + "/" + name] = blob_hash (f.read ())
+        self.libs = dict (libs)
+        return entries
+
+    def read (self, relpath, blob):
+        lib, name = relpath.split ("/", 1)
+        with open (os.path.join (self.libs[lib], name), "rb") as f:
+            return f.read ().decode ("utf8")
+
+class GitTree (object):
+    """A snapshot read from a git revision."""
+
+    def __init__ (self, rev, repo="."):
+        self.rev = rev
+        self.repo = repo
+        self.batch = None
+
+    def entries (self):
+        out = subprocess.check_output (["git", "-C", self.repo, "ls-tree",
+            "-r", "-z", self.rev])
+        entries = {}
+        for record in out.decode ("utf8").split ("\0"):
+            if not record:
+                continue
+            meta, path = record.split ("\t", 1)
+            mode, kind, blob = meta.split ()
+            parts = path.split ("/")
+            if kind != "blob" or len (parts) != 2:
+                continue
+            if parts[0].endswith (".pretty") and parts[1].endswith (".kicad_mod"):
+                entries[path] = blob
+        return entries
+
+    def read (self, relpath, blob):
+        if self.batch is None:
+            self.batch = subprocess.Popen (["git", "-C", self.repo,
+                "cat-file", "--batch"], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        self.batch.stdin.write ((blob + "\n").encode ("ascii"))
+        self.batch.stdin.flush ()
+        header = self.batch.stdout.readline ().split ()
+        size = int (header[2])
+        data = self.batch.stdout.read (size + 1)[:size]
+        return data.decode ("utf8")
+
+    def close (self):
+        if self.batch is not None:
+            self.batch.stdin.close ()
+            self.batch.wait ()
+
+def summarize (sexp):
+    """Boil a footprint down to the parts worth diffing."""
+    pads = {}
+    graphics = {}
+    courtyard = None
+    texts = {}
+    model = None
+    header = {}
+
+    for node in sexp[2:]:
+        name = sexp_head (node)
+        if name is None:
+            continue
+        if name == "pad":
+            at = sexp_child (node, "at")
+            size = sexp_child (node, "size")
+            drill = sexp_child (node, "drill")
+            layers = sexp_child (node, "layers")
+            pads.setdefault (str (node[1]), []).append ({
+                "type": str (node[2]),
+                "shape": str (node[3]),
+                "at": [float (i) for i in at[1:]] if at else None,
+                "size": [float (i) for i in size[1:3]] if size else None,
+                "drill": str (drill[1:]) if drill else None,
+                "layers": sorted (str (i) for i in layers[1:]) if layers else None,
+            })
+        elif name in ("fp_line", "fp_arc", "fp_circle", "fp_poly", "fp_rect"):
+            layer = sexp_child (node, "layer")
+            layer = str (layer[1]) if layer else "?"
+            graphics.setdefault (layer, []).append (graphic_item (node))
+            if layer in COURTYARD_LAYERS:
+                for part in node[1:]:
+                    if sexp_head (part) in ("start", "end", "center", "mid"):
+                        courtyard = extend_box (courtyard, part[1], part[2])
+                    elif sexp_head (part) == "pts":
+                        for xy in part[1:]:
+                            courtyard = extend_box (courtyard, xy[1], xy[2])
+        elif name == "fp_text":
+            key = str (node[1])
+            if key in texts:
+                key = "%s %d" % (key, sum (1 for i in texts if
+                    i.split ()[0] == key) + 1)
+            at = sexp_child (node, "at")
+            layer = sexp_child (node, "layer")
+            size = None
+            effects = sexp_child (node, "effects")
+            font = sexp_child (effects, "font") if effects else None
+            if font is not None and sexp_child (font, "size"):
+                size = [round (float (i), DIGITS)
+                        for i in sexp_child (font, "size")[1:3]]
+            texts[key] = {"text": str (node[2]),
+                "at": [round (float (i), DIGITS) for i in at[1:]] if at else None,
+                "size": size,
+                "layer": str (layer[1]) if layer else None}
+        elif name == "model":
+            model = {"path": str (node[1])}
+            for part in node[2:]:
+                xyz = sexp_child (part, "xyz") if isinstance (part, list) else None
+                if xyz is not None:
+                    model[sexp_head (part)] = [float (i) for i in xyz[1:]]
+        elif name in ("layer", "descr", "tags", "attr", "tedit"):
+            header[name] = " ".join (str (i) for i in node[1:])
+
+    for items in graphics.values ():
+        items.sort ()
+    return {"pads": pads, "graphics": graphics, "courtyard": courtyard,
+            "texts": texts, "model": model, "header": header}
+
+def graphic_item (node):
+    """A graphic item as [kind, rounded coordinates..., width], in a form
+    that compares equal for the same geometry.
+    """
+    item = [sexp_head (node)]
+    for part in node[1:]:
+        head = sexp_head (part)
+        if head in ("start", "mid", "end", "center"):
+            item += [round (float (i), DIGITS) for i in part[1:3]]
+        elif head == "angle":
+            item.append (round (float (part[1]), DIGITS))
+        elif head == "pts":
+            for xy in part[1:]:
+                item += [round (float (i), DIGITS) for i in xy[1:3]]
+    width = sexp_child (node, "width")
+    if width is None and sexp_child (node, "stroke"):
+        width = sexp_child (sexp_child (node, "stroke"), "width")
+    item.append (round (float (width[1]), DIGITS) if width else None)
+    return item
+
+def extend_box (box, x, y):
+    x, y = float (x), float (y)
+    if box is None:
+        return [x, y, x, y]
+    return [min (box[0], x), min (box[1], y), max (box[2], x), max (box[3], y)]
+
+def close (a, b):
+    if a is None or b is None:
+        return a == b
+    return len (a) == len (b) and \
+            all (abs (i - j) <= TOLERANCE for i, j in zip (a, b))
+
+def diff_footprint (old, new):
+    """Return a list of change dicts between two summaries. Moved graphics
+    and texts are changes; only an edit time or layout change is "other":
+
+    >>> text = ('(module X (layer F.Cu) (tedit %s) (fp_text reference REF** '
+    ...     '(at 0 %s) (layer F.SilkS) (effects (font (size 1 1)))) '
+    ...     '(fp_line (start -1 %s) (end 1 %s) (layer F.SilkS) (width 0.15)))')
+    >>> old = summarize (SexpLoads (text % (1, -2, -1, -1)))
+    >>> moved = summarize (SexpLoads (text % (2, -2.5, -1.5, -1.5)))
+    >>> for i in diff_footprint (old, moved):
+    ...     print (describe (i))
+    text moved reference: (0 -2) -> (0 -2.5)
+    F.SilkS: fp_line (-1 -1 1 -1 0.15) -> fp_line (-1 -1.5 1 -1.5 0.15)
+    >>> for i in diff_footprint (old, summarize (SexpLoads (text % (2, -2, -1, -1)))):
+    ...     print (describe (i))
+    formatting or edit time only
+    """
+    changes = []
+
+    for key in sorted (set (old["header"]) | set (new["header"])):
+        if key == "tedit":
+            continue
+        a, b = old["header"].get (key), new["header"].get (key)
+        if a != b:
+            changes.append ({"change": "header", "field": key, "old": a, "new": b})
+
+    for key in sorted (set (old["texts"]) | set (new["texts"])):
+        a, b = old["texts"].get (key), new["texts"].get (key)
+        if a is None or b is None:
+            changes.append ({"change": "text", "field": key,
+                "old": a and a["text"], "new": b and b["text"]})
+            continue
+        if a["text"] != b["text"]:
+            changes.append ({"change": "text", "field": key,
+                "old": a["text"], "new": b["text"]})
+        if not close (a["at"], b["at"]):
+            changes.append ({"change": "text moved", "field": key,
+                "old": a["at"], "new": b["at"]})
+        if not close (a["size"], b["size"]):
+            changes.append ({"change": "text resized", "field": key,
+                "old": a["size"], "new": b["size"]})
+        if a["layer"] != b["layer"]:
+            changes.append ({"change": "text layer", "field": key,
+                "old": a["layer"], "new": b["layer"]})
+
+    for name in sorted (set (old["pads"]) | set (new["pads"])):
+        a, b = old["pads"].get (name, []), new["pads"].get (name, [])
+        for pa, pb in zip (sorted (a, key=pad_key), sorted (b, key=pad_key)):
+            if not close (pa["at"], pb["at"]):
+                changes.append ({"change": "pad moved", "pad": name,
+                    "old": pa["at"], "new": pb["at"]})
+            if not close (pa["size"], pb["size"]):
+                changes.append ({"change": "pad resized", "pad": name,
+                    "old": pa["size"], "new": pb["size"]})
+            for field in ("type", "shape", "drill", "layers"):
+                if pa[field] != pb[field]:
+                    changes.append ({"change": "pad " + field, "pad": name,
+                        "old": pa[field], "new": pb[field]})
+        for pa in sorted (a, key=pad_key)[len (b):]:
+            changes.append ({"change": "pad removed", "pad": name, "old": pa["at"]})
+        for pb in sorted (b, key=pad_key)[len (a):]:
+            changes.append ({"change": "pad added", "pad": name, "new": pb["at"]})
+
+    if old["model"] != new["model"]:
+        changes.append ({"change": "model", "old": old["model"], "new": new["model"]})
+
+    if not close (old["courtyard"], new["courtyard"]):
+        changes.append ({"change": "courtyard", "old": old["courtyard"],
+            "new": new["courtyard"]})
+
+    for layer in sorted (set (old["graphics"]) | set (new["graphics"])):
+        a, b = old["graphics"].get (layer, []), new["graphics"].get (layer, [])
+        if a == b:
+            continue
+        removed = list (a)
+        added = []
+        for item in b:
+            if item in removed:
+                removed.remove (item)
+            else:
+                added.append (item)
+        changes.append ({"change": "graphics", "layer": layer,
+            "old": len (a), "new": len (b), "removed": removed, "added": added})
+
+    if not changes:
+        if normalized (old) == normalized (new):
+            # Only formatting, ordering or the edit time differ
+            changes.append ({"change": "other"})
+        else:
+            changes.append ({"change": "unclassified"})
+    return changes
+
+def normalized (summary):
+    """A summary without the parts that don't count as a change."""
+    header = dict (summary["header"])
+    header.pop ("tedit", None)
+    return dict (summary, header=header)
+
+def pad_key (pad):
+    return pad["at"] or []
+
+def diff_trees (old, new):
+    """Diff two snapshots. Returns {"added": [...], "removed": [...],
+    "changed": {path: [changes]}, "unchanged": count}.
+    """
+
+    old_entries = old.entries ()
+    new_entries = new.entries ()
+
+    added = sorted (set (new_entries) - set (old_entries))
+    removed = sorted (set (old_entries) - set (new_entries))
+    changed = {}
+    unchanged = 0
+    for path in sorted (set (old_entries) & set (new_entries)):
+        if old_entries[path] == new_entries[path]:
+            unchanged += 1
+            continue
+        a = summarize (SexpLoads (old.read (path, old_entries[path])))
+        b = summarize (SexpLoads (new.read (path, new_entries[path])))
+        changed[path] = diff_footprint (a, b)
+
+    return {"added": added, "removed": removed, "changed": changed,
+            "unchanged": unchanged}
+
+def describe (change):
+    c = change
+    kind = c["change"]
+    if kind == "other":
+        return "formatting or edit time only"
+    elif kind == "unclassified":
+        return "changed, but not in any way listed here"
+    elif kind in ("header", "text", "text layer"):
+        return "%s %s: %r -> %r" % (kind, c["field"], c["old"], c["new"])
+    elif kind in ("text moved", "text resized"):
+        return "%s %s: %s -> %s" % (kind, c["field"], fmt (c["old"]), fmt (c["new"]))
+    elif kind == "pad added":
+        return "pad %s added at %s" % (c["pad"], fmt (c["new"]))
+    elif kind == "pad removed":
+        return "pad %s removed from %s" % (c["pad"], fmt (c["old"]))
+    elif kind.startswith ("pad"):
+        return "%s %s: %s -> %s" % (kind, c["pad"], fmt (c["old"]), fmt (c["new"]))
+    elif kind == "model":
+        a = c["old"]["path"] if c["old"] else None
+        b = c["new"]["path"] if c["new"] else None
+        if a == b:
+            return "model %s placement changed" % a
+        return "model %s -> %s" % (a, b)
+    elif kind == "courtyard":
+        return "courtyard %s -> %s" % (fmt (c["old"]), fmt (c["new"]))
+    elif kind == "graphics":
+        if len (c["removed"]) == 1 and len (c["added"]) == 1:
+            return "%s: %s -> %s" % (c["layer"], fmt_item (c["removed"][0]),
+                    fmt_item (c["added"][0]))
+        return "%s: %d -> %d items (%d removed, %d added)" % (c["layer"],
+                c["old"], c["new"], len (c["removed"]), len (c["added"]))
+    return kind
+
+def fmt_item (item):
+    return "%s %s" % (item[0], fmt ([i for i in item[1:] if i is not None]))
+
+def fmt (value):
+    if isinstance (value, list) and all (isinstance (i, float) for i in value):
+        return "(" + " ".join ("%g" % i for i in value) + ")"
+    return str (value)
+
+def print_summary (result, f=sys.stdout, limit=None):
+    for path in result["removed"]:
+        f.write ("- %s\n" % path)
+    for path in result["added"]:
+        f.write ("+ %s\n" % path)
+    for path, changes in sorted (result["changed"].items ()):
+        f.write ("~ %s\n" % path)
+        shown = changes if limit is None else changes[:limit]
+        for c in shown:
+            f.write ("    %s\n" % describe (c))
+        if len (shown) < len (changes):
+            f.write ("    ... %d more\n" % (len (changes) - len (shown)))
+
+    counts = {}
+    for changes in result["changed"].values ():
+        for kind in set (i["change"] for i in changes):
+            counts[kind] = counts.get (kind, 0) + 1
+    f.write ("%d added, %d removed, %d changed, %d unchanged\n" % (
+        len (result["added"]), len (result["removed"]),
+        len (result["changed"]), result["unchanged"]))
+    for kind in sorted (counts):
+        f.write ("  %5d footprints with %s\n" % (counts[kind], kind))
+
+def make_tree (spec, git):
+    if git and not os.path.isdir (spec):
+        return GitTree (spec)
+    return DirTree (spec)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Show what changed between two snapshots of footprint " + \
+            "libraries, footprint by footprint."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("old", metavar="OLD", type=str,
+            help="Old snapshot: directory, or git revision with --git")
+    p.add_argument ("new", metavar="NEW", type=str,
+            help="New snapshot: directory, or git revision with --git")
+    p.add_argument ("--git", dest="git", action="store_const", const=True,
+            default=False,
+            help="Treat snapshots that aren't directories as git revisions")
+    p.add_argument ("--json", dest="json", type=str, default=None,
+            help="Write the full diff to this JSON file ('-' for stdout)")
+    p.add_argument ("--limit", dest="limit", type=int, default=10,
+            help="Changes shown per footprint in the summary (default: 10)")
+    args = p.parse_args ()
+
+    old = make_tree (args.old, args.git)
+    new = make_tree (args.new, args.git)
+    result = diff_trees (old, new)
+    for i in (old, new):
+        if isinstance (i, GitTree):
+            i.close ()
+
+    if args.json == "-":
+        json.dump (result, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write ("\n")
+    else:
+        print_summary (result, limit=args.limit)
+        if args.json is not None:
+            with open (args.json, "w") as f:
+                json.dump (result, f, indent=1, sort_keys=True)
+                f.write ("\n")
+
+    return 1 if result["added"] or result["removed"] or result["changed"] else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
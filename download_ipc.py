@@ -103,6 +103,22 @@ def main ():
     p.add_argument ("--hash-time", dest="hashtime", action="store_const",
             const=True, default=False,
             help="Set a fake edit time on the footprints using a hash")
+    p.add_argument ("--manifest", dest="manifest", type=str, default=None,
+            help="Write a manifest of the output for manifest.py")
+    p.add_argument ("--quiet", dest="quiet", action="store_const",
+            const=True, default=False,
+            help="Show a progress line instead of every file name")
+    p.add_argument ("--atomic", dest="atomic", action="store_const",
+            const=True, default=False,
+            help="Write into a staging directory and swap it into place when complete")
+    p.add_argument ("--keep-previous", dest="keep_previous", action="store_const",
+            const=True, default=False,
+            help="With --atomic, keep the replaced output as DEST.previous")
+    p.add_argument ("--watch", dest="watch", action="store_const",
+            const=True, default=False,
+            help="Keep running, rewriting footprints when the 3D map or exceptions lists change")
+    p.add_argument ("--profile", dest="profile", type=str, default=None,
+            help="Write a conversion profile to PREFIX.json and PREFIX.trace.json")
 
     args = p.parse_args ()
 
@@ -126,6 +142,24 @@ def main ():
     if args.hashtime:
         FREEPCB2KICAD_ARGS.append ("--hash-time")
 
+    if args.manifest is not None:
+        FREEPCB2KICAD_ARGS.extend (["--manifest", args.manifest])
+
+    if args.quiet:
+        FREEPCB2KICAD_ARGS.append ("--quiet")
+
+    if args.profile is not None:
+        FREEPCB2KICAD_ARGS.extend (["--profile", args.profile])
+
+    if args.atomic:
+        FREEPCB2KICAD_ARGS.append ("--atomic")
+
+    if args.keep_previous:
+        FREEPCB2KICAD_ARGS.append ("--keep-previous")
+
+    if args.watch:
+        FREEPCB2KICAD_ARGS.append ("--watch")
+
     # Download, if necessary, then open file
     if args.src.startswith ("http:/"):
         if not args.no_confirm_license:
@@ -51,14 +51,37 @@ import sys
 import re
 import os.path
 import math
+import json
+import zlib
+import struct
+import hashlib
+import contextlib
+import threading
+import uuid
+import shutil
+import tempfile
+import tarfile
+import gzip
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     unicode
 except NameError:
     unicode = str
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 VERSION="1.0"
 
+MANIFEST_VERSION = 1
+
 TEXT_SIZE = 1.
 TEXT_THICK = 0.2
 
@@ -96,7 +119,13 @@ def SexpDump (sexp, f, indentlevel=0):
     indentlevel is used for recursion.
     """
 
-    if isinstance (sexp, list):
+    if isinstance (sexp, SexpFragment):
+        f.write (sexp.text)
+
+        if indentlevel == 1 :
+            f.write("\n")
+
+    elif isinstance (sexp, list):
         f.write ("(")
         first = True
         for i in sexp:
@@ -111,6 +140,9 @@ def SexpDump (sexp, f, indentlevel=0):
         if indentlevel == 1 :
             f.write("\n")
 
+    elif isinstance (sexp, float):
+        f.write (NUMBERS.text (sexp))
+
     elif isinstance (sexp, (str, unicode)):
         f.write ('"')
         f.write (sexp.encode ("unicode_escape").decode ("ascii"))
@@ -119,6 +151,169 @@ def SexpDump (sexp, f, indentlevel=0):
     else:
         f.write (str(sexp))
 
+class NumberFormat (object):
+    """Writes numbers as millimetres: rounded to a resolution in nanometres,
+    with the shortest exact decimal text (no trailing zeros, no "-0"). The
+    same few values make up most of a library, so their text is cached.
+    """
+
+    # Values cached before the cache is emptied
+    CACHE_SIZE = 8192
+
+    def __init__ (self, resolution=1):
+        self.Resolution = resolution
+        self.Scale = 1e6 / resolution
+        self.Cache = {}
+
+    def text (self, value):
+        text = self.Cache.get (value)
+        if text is None:
+            if len (self.Cache) >= self.CACHE_SIZE:
+                self.Cache.clear ()
+            nm = int (round (value * self.Scale)) * self.Resolution
+            whole, frac = divmod (abs (nm), 1000000)
+            text = "-" if nm < 0 else ""
+            if frac:
+                text += "%d.%s" % (whole, ("%06d" % frac).rstrip ("0"))
+            else:
+                text += "%d" % whole
+            self.Cache[value] = text
+        return text
+
+# Number formatting for SexpDump; see set_resolution
+NUMBERS = NumberFormat ()
+
+def format_number (value):
+    """Return the text SexpDump writes for a number."""
+    return NUMBERS.text (value)
+
+def set_resolution (resolution):
+    """Set the resolution numbers are written at, in nanometres. Call this
+    before loading anything, since some expressions are written out as they
+    are created (see SexpFragment); their caches are emptied here.
+    """
+
+    global NUMBERS
+    if resolution < 1:
+        raise Exception ("resolution must be at least 1 nm")
+    if resolution != NUMBERS.Resolution:
+        NUMBERS = NumberFormat (resolution)
+        TextStyle.Cache.clear ()
+        PAD_SIZES.clear ()
+
+class SexpFragment (list):
+    """A sub-expression that is dumped to text once, when created, and then
+    written out as that text. It is still a list, so it compares and reprs
+    like the expression it stands for. Fragments are shared between
+    expressions, so don't modify them.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__ (self, items):
+        list.__init__ (self, items)
+        f = io.StringIO ()
+        SexpDump (list (self), f, 2)
+        self.text = f.getvalue ()
+
+SEXP_TOKEN = re.compile (r'"[^"\\]*(?:\\.[^"\\]*)*"|[^\s()"]+|[()]')
+SEXP_NUMBER = re.compile (r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+
+def SexpLoads (s):
+    """Parse an s-expression from a string. This is the inverse of SexpDump:
+    quoted strings become strings, numbers become int or float, and other
+    bare words become SexpSymbol. Only the first expression is returned.
+    """
+
+    stack = []
+    current = []
+    push = stack.append
+    pop = stack.pop
+    is_number = SEXP_NUMBER.match
+
+    for token in SEXP_TOKEN.findall (s):
+        c = token[0]
+        if c == "(":
+            new = []
+            current.append (new)
+            push (current)
+            current = new
+        elif c == ")":
+            if not stack:
+                raise ValueError ("Unbalanced ')' in s-expression")
+            current = pop ()
+            if not stack:
+                break
+        elif not stack:
+            raise ValueError ("Expected '(' but found %r" % token)
+        elif c == '"':
+            token = token[1:-1]
+            if "\\" in token:
+                token = token.encode ("ascii", "backslashreplace") \
+                        .decode ("unicode_escape")
+            current.append (token)
+        elif c in "-+.0123456789" and is_number (token):
+            try:
+                current.append (int (token))
+            except ValueError:
+                current.append (float (token))
+        else:
+            current.append (SexpSymbol (token))
+
+    if stack or not current:
+        raise ValueError ("Unexpected end of s-expression")
+    return current[0]
+
+def SexpLoad (f):
+    """Load an s-expression from a file. See SexpLoads."""
+    return SexpLoads (f.read ())
+
+def sexp_head (node):
+    """Return the name of an s-expression node, or None."""
+    if isinstance (node, list) and node:
+        return str (node[0])
+    return None
+
+def sexp_child (node, name):
+    """Return the first child node called 'name', or None."""
+    for i in node[1:]:
+        if isinstance (i, list) and i and str (i[0]) == name:
+            return i
+    return None
+
+def arc_through (start, mid, end):
+    """Return the (center, angle) of the arc from 'start' through 'mid' to
+    'end', or None if the points are in line.
+    """
+    ax, ay = start
+    bx, by = mid
+    cx, cy = end
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if abs (d) < 1e-12:
+        return None
+    a2, b2, c2 = ax * ax + ay * ay, bx * bx + by * by, cx * cx + cy * cy
+    ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+    uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+    a0 = math.atan2 (ay - uy, ax - ux)
+    a1 = math.atan2 (cy - uy, cx - ux)
+    # Sweep from start to end, the way that passes through mid
+    sweep = math.degrees (a1 - a0) % 360
+    cross = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    if cross < 0:
+        sweep -= 360
+    return (ux, uy), sweep
+
+def find_footprints (paths):
+    """Expand .pretty directories into their .kicad_mod files."""
+    files = []
+    for path in paths:
+        if os.path.isdir (path):
+            files.extend (os.path.join (path, i) for i in sorted (os.listdir (path))
+                    if i.endswith (".kicad_mod"))
+        else:
+            files.append (path)
+    return files
+
 def indent_string (s):
     """Put two spaces before each line in s"""
     lines = s.split ("\n")
@@ -160,6 +355,8 @@ def from_mm (n):
 
 
 class Point (object):
+    __slots__ = ("x", "y")
+
 
     def __init__ (self, x, y):
         self.x = x
@@ -186,6 +383,30 @@ def kicad_arc_center (start, end, angle):
 
     return center
 
+def arc_extremes (start, end, style):
+    """Return the points, other than its ends, where the arc that
+    Polyline.kicad_sexp writes from 'start' to 'end' (FreePCB coordinates,
+    side style 'style') reaches furthest along an axis. The arc is a circular
+    quarter, so it leaves the box spanned by its ends unless they are on a
+    diagonal.
+    """
+    if start[0] == end[0] and start[1] == end[1]:
+        return []
+    angle = -90 if style == 1 else 90
+    center = kicad_arc_center (Point (start[0], -start[1]),
+            Point (end[0], -end[1]), angle)
+    cx, cy = center.x, -center.y
+    r = math.hypot (start[0] - cx, start[1] - cy)
+    points = []
+    # A point of the circle is on a quarter arc if it is within 90 degrees
+    # of both ends; one at an end isn't returned
+    eps = r * r * 1e-9
+    for dx, dy in ((r, 0), (-r, 0), (0, r), (0, -r)):
+        if dx * (start[0] - cx) + dy * (start[1] - cy) > eps and \
+                dx * (end[0] - cx) + dy * (end[1] - cy) > eps:
+            points.append ((cx + dx, cy + dy))
+    return points
+
 class Library (object):
     def __init__ (self, file_in=None, opts=None):
         self.Modules = []
@@ -218,19 +439,54 @@ class Library (object):
         for i in self.Modules:
             i.strip_lmn ()
 
+    def set_origin (self, filename, crc):
+        """Record the source file (or zip member) all modules came from."""
+        for i in self.Modules:
+            i.Origin = (filename, crc)
+
+class TextStyle (object):
+    """Text height and line width in some units. Styles repeat across the
+    library, so they are interned (see TextStyle.get) and shared between
+    texts, along with their font expression.
+    """
+
+    __slots__ = ("Units", "Height", "LineWidth", "HeightMM", "Font")
+
+    # (units, height, line width): TextStyle
+    Cache = {}
+
+    def __init__ (self, units, height, linewidth):
+        self.Units = units
+        self.Height = height
+        self.LineWidth = linewidth
+        self.HeightMM = to_mm (height, units)
+        self.Font = SexpFragment ([S("font"),
+            [S("size"), self.HeightMM, self.HeightMM],
+            [S("thickness"), to_mm (linewidth, units)]])
+
+    @classmethod
+    def get (cls, units, height, linewidth):
+        """Return the shared style with these values."""
+        key = (units, height, linewidth)
+        style = cls.Cache.get (key)
+        if style is None:
+            style = cls.Cache[key] = cls (units, height, linewidth)
+        return style
+
 class TextProperties (object):
+    __slots__ = ("Style", "TextType", "Str", "x", "y", "Angle", "Mirrored",
+            "LayerNo", "Layer")
+
     def __init__ (self, _units, _type, _str):
         """Text properties."""
 
-        self.Units = _units
+        self.Style = TextStyle.get (_units, 1.27, 0.15)
         self.TextType = _type  # reference ,value or user
         self.Str = _str
 
         self.x = 0
         self.y = 0
-        self.Height = 1.27
         self.Angle = 0
-        self.LineWidth = 0.15
 
         self.Mirrored = False
         self.LayerNo = 0
@@ -238,27 +494,55 @@ class TextProperties (object):
 
         # 4, "F.SilkS"
 
+    # Style attributes, for convenience; setting one switches to another
+    # shared style
+    @property
+    def Units (self):
+        return self.Style.Units
+
+    @Units.setter
+    def Units (self, value):
+        self.Style = TextStyle.get (value, self.Height, self.LineWidth)
+
+    @property
+    def Height (self):
+        return self.Style.Height
+
+    @Height.setter
+    def Height (self, value):
+        self.Style = TextStyle.get (self.Units, value, self.LineWidth)
+
+    @property
+    def LineWidth (self):
+        return self.Style.LineWidth
+
+    @LineWidth.setter
+    def LineWidth (self, value):
+        self.Style = TextStyle.get (self.Units, self.Height, value)
+
     def kicad_sexp (self):
 
         # adjust position to hcenter,vcenter justification for KiCad
-        swidth = to_mm(self.Height, self.Units) * len(self.Str)
+        height = self.Style.HeightMM
+        swidth = height * len(self.Str)
         px =  to_mm(self.x, self.Units) + swidth/2
-        py = -to_mm(self.y, self.Units) - to_mm(self.Height, self.Units)/2
+        py = -to_mm(self.y, self.Units) - height/2
 
         sexp = ([S("fp_text"),
                 S(self.TextType), self.Str,
                 [S("at"), px, py ],
                 [S("layer"), self.Layer],
-                [S("effects"),
-                    [S("font"),
-                        [S("size"), to_mm(self.Height, self.Units), to_mm(self.Height, self.Units)],
-                        [S("thickness"), to_mm(self.LineWidth, self.Units)]]
-                    ]
+                [S("effects"), self.Style.Font]
                 ])
 
         return sexp
 
 class PCBmodule (object):
+    __slots__ = ("opts", "ThreeDName", "ThreeDScale", "ThreeDOffset",
+            "ThreeDRot", "Name", "Author", "Source", "Description",
+            "SourceName", "Origin", "Units", "SelectionRect", "RefText",
+            "ValText", "Centroid", "Graphics", "UserText", "tedit", "Rounding")
+
     def __init__ (self, file_in, opts):
         """Read out the footprint from the FreePCB module."""
         
@@ -292,6 +576,12 @@ class PCBmodule (object):
                 
         assert self.Name
 
+        # Name as read, before stripping L/M/N, and the (file, CRC) it came
+        # from; see Library.set_origin
+        self.SourceName = self.Name
+        self.Origin = (None, None)
+        self.Rounding = None
+
         # 
         self.Units = None
         self.SelectionRect = None
@@ -312,11 +602,10 @@ class PCBmodule (object):
                 self.RefText = TextProperties(self.Units, "reference", "REF**")
 
                 params = [i for i in file_in.value.split()]
-                self.RefText.Height = params[0]
+                self.RefText.Style = TextStyle.get (self.Units, params[0], params[4])
                 self.RefText.x = params[1]
                 self.RefText.y = params[2]
                 self.RefText.Angle = params[3]
-                self.RefText.LineWidth = params[4]
 
                 file_in.get_string ()
             elif file_in.key == "value_text":
@@ -324,11 +613,10 @@ class PCBmodule (object):
 
                 #
                 params = [i for i in file_in.value.split()]
-                self.ValText.Height = params[0]
+                self.ValText.Style = TextStyle.get (self.Units, params[0], params[4])
                 self.ValText.x = params[1]
                 self.ValText.y = params[2]
                 self.ValText.Angle = params[3]
-                self.ValText.LineWidth = params[4]
 
                 file_in.get_string ()
             elif file_in.key == "text":
@@ -339,11 +627,10 @@ class PCBmodule (object):
                 params = t[length:]
                 params = [i for i in params.split()]
 
-                text.Height = params[0]
+                text.Style = TextStyle.get (self.Units, params[0], params[4])
                 text.x = params[1]
                 text.y = params[2]
                 text.Angle = params[3]
-                text.LineWidth = params[4]
 
                 text.Mirrored = params[5]
                 text.LayerNo = params[6]
@@ -358,11 +645,11 @@ class PCBmodule (object):
                 # ignored
                 file_in.get_string ()
             elif file_in.key == "outline_polyline":
-                self.Graphics.append (Polyline.create_from_freepcb (file_in, opts, self.Units))
+                self.Graphics.append (Polyline.create_from_freepcb (file_in, self.Units))
             elif file_in.key == "n_pins":
                 file_in.get_string () # Skip the n_pins line
             elif file_in.key == "pin":
-                self.Graphics.append (Pin.create_from_freepcb (self.Name, file_in, opts, self.Units))
+                self.Graphics.append (Pin.create_from_freepcb (self, file_in))
             else:
                 raise Exception ("Unexpected key \"%s\" on line %d."
                         % (file_in.key, file_in.Lineno - 1))
@@ -375,6 +662,9 @@ class PCBmodule (object):
         # TODO
         # assert self.Centroid == "0 0 0 0"
 
+        if getattr (opts, "pin_arrays", True):
+            self.Graphics = find_pin_arrays (self.Graphics)
+
         self.tedit = time.time()
 
 
@@ -390,12 +680,13 @@ class PCBmodule (object):
             s += indent_string (str (i))
         return s
 
-    def kicad_sexp (self):
-        sexp = [S('module')]
+    def kicad_sexp (self, fmt=None):
+        """Return the footprint in the syntax of 'fmt' (default: LEGACY)."""
 
-        sexp.append (self.Name)
-        sexp.append ([S("layer"), "F.Cu"])
-        sexp.append ([S("tedit"), "%08X" % int (self.tedit)])
+        if fmt is None:
+            fmt = LEGACY
+
+        sexp = fmt.header (self)
 
         sexp.append ([S("descr"), str(self.Description)])
 
@@ -414,22 +705,60 @@ class PCBmodule (object):
         # Polylines
         for i in self.Graphics:
             if not isinstance (i, Polyline): continue
-            sexp.extend (i.kicad_sexp ())
+            sexp.extend (i.kicad_sexp (fmt))
 
         # Pads/pins
         for i in self.Graphics:
-            if not isinstance (i, Pin): continue
+            if not isinstance (i, (Pin, PinArray)): continue
             sexp.extend (i.kicad_sexp ())
 
         # 3D
         if self.ThreeDName is not None:
             sexp.append ([S("model"), self.ThreeDName,
-                [S("at"), [S("xyz")] + self.ThreeDOffset],
+                [S(fmt.ModelOffset), [S("xyz")] + self.ThreeDOffset],
                 [S("scale"), [S("xyz")] + self.ThreeDScale],
                 [S("rotate"), [S("xyz")] + self.ThreeDRot]])
 
+        fmt.stamp (self, sexp)
         return sexp
 
+    def pins (self):
+        """All pins, in order, expanding pin arrays."""
+        for i in self.Graphics:
+            if isinstance (i, Pin):
+                yield i
+            elif isinstance (i, PinArray):
+                for j in i.pins ():
+                    yield j
+
+    def pin_count (self):
+        return sum (i.Count if isinstance (i, PinArray) else 1
+                for i in self.Graphics if isinstance (i, (Pin, PinArray)))
+
+    def pad_rounding (self):
+        """Return (can_round_pads, can_round_center) from the exceptions
+        lists. These are matched against the name before stripping L/M/N,
+        once per module rather than once per pin.
+        """
+        if self.Rounding is None:
+            can_round_pads = True
+            for regex in self.opts.rpexceptions:
+                if regex.match (self.SourceName):
+                    can_round_pads = False
+            can_round_center = True
+            for regex in self.opts.rcexceptions:
+                if regex.match (self.SourceName):
+                    can_round_center = False
+            self.Rounding = (can_round_pads, can_round_center)
+        return self.Rounding
+
+    def reset_3d (self):
+        """Remove the 3D model, as before applying a 3D map."""
+        self.ThreeDName = None
+        self.ThreeDScale = [1.0, 1.0, 1.0]
+        self.ThreeDOffset = [0.0, 0.0, 0.0]
+        self.ThreeDRot = [0.0, 0.0, 0.0]
+
     def strip_lmn (self):
         """Strip least/most/nominal specifier from all modules"""
         if self.Name[-1] in "LMNlmn":
@@ -446,7 +775,7 @@ class PCBmodule (object):
         bb = [min(lefts), max(rights), max(tops), min(bottoms)]
         return bb
 
-    def add_courtyard (self, spacing):
+    def add_courtyard (self, spacing, grid=None):
         left, right, top, bottom = self.bounding_box ()
 
         left  -= spacing
@@ -454,20 +783,262 @@ class PCBmodule (object):
         top    += spacing
         bottom -= spacing
 
-        cy = Polyline ()
-        cy.Points = [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]
-        cy.Style= [0,0,0,0]
-        cy.Linewidth = 0.05
-        cy.Layer = "F.CrtYd"
-        cy.Units = "MM"
+        if grid:
+            left   = snap_to_grid (left, grid, -1)
+            right  = snap_to_grid (right, grid, 1)
+            top    = snap_to_grid (top, grid, 1)
+            bottom = snap_to_grid (bottom, grid, -1)
+
+        self.Graphics.append (courtyard_polyline (
+            [(left, top), (right, top), (right, bottom), (left, bottom)]))
+
+def courtyard_polyline (points):
+    """A closed courtyard outline through points, in mm."""
+    cy = Polyline ()
+    cy.Points = list (points) + [points[0]]
+    cy.Style = [0] * len (points)
+    cy.Linewidth = 0.05
+    cy.Layer = "F.CrtYd"
+    cy.Units = "MM"
+    return cy
+
+def snap_to_grid (value, grid, direction):
+    """Round a value in mm to a multiple of grid, up if direction is
+    positive and down otherwise. Values already on the grid (to 1 nm) stay.
+    """
+    steps = value / grid
+    if abs (steps - round (steps)) * grid < 1e-6:
+        steps = round (steps)
+    elif direction > 0:
+        steps = math.ceil (steps)
+    else:
+        steps = math.floor (steps)
+    return round (steps * grid, 6)
+
+# Multipliers from FreePCB units to mm
+UNIT_SCALE = {"NM": 1e-6, "MM": 1., "MIL": 0.0254}
+
+# Hull vertices are rounded outward to this (mm) if there is no grid
+HULL_RESOLUTION = 0.001
+
+def courtyard_sources (modules):
+    """Collect what hull courtyards must enclose, for all modules at once:
+    pads as (module index, x, y, size x, size y, scale to mm) and outline
+    points as (module index, x, y, scale to mm).
+
+    FreePCB arcs are quarter ellipses inside the box spanned by their ends,
+    but they are written as circular quarters (see arc_extremes), which only
+    stay inside that box when the ends are on a diagonal. An arc is
+    represented by the corners of the box and the extremes of the circular
+    arc. Pin arrays only contribute the pins at each end of their rows, as no
+    other pin can be on the hull.
+    """
 
-        self.Graphics.append (cy)
+    pads = []
+    points = []
+    for m, module in enumerate (modules):
+        for i in module.Graphics:
+            if isinstance (i, Polyline):
+                if i.Layer == "F.CrtYd":
+                    continue
+                scale = UNIT_SCALE[i.Units]
+                last = i.Points[0]
+                points.append ((m, last[0], last[1], scale))
+                for j, point in enumerate (i.Points[1:]):
+                    style = i.Style[min (j, len (i.Style) - 1)] if i.Style else 0
+                    if style:
+                        points.append ((m, last[0], point[1], scale))
+                        points.append ((m, point[0], last[1], scale))
+                        for x, y in arc_extremes (last, point, style):
+                            points.append ((m, x, y, scale))
+                    points.append ((m, point[0], point[1], scale))
+                    last = point
+            elif isinstance (i, (Pin, PinArray)):
+                pin = i if isinstance (i, Pin) else i.Template
+                sx, sy = pin.extent ()
+                scale = UNIT_SCALE[pin.Units]
+                positions = [pin.Coords] if isinstance (i, Pin) else i.row_ends ()
+                for x, y in positions:
+                    pads.append ((m, x, y, sx, sy, scale))
+    return pads, points
+
+def convex_hull (points):
+    """Convex hull of (x, y) points sorted by x then y, counterclockwise,
+    by Andrew's monotone chain.
+    """
+
+    if len (points) < 3:
+        return list (points)
+
+    def half (points):
+        chain = []
+        for p in points:
+            while len (chain) >= 2 and \
+                    (chain[-1][0] - chain[-2][0]) * (p[1] - chain[-2][1]) - \
+                    (chain[-1][1] - chain[-2][1]) * (p[0] - chain[-2][0]) <= 0:
+                chain.pop ()
+            chain.append (p)
+        return chain
+
+    lower = half (points)
+    upper = half (reversed (points))
+    return lower[:-1] + upper[:-1]
+
+def hull_courtyards (modules, spacing, grid=None):
+    """Add a courtyard to each module following the convex hull of its pad
+    corners and outlines, at least 'spacing' mm away from all of them. The
+    whole library is done in one pass: pad corners, culling and the
+    clearance expansion are vectorized with NumPy, leaving only the hulls of
+    the few remaining points to Python.
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        raise Exception ("--courtyard-mode hull needs NumPy")
+
+    pads, points = courtyard_sources (modules)
+
+    # Pad corners, in mm
+    chunks = []
+    if pads:
+        p = numpy.array (pads, dtype=float)
+        signs = numpy.array ([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=float)
+        corners = p[:, None, 1:3] + p[:, None, 3:5] / 2 * signs[None, :, :]
+        corners *= p[:, None, 5:6]
+        chunks.append (numpy.column_stack ((numpy.repeat (p[:, 0], 4),
+            corners.reshape (-1, 2))))
+    if points:
+        p = numpy.array (points, dtype=float)
+        chunks.append (numpy.column_stack ((p[:, 0], p[:, 1:3] * p[:, 3:4])))
+    if not chunks:
+        return
+    pts = numpy.unique (numpy.concatenate (chunks), axis=0)
+
+    # Cull points strictly inside the quadrilateral of each module's extreme
+    # points (leftmost, lowest, rightmost, highest); they can't be on the hull
+    # (numpy.unique sorts by module, then x, then y)
+    mod = pts[:, 0].astype (int)
+    new = numpy.r_[True, mod[1:] != mod[:-1]]
+    starts = numpy.flatnonzero (new)
+    ends = numpy.r_[starts[1:], len (pts)] - 1
+    segment = numpy.cumsum (new) - 1
+    by_y = numpy.lexsort ((pts[:, 2], mod))
+    left = pts[starts, 1:3]
+    right = pts[ends, 1:3]
+    bottom = pts[by_y[starts], 1:3]
+    top = pts[by_y[ends], 1:3]
+    inside = numpy.ones (len (pts), dtype=bool)
+    for a, b in ((left, bottom), (bottom, right), (right, top), (top, left)):
+        a, b = a[segment], b[segment]
+        cross = (b[:, 0] - a[:, 0]) * (pts[:, 2] - a[:, 1]) - \
+                (b[:, 1] - a[:, 1]) * (pts[:, 1] - a[:, 0])
+        inside &= cross > 0
+    pts = pts[~inside]
+
+    # Hulls of what is left, per module
+    mod = pts[:, 0].astype (int)
+    bounds = numpy.flatnonzero (numpy.r_[True, mod[1:] != mod[:-1], True])
+    hull_seg = []
+    hull_xy = []
+    for k in range (len (bounds) - 1):
+        hull = convex_hull (pts[bounds[k]:bounds[k + 1], 1:3].tolist ())
+        hull_seg.extend ([k] * len (hull))
+        hull_xy.extend (hull)
+    seg_module = mod[bounds[:-1]]
+    nseg = len (seg_module)
+    hseg = numpy.array (hull_seg)
+    hull = numpy.array (hull_xy, dtype=float)
+
+    # Clearance: a regular octagon, large enough to contain the circle of
+    # radius 'spacing', plus the furthest rounding can move a vertex (and so
+    # an edge)
+    resolution = grid or HULL_RESOLUTION
+    radius = spacing / math.cos (math.pi / 8) + resolution * math.sqrt (2)
+    angles = numpy.arange (8) * (math.pi / 4) + math.pi / 8
+    octagon = radius * numpy.column_stack ((numpy.cos (angles), numpy.sin (angles)))
+    oct_edges = numpy.roll (octagon, -1, axis=0) - octagon
+    oct_low = octagon[numpy.lexsort ((octagon[:, 0], octagon[:, 1]))[0]]
+
+    # Minkowski sum of each hull with the octagon: both polygons' edges,
+    # merged by angle, walked from the sum of their lowest vertices
+    starts = numpy.flatnonzero (numpy.r_[True, hseg[1:] != hseg[:-1]])
+    ends = numpy.r_[starts[1:], len (hull)] - 1
+    following = numpy.arange (1, len (hull) + 1)
+    following[ends] = starts
+    hull_edges = hull[following] - hull
+    low = hull[numpy.lexsort ((hull[:, 0], hull[:, 1], hseg))[starts]]
+
+    edges = numpy.concatenate ((hull_edges, numpy.tile (oct_edges, (nseg, 1))))
+    eseg = numpy.concatenate ((hseg, numpy.repeat (numpy.arange (nseg), 8)))
+    angle = numpy.mod (numpy.arctan2 (edges[:, 1], edges[:, 0]), 2 * math.pi)
+    order = numpy.lexsort ((angle, eseg))
+    edges = edges[order]
+    eseg = eseg[order]
+
+    # Drop zero-length edges, and merge parallel neighbours
+    length = numpy.hypot (edges[:, 0], edges[:, 1])
+    keep = length > 1e-9
+    edges = edges[keep]
+    eseg = eseg[keep]
+    length = length[keep]
+    new = numpy.r_[True, eseg[1:] != eseg[:-1]]
+    previous = numpy.r_[-1, numpy.arange (len (edges) - 1)]
+    cross = edges[previous, 0] * edges[:, 1] - edges[previous, 1] * edges[:, 0]
+    dot = (edges[previous] * edges).sum (axis=1)
+    parallel = ~new & (numpy.abs (cross) <= 1e-9 * length[previous] * length) & (dot > 0)
+    edges = numpy.add.reduceat (edges, numpy.flatnonzero (~parallel))
+    eseg = eseg[~parallel]
+
+    # Vertices: the start point, then the running sum of edges, without the
+    # last (which closes the polygon)
+    new = numpy.r_[True, eseg[1:] != eseg[:-1]]
+    first = numpy.flatnonzero (new)
+    walked = numpy.cumsum (edges, axis=0) - edges
+    walked -= walked[first][numpy.cumsum (new) - 1]
+    vertices = (low + oct_low)[eseg] + walked
+
+    # Round away from each outline's centre
+    counts = numpy.diff (numpy.r_[first, len (vertices)])
+    centre = numpy.add.reduceat (vertices, first) / counts[:, None]
+    steps = vertices / resolution
+    nearest = numpy.round (steps)
+    away = numpy.where (vertices > centre[eseg], numpy.ceil (steps),
+            numpy.floor (steps))
+    steps = numpy.where (numpy.abs (steps - nearest) * resolution < 1e-6,
+            nearest, away)
+
+    for k, (i, j) in enumerate (zip (first, numpy.r_[first[1:], len (steps)])):
+        outline = []
+        for x, y in steps[i:j].tolist ():
+            p = (round (x * resolution, 6), round (y * resolution, 6))
+            if not outline or p != outline[-1]:
+                outline.append (p)
+        if len (outline) > 1 and outline[0] == outline[-1]:
+            outline.pop ()
+        modules[int (seg_module[eseg[i]])].Graphics.append (
+                courtyard_polyline (outline))
+
+def add_courtyards (modules, args, each=None):
+    """Add courtyards to modules as set by --add-courtyard, --courtyard-mode
+    and --courtyard-grid. 'each' can wrap the per-module loop (see
+    Profiler.each).
+    """
+
+    mode = getattr (args, "courtyard_mode", "bbox")
+    grid = getattr (args, "courtyard_grid", None)
+    if mode == "hull":
+        hull_courtyards (modules, args.courtyard, grid)
+    else:
+        for i in (modules if each is None else each (modules)):
+            i.add_courtyard (args.courtyard, grid)
 
 class Polyline (object):
+    __slots__ = ("Points", "Style", "Linewidth", "Closed", "Layer", "Units")
+
     def __init__ (self):
         """Read a polyline object."""
 
-        self.opts = None
         self.Points = []
         self.Style = []
         self.Linewidth = None
@@ -476,9 +1047,8 @@ class Polyline (object):
         self.Units = "NM"
 
     @classmethod
-    def create_from_freepcb (cls, file_in, opts, units):
+    def create_from_freepcb (cls, file_in, units):
         self = cls ()
-        self.opts = opts
         self.Units = units
 
         # First point and line width
@@ -494,7 +1064,7 @@ class Polyline (object):
                 % (file_in.Lineno - 1))
 
         self.Linewidth = value[0]
-        self.Points.append (value[1:]) 
+        self.Points.append (tuple (value[1:]))
 
         # Subsequent points
         key, value = file_in.get_string ()
@@ -509,7 +1079,7 @@ class Polyline (object):
             if len (value) != 3:
                 raise Exception ("Line %d must contain a list of three values."
                     % (file_in.Lineno - 1))
-            self.Points.append (value[:2])
+            self.Points.append (tuple (value[:2]))
             # Third number is "side style"
             self.Style.append (value[2])
 
@@ -528,19 +1098,24 @@ class Polyline (object):
             s += "  Point: %d, %d\n" % tuple (i)
         return s
 
-    def kicad_sexp (self):
+    def kicad_sexp (self, fmt=None):
+        """Return the outline as a list of lines and arcs, in the syntax of
+        'fmt' (default: LEGACY)."""
+
+        if fmt is None:
+            fmt = LEGACY
 
         sexp = []
         last_corner = self.Points[0]
+        width = to_mm (self.Linewidth, self.Units)
 
         j = 0
         for i in self.Points[1:]:
             if self.Style[j] == 0:
-                sexp.append ([S("fp_line"),
-                    [S("start"), to_mm (last_corner[0], self.Units), to_mm (-last_corner[1], self.Units)],
-                    [S("end"), to_mm (i[0], self.Units), to_mm (-i[1], self.Units)],
-                    [S("layer"), self.Layer],
-                    [S("width"), to_mm(self.Linewidth, self.Units)]])
+                sexp.append (fmt.line (
+                    (to_mm (last_corner[0], self.Units), to_mm (-last_corner[1], self.Units)),
+                    (to_mm (i[0], self.Units), to_mm (-i[1], self.Units)),
+                    self.Layer, width))
             else:
                 if self.Style[j] == 1:
                     angle = -90
@@ -553,12 +1128,11 @@ class Polyline (object):
                 p2.y = -p2.y
                 center = kicad_arc_center (p1, p2, angle)
 
-                sexp.append ([S("fp_arc"),
-                    [S("start"), to_mm (center.x, self.Units), to_mm (center.y, self.Units)],
-                    [S("end"), to_mm (p1.x, self.Units), to_mm (p1.y, self.Units)],
-                    [S("angle"), -angle],
-                    [S("layer"), self.Layer],
-                    [S("width"), to_mm(self.Linewidth,self.Units)]])
+                sexp.append (fmt.arc (
+                    (to_mm (center.x, self.Units), to_mm (center.y, self.Units)),
+                    (to_mm (p1.x, self.Units), to_mm (p1.y, self.Units)),
+                    (to_mm (p2.x, self.Units), to_mm (p2.y, self.Units)),
+                    -angle, self.Layer, width))
 
             last_corner = i
             if j  < len(self.Style)-1:
@@ -580,13 +1154,33 @@ class Polyline (object):
 
         return (left, right, top, bottom) 
 
+# Pad expressions shared between pins; see SexpFragment
+SMD_LAYERS = SexpFragment ([S("layers"), "F.Cu", "F.Paste", "F.Mask"])
+PTH_LAYERS = SexpFragment ([S("layers"), "*.Cu", "*.Mask"])
+NPTH_LAYERS = SexpFragment ([S("layers"), "*.Mask"])
+
+# (units, x, y): shared (size x y) expression
+PAD_SIZES = {}
+
+def pad_size_sexp (sx, sy, units):
+    """Return the shared (size) expression for a pad size in some units."""
+    key = (units, sx, sy)
+    sexp = PAD_SIZES.get (key)
+    if sexp is None:
+        sexp = PAD_SIZES[key] = SexpFragment ([S("size"), to_mm (sx, units),
+            to_mm (sy, units)])
+    return sexp
+
 class Pin (object):
-    def __init__ (self, modname):
-        """Read a pin object."""
+    __slots__ = ("Module", "Name", "DrillDiam", "Coords", "Angle", "TopPad",
+            "InnerPad", "BottomPad")
 
+    def __init__ (self, module):
+        """Read a pin object. Options, units and the module name are shared
+        with the other pins through 'module'.
+        """
 
-        self.opts = None
-        self.ModName = modname
+        self.Module = module
         self.Name = None
         self.DrillDiam = None
         self.Coords = []
@@ -596,14 +1190,21 @@ class Pin (object):
         self.InnerPad = None
         self.BottomPad = None
 
-        self.Units = "NM"
+    @property
+    def opts (self):
+        return self.Module.opts
 
-    @classmethod
-    def create_from_freepcb (cls, modname, file_in, opts, units):
-        self = cls (modname)
+    @property
+    def ModName (self):
+        return self.Module.SourceName
 
-        self.opts = opts
-        self.Units = units
+    @property
+    def Units (self):
+        return self.Module.Units
+
+    @classmethod
+    def create_from_freepcb (cls, module, file_in):
+        self = cls (module)
 
         assert file_in.key == "pin"
 
@@ -619,7 +1220,7 @@ class Pin (object):
                     % (file_in.Lineno - 1))
 
         self.DrillDiam = value[0]
-        self.Coords = value[1:3]
+        self.Coords = tuple (value[1:3])
         self.Angle = value[3]
 
         file_in.get_string ()
@@ -627,11 +1228,11 @@ class Pin (object):
         while file_in.key in ["top_pad", "inner_pad", "bottom_pad", "top_mask", "top_paste", "bottom_mask", "bottom_paste" ]:
             
             if file_in.key == "top_pad":
-                self.TopPad = Pad (file_in.value, file_in)
+                self.TopPad = Pad.get (file_in.value, file_in)
             elif file_in.key == "inner_pad":
-                self.InnerPad = Pad (file_in.value, file_in)
+                self.InnerPad = Pad.get (file_in.value, file_in)
             elif file_in.key == "bottom_pad":
-                self.BottomPad = Pad (file_in.value, file_in)
+                self.BottomPad = Pad.get (file_in.value, file_in)
             elif file_in.key in ["top_mask", "top_paste", "bottom_mask", "bottom_paste"]:
                 # todo
                 pass
@@ -678,14 +1279,7 @@ class Pin (object):
                 sx, sy = sy, sx
 
             # Rounded pads
-            can_round_pads = True
-            for regex in self.opts.rpexceptions:
-                if regex.match (self.ModName):
-                    can_round_pads = False
-            can_round_center = True
-            for regex in self.opts.rcexceptions:
-                if regex.match (self.ModName):
-                    can_round_center = False
+            can_round_pads, can_round_center = self.Module.pad_rounding ()
 
             if self.opts.roundedpads is None:
                 if ref_pad.Shape == PAD_ROUND or ref_pad.Shape == PAD_OCTAGON:
@@ -714,8 +1308,8 @@ class Pin (object):
             # TODO: if bottom pad
             sexp = [ [S("pad"), self.Name, S("smd"), S(shape),
                         [S("at"), to_mm (self.Coords[0], self.Units), -to_mm (self.Coords[1], self.Units)],
-                        [S("size"), to_mm (sy, self.Units), to_mm (sx, self.Units)],
-                        [S("layers"), "F.Cu", "F.Paste", "F.Mask"] ] ]
+                        pad_size_sexp (sy, sx, self.Units),
+                        SMD_LAYERS ] ]
 
         else:
             # PTH
@@ -747,16 +1341,16 @@ class Pin (object):
                 sy = sx
                 sexp = [[S("pad"), self.Name, S(_type), S(shape),
                     [S("at"), to_mm (self.Coords[0], self.Units), -to_mm (self.Coords[1], self.Units)],
-                    [S("size"), to_mm (sx, self.Units), to_mm (sy, self.Units)],
+                    pad_size_sexp (sx, sy, self.Units),
                     [S("drill"), to_mm (self.DrillDiam, self.Units)],
-                    [S("layers"), "*.Mask"]]]
+                    NPTH_LAYERS]]
             else:
                 _type = "thru_hole"
                 sexp = [[S("pad"), self.Name, S(_type), S(shape),
                     [S("at"), to_mm (self.Coords[0], self.Units), -to_mm (self.Coords[1], self.Units)],
-                    [S("size"), to_mm (sx, self.Units), to_mm (sy, self.Units)],
+                    pad_size_sexp (sx, sy, self.Units),
                     [S("drill"), to_mm (self.DrillDiam, self.Units)],
-                    [S("layers"), "*.Cu", "*.Mask"]]]
+                    PTH_LAYERS]]
 
 
 
@@ -765,8 +1359,8 @@ class Pin (object):
 
         return sexp
 
-    def bounding_box (self):
-        """Return a (left, right, top, bottom) bounding box"""
+    def extent (self):
+        """Return the (x, y) size of the pad, as used for bounding boxes"""
 
         if self.TopPad:
             sx, sy = self.TopPad.Width, self.TopPad.Len1 + self.TopPad.Len2
@@ -782,6 +1376,13 @@ class Pin (object):
         if self.DrillDiam == 0:
             sx, sy = sy, sx
 
+        return sx, sy
+
+    def bounding_box (self):
+        """Return a (left, right, top, bottom) bounding box"""
+
+        sx, sy = self.extent ()
+
         left  = self.Coords[0] - (sx / 2)
         right = self.Coords[0] + (sx / 2)
 
@@ -795,7 +1396,357 @@ class Pin (object):
 
         return (left, right, top, bottom)
 
+# Fewest pins worth storing as a PinArray
+PIN_ARRAY_MIN = 4
+
+PIN_ARRAY_NAME = re.compile (r"([A-Za-z]+)([1-9][0-9]*)$")
+
+class PinArray (object):
+    """A row or grid of pins with the same drill, angle and pad stacks, at
+    Origin + c * Step + r * RowStep for row r and column c, in row-major
+    order and with some positions possibly Skipped. Pins are only expanded
+    when needed (see pins); bounding boxes are computed directly.
+
+    Names are either a sequence of numbers (NameStart), a row label and a
+    column number (RowLabels, ColBase), or listed (NameList).
+
+    Arrays are only formed when the expansion reproduces every pin exactly;
+    see find_pin_arrays.
+    """
+
+    __slots__ = ("Template", "Origin", "Step", "RowStep", "Rows", "ColStart",
+            "Cols", "Skipped", "Count", "NameStart", "RowLabels", "ColBase",
+            "NameList")
+
+    def __init__ (self, template, origin, step, rowstep, rows, colstart, cols,
+            skipped, count):
+        self.Template = template
+        self.Origin = origin
+        self.Step = step
+        self.RowStep = rowstep
+        self.Rows = rows
+        self.ColStart = colstart
+        self.Cols = cols
+        self.Skipped = skipped
+        self.Count = count
+        self.NameStart = None
+        self.RowLabels = None
+        self.ColBase = None
+        self.NameList = None
+
+    @property
+    def Module (self):
+        return self.Template.Module
+
+    def position (self, row, col):
+        """Coordinates of a grid position, computed the same way as when the
+        array was detected so that they are exact.
+        """
+        x = self.Origin[0] + col * self.Step[0] + row * self.RowStep[0]
+        y = self.Origin[1] + col * self.Step[1] + row * self.RowStep[1]
+        return (x, y)
+
+    def indices (self):
+        """(row, column) of each pin, in order."""
+        for row in range (self.Rows):
+            for col in range (self.ColStart, self.ColStart + self.Cols):
+                if (row, col) not in self.Skipped:
+                    yield row, col
+
+    def name (self, index, row, col):
+        if self.NameStart is not None:
+            return str (self.NameStart + index)
+        elif self.RowLabels is not None:
+            return self.RowLabels[row] + str (self.ColBase + col)
+        return self.NameList[index]
+
+    def pins (self):
+        """Expand the array into Pin objects."""
+        t = self.Template
+        for index, (row, col) in enumerate (self.indices ()):
+            pin = Pin (t.Module)
+            pin.Name = self.name (index, row, col)
+            pin.DrillDiam = t.DrillDiam
+            pin.Coords = self.position (row, col)
+            pin.Angle = t.Angle
+            pin.TopPad = t.TopPad
+            pin.InnerPad = t.InnerPad
+            pin.BottomPad = t.BottomPad
+            yield pin
+
+    def kicad_sexp (self):
+        sexp = []
+        for i in self.pins ():
+            sexp.extend (i.kicad_sexp ())
+        return sexp
+
+    def row_ends (self):
+        """Coordinates of the first and last pin of each row. Positions are
+        linear in row and column, so no other pin can be extreme in any
+        direction.
+        """
+
+        ends = []
+        for row in range (self.Rows):
+            cols = [c for c in range (self.ColStart, self.ColStart + self.Cols)
+                    if (row, c) not in self.Skipped] if self.Skipped else \
+                    [self.ColStart, self.ColStart + self.Cols - 1]
+            if cols:
+                ends.append (self.position (row, cols[0]))
+                ends.append (self.position (row, cols[-1]))
+        return ends
+
+    def bounding_box (self):
+        """Return a (left, right, top, bottom) bounding box"""
+
+        ends = self.row_ends ()
+        xs = [i[0] for i in ends]
+        ys = [i[1] for i in ends]
+
+        sx, sy = self.Template.extent ()
+        units = self.Template.Units
+        return (to_mm (min (xs) - (sx / 2), units),
+                to_mm (max (xs) + (sx / 2), units),
+                to_mm (max (ys) + (sy / 2), units),
+                to_mm (min (ys) - (sy / 2), units))
+
+def pin_rows (pins):
+    """Split pins into rows: runs on one line at a fixed step, in order,
+    possibly with gaps of whole steps. Returns (pins, step, columns) for
+    each row; step is None for a lone pin.
+    """
+
+    rows = []
+    i = 0
+    while i < len (pins):
+        first = pins[i]
+        x0, y0 = first.Coords
+        step = None
+        cols = [0]
+        j = i + 1
+        while j < len (pins) and same_pin_stack (first, pins[j]):
+            x, y = pins[j].Coords
+            if step is None:
+                if (x, y) == (x0, y0):
+                    break
+                step = (x - x0, y - y0)
+                col = 1
+            else:
+                # Usually the next column; otherwise after a gap
+                col = cols[-1] + 1
+                if (x0 + col * step[0], y0 + col * step[1]) != (x, y):
+                    col = nearest_step (first.Coords, step, (x, y))
+                    if col <= cols[-1] or \
+                            (x0 + col * step[0], y0 + col * step[1]) != (x, y):
+                        break
+            cols.append (col)
+            j += 1
+        rows.append ((pins[i:j], step, cols))
+        i = j
+    return rows
+
+def same_pin_stack (a, b):
+    return a.DrillDiam == b.DrillDiam and a.Angle == b.Angle and \
+            a.TopPad is b.TopPad and a.InnerPad is b.InnerPad and \
+            a.BottomPad is b.BottomPad
+
+def same_coords (a, b):
+    """Exact comparison of coordinates, telling 0.0 and -0.0 apart, since
+    they are written out differently.
+    """
+    return a[0] == b[0] and a[1] == b[1] and \
+            (a[0] or math.copysign (1., a[0]) == math.copysign (1., b[0])) and \
+            (a[1] or math.copysign (1., a[1]) == math.copysign (1., b[1]))
+
+def nearest_step (origin, step, point):
+    """The whole number of steps from origin closest to point."""
+    dx, dy = point[0] - origin[0], point[1] - origin[1]
+    return int (round ((dx * step[0] + dy * step[1]) /
+        (step[0] * step[0] + step[1] * step[1])))
+
+def name_array (array, names, positions):
+    """Choose the most compact naming for an array's pins."""
+
+    try:
+        start = int (names[0])
+    except ValueError:
+        start = None
+    if start is not None and all (str (start + k) == name
+            for k, name in enumerate (names)):
+        array.NameStart = start
+        return
+
+    labels = {}
+    base = None
+    for name, (row, col) in zip (names, positions):
+        m = PIN_ARRAY_NAME.match (name)
+        if m is None or labels.setdefault (row, m.group (1)) != m.group (1):
+            break
+        if base is None:
+            base = int (m.group (2)) - col
+        elif int (m.group (2)) - col != base:
+            break
+    else:
+        if len (labels) == array.Rows:
+            array.RowLabels = tuple (labels[i] for i in range (array.Rows))
+            array.ColBase = base
+            return
+
+    array.NameList = tuple (names)
+
+class PinGrid (object):
+    """Rows of pins (as from pin_rows) sharing a step, added one at a time
+    while they all lie on one grid exactly. A new row is only checked
+    against the origin and row step found so far, so building a grid is
+    linear in its pins.
+    """
+
+    __slots__ = ("Origin", "Step", "RowStep", "Rows", "Pins", "Positions",
+            "ColMin", "ColMax")
+
+    def __init__ (self, step):
+        self.Origin = None
+        self.Step = step
+        self.RowStep = (0., 0.)
+        self.Rows = 0
+        self.Pins = []
+        self.Positions = []
+        self.ColMin = 0
+        self.ColMax = 0
+
+    def add (self, row):
+        """Add a row, if the grid still reproduces every pin exactly.
+        Returns whether it was added; if not, the grid is unchanged.
+        """
+
+        pins, _, cols = row
+        r = self.Rows
+        step = self.Step
+        origin = self.Origin if r else pins[0].Coords
+        rowstep = self.RowStep
+        offset = 0
+        if r:
+            offset = nearest_step (origin, step, pins[0].Coords)
+        if r == 1:
+            rowstep = (pins[0].Coords[0] - (origin[0] + offset * step[0]),
+                       pins[0].Coords[1] - (origin[1] + offset * step[1]))
+            # Rows must be stacked across the row direction, not along it
+            cross = step[0] * rowstep[1] - step[1] * rowstep[0]
+            if cross * cross < 0.25 * (step[0] ** 2 + step[1] ** 2) * \
+                    (rowstep[0] ** 2 + rowstep[1] ** 2) or rowstep == (0., 0.):
+                return False
+
+        # Columns increase along a row, so positions are distinct and in the
+        # order PinArray.indices gives them
+        colmin = min (self.ColMin, offset + cols[0])
+        colmax = max (self.ColMax, offset + cols[-1])
+        if (r + 1) * (colmax - colmin + 1) > 2 * (len (self.Pins) + len (pins)):
+            return False
+
+        # The expansion must reproduce the row's pins exactly; this is how
+        # PinArray.position computes them
+        x0, y0 = origin
+        sx, sy = step
+        rx, ry = r * rowstep[0], r * rowstep[1]
+        for pin, col in zip (pins, cols):
+            c = offset + col
+            if not same_coords ((x0 + c * sx + rx, y0 + c * sy + ry), pin.Coords):
+                return False
+
+        self.Origin = origin
+        self.RowStep = rowstep
+        self.Rows = r + 1
+        self.Pins.extend (pins)
+        self.Positions.extend ((r, offset + col) for col in cols)
+        self.ColMin = colmin
+        self.ColMax = colmax
+        return True
+
+    def array (self):
+        """Return the grid as a named PinArray."""
+        cols = self.ColMax - self.ColMin + 1
+        present = set (self.Positions)
+        skipped = frozenset ((r, c) for r in range (self.Rows)
+                for c in range (self.ColMin, self.ColMax + 1)
+                if (r, c) not in present)
+        array = PinArray (self.Pins[0], self.Origin, self.Step, self.RowStep,
+                self.Rows, self.ColMin, cols, skipped, len (self.Pins))
+        name_array (array, [i.Name for i in self.Pins], self.Positions)
+        return array
+
+def find_pin_arrays (graphics):
+    """Replace runs of pins forming rows or grids with PinArrays. Arrays
+    expand to exactly the pins they replace, in the same order.
+    """
+
+    out = []
+    run = []
+    for i in graphics + [None]:
+        if isinstance (i, Pin):
+            run.append (i)
+            continue
+        if run:
+            if whole_coords (run):
+                out.extend (group_pin_rows (pin_rows (run)))
+            else:
+                out.extend (run)
+            run = []
+        if i is not None:
+            out.append (i)
+    return out
+
+def whole_coords (pins):
+    """Whether all pin coordinates are whole numbers, as in NM files. Grid
+    positions computed from these are exact; decimal MM and MIL coordinates
+    almost never come out exactly, so they aren't searched for arrays.
+    """
+    for i in pins:
+        x, y = i.Coords
+        if not (x.is_integer () and y.is_integer ()):
+            return False
+    return True
+
+def group_pin_rows (rows):
+    """Greedily merge rows into grids, falling back to single-row arrays and
+    plain pins.
+    """
+
+    out = []
+    i = 0
+    while i < len (rows):
+        pins, step, cols = rows[i]
+        if step is None:
+            out.extend (pins)
+            i += 1
+            continue
+
+        # Extend the grid while rows share the step and pin stack, and
+        # still fit
+        grid = PinGrid (step)
+        j = i
+        while j < len (rows) and (j == i or rows[j][1] == step and
+                same_pin_stack (pins[0], rows[j][0][0])) and grid.add (rows[j]):
+            j += 1
+
+        if grid.Rows and len (grid.Pins) >= PIN_ARRAY_MIN:
+            out.append (grid.array ())
+            i = j
+        else:
+            out.extend (pins)
+            i += 1
+    return out
+
 class Pad (object):
+    """A pad stack: shape, width, lengths and corner radius. Nearly all pads
+    in a footprint, and many across footprints, are the same, so pads are
+    interned (see Pad.get) and shared between pins. Don't modify them.
+    """
+
+    __slots__ = ("Shape", "Width", "Len1", "Len2", "CornRad")
+
+    # Pad line text, and (shape, width, len1, len2, cornrad): Pad
+    Cache = {}
+
     def __init__ (self, value, file_in):
         try:
             value = [float(i) for i in value.split ()]
@@ -816,6 +1767,17 @@ class Pad (object):
 
         self.Shape, self.Width, self.Len1, self.Len2, self.CornRad = value[:5]
 
+    @classmethod
+    def get (cls, value, file_in):
+        """Return the shared pad for a pad line."""
+        pad = cls.Cache.get (value)
+        if pad is None:
+            pad = cls (value, file_in)
+            pad = cls.Cache.setdefault ((pad.Shape, pad.Width, pad.Len1,
+                pad.Len2, pad.CornRad), pad)
+            cls.Cache[value] = pad
+        return pad
+
     def __str__ (self):
         return "Pad: shape %d, (w %d, L1 %d, L2 %d), corner %d" % \
                 (self.Shape, self.Width, self.Len1, self.Len2, self.CornRad)
@@ -823,14 +1785,28 @@ class Pad (object):
 class FreePCBfile (object):
     """This just wraps a FreePCB text file, reading it out in pieces."""
 
-    def __init__ (self, f):
-        self.File = [i.rstrip () for i in f.readlines ()]
+    def __init__ (self, f=None, lines=None):
+        if lines is None:
+            lines = f.readlines ()
+        self.File = [i.rstrip () for i in lines]
         self.File.reverse ()
         self.Lineno = 1
 
         self.key = ""
         self.value = ""
 
+    @classmethod
+    def from_text (cls, text):
+        """Wrap already decoded text, splitting lines as a text file would
+        (universal newlines), without copying it into a file object first.
+        """
+        if "\r" in text:
+            text = text.replace ("\r\n", "\n").replace ("\r", "\n")
+        lines = text.split ("\n")
+        if lines and not lines[-1]:
+            lines.pop ()
+        return cls (lines=lines)
+
     def get_string (self, allow_blank = True):
         # Retrieve a line of the format "key: value"
 
@@ -885,55 +1861,1042 @@ class FreePCBfile (object):
         key, delim, value = self.File[-1].partition (":")
         return key.strip ()
 
-def process_3dmap (mapfile, library):
-    """Read all 3D mappings from mapfile, applying them to library."""
+def read_3dmap (mapfile):
+    """Read all 3D mappings from mapfile. Returns a dict mapping each module
+    name to its list of (key, value, line number) entries, in file order,
+    starting with the "mod" line.
+    """
 
-    f = open (mapfile)
-    ff = FreePCBfile (f) # Exploit the format to reuse a parser
-    current_module = None
+    blocks = {}
+    with open (mapfile) as f:
+        ff = FreePCBfile (f) # Exploit the format to reuse a parser
+    current = None
     while not ff.at_end ():
         key, value = ff.get_string ()
+        lineno = ff.Lineno - 1
         if key == "mod":
-            for i in library.Modules:
-                if i.Name == value:
-                    current_module = i
-                    break
-            else:
-                raise Exception (("3D map (line %d): couldn't find " +
-                    "module \"%s\"") % (ff.Lineno - 1, value))
-        elif key == "3dmod":
-            if current_module is None:
+            current = blocks.setdefault (value, [])
+            current.append ((key, value, lineno))
+        elif key == "3dmod" or key[:3] in ("rot", "sca", "off"):
+            if current is None:
                 raise Exception (("3D map (line %d): cannot specify " +
-                    "parameters before module name") % (ff.Lineno - 1))
-            current_module.ThreeDName = value
-        elif key.startswith ("rot"):
-            if current_module is None:
-                raise Exception (("3D map (line %d): cannot specify " +
-                    "parameters before module name") % (ff.Lineno - 1))
-            index = ord (key[3]) - ord('x')
-            current_module.ThreeDRot[index] = float (value)
+                    "parameters before module name") % lineno)
+            current.append ((key, value, lineno))
+        else:
+            raise Exception ("3D map (line %d): unknown key \"%s\"" %
+                    (lineno, key))
+    return blocks
+
+def apply_3dmap_entries (module, entries):
+    """Apply one module's 3D map entries (see read_3dmap) to it."""
+    for key, value, lineno in entries:
+        if key == "mod":
+            continue
+        elif key == "3dmod":
+            module.ThreeDName = value
+            continue
+
+        index = ord (key[3]) - ord('x')
+        if key.startswith ("rot"):
+            module.ThreeDRot[index] = float (value)
         elif key.startswith ("sca"):
-            if current_module is None:
-                raise Exception (("3D map (line %d): cannot specify " +
-                    "parameters before module name") % (ff.Lineno - 1))
-            index = ord (key[3]) - ord('x')
-            current_module.ThreeDScale[index] = float (value)
+            module.ThreeDScale[index] = float (value)
         elif key.startswith ("off"):
-            if current_module is None:
-                raise Exception (("3D map (line %d): cannot specify " +
-                    "parameters before module name") % (ff.Lineno - 1))
-            index = ord (key[3]) - ord('x')
-            current_module.ThreeDOffset[index] = float (value)
+            module.ThreeDOffset[index] = float (value)
+
+def process_3dmap (mapfile, library):
+    """Read all 3D mappings from mapfile, applying them to library. Returns
+    the mappings as read by read_3dmap.
+    """
+
+    blocks = read_3dmap (mapfile)
+    modules = {}
+    for i in library.Modules:
+        modules.setdefault (i.Name, i)
+    for name, entries in blocks.items ():
+        if name not in modules:
+            raise Exception (("3D map (line %d): couldn't find " +
+                "module \"%s\"") % (entries[0][2], name))
+        apply_3dmap_entries (modules[name], entries)
+    return blocks
+
+def read_exceptions (path):
+    """Read an exceptions list (see header), returning compiled regexes."""
+    exceptions = []
+    if path is not None:
+        with open (path) as f:
+            for line in f:
+                line = line.strip ()
+                if not line:
+                    continue
+                exceptions.append (re.compile (line))
+    return exceptions
+
+def load_file (filename, opts, profiler=None):
+    """Load one FreePCB library file."""
+    if profiler is None:
+        profiler = Profiler (enabled=False)
+    with profiler.span ("member", filename) as span:
+        with open (filename, 'rb') as f:
+            data = f.read ()
+        ff = FreePCBfile.from_text (data.decode ('utf8'))
+        library = Library (ff, opts)
+        library.set_origin (filename, zlib.crc32 (data) & 0xffffffff)
+        span["bytes"] = len (data)
+        span["modules"] = len (library.Modules)
+    return library
+
+def cpu_count ():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count ()
+    except (ImportError, NotImplementedError):
+        return 1
+
+class MemberReader (object):
+    """Decompress and decode the members of a zipfile on threads of its own,
+    a few members ahead of the reader, so that reading overlaps with parsing
+    (zlib lets go of the GIL while it inflates). Iterating yields (info,
+    text) in the order given. With no threads, members are read as they are
+    asked for.
+    """
+
+    # Members decoded before the threads wait for the reader
+    DEPTH = 8
+
+    def __init__ (self, zipfile, infos, threads=2):
+        self.zipfile = zipfile
+        self.infos = list (infos)
+        self.results = [None] * len (self.infos)
+        self.ready = [threading.Event () for i in self.infos]
+        self.slots = threading.Semaphore (self.DEPTH)
+        self.lock = threading.Lock ()
+        self.next = 0
+        self.threads = []
+        for i in range (threads):
+            thread = threading.Thread (target=self._run)
+            thread.daemon = True
+            thread.start ()
+            self.threads.append (thread)
+
+    def read (self, info):
+        return self.zipfile.read (info).decode ('utf8')
+
+    def _run (self):
+        while True:
+            self.slots.acquire ()
+            with self.lock:
+                index = self.next
+                self.next += 1
+            if index >= len (self.infos):
+                self.slots.release ()
+                return
+            try:
+                self.results[index] = (self.read (self.infos[index]), None)
+            except Exception as e:
+                self.results[index] = (None, e)
+            self.ready[index].set ()
+
+    def close (self):
+        """Stop the threads, if the reader gives up early."""
+        with self.lock:
+            self.next = len (self.infos)
+        for i in self.threads:
+            self.slots.release ()
+
+    def __iter__ (self):
+        try:
+            for index, info in enumerate (self.infos):
+                if not self.threads:
+                    yield info, self.read (info)
+                    continue
+                self.ready[index].wait ()
+                text, error = self.results[index]
+                self.results[index] = None
+                self.slots.release ()
+                if error is not None:
+                    raise error
+                yield info, text
+        finally:
+            self.close ()
+
+def load_zip (zipfile, opts, members=None, profiler=None):
+    """Load and merge every FreePCB library in a zipfile object, or only
+    those named in 'members'. Members are read ahead by a MemberReader.
+    """
+    if profiler is None:
+        profiler = Profiler (enabled=False)
+    library = Library ()
+    infos = [i for i in zipfile.infolist ()
+            if members is None or i.filename in members]
+    # On one CPU the threads would only take turns with the parser
+    threads = 2 if len (infos) > 1 and cpu_count () > 1 else 0
+    for info, text in MemberReader (zipfile, infos, threads):
+        with profiler.span ("member", info.filename, bytes=info.file_size) as span:
+            ff = FreePCBfile.from_text (text)
+            sublibrary = Library (ff, opts)
+            sublibrary.set_origin (info.filename, info.CRC)
+            library += sublibrary
+            span["modules"] = len (sublibrary.Modules)
+    return library
+
+class LegacyFormat (object):
+    """Footprint syntax: the (module ...) files read by every KiCad since
+    4.0. Formats turn the parts of a footprint whose syntax changed between
+    KiCad versions into s-expressions; the rest (text, pads) is the same in
+    all of them.
+    """
+
+    Name = "legacy"
+
+    # Keyword of the 3D model offset
+    ModelOffset = "at"
+
+    def header (self, module):
+        """Return the start of a footprint expression, up to its layer."""
+        return [S("module"), module.Name,
+                [S("layer"), "F.Cu"],
+                [S("tedit"), "%08X" % int (module.tedit)]]
+
+    def drawing (self, layer, width):
+        """Return the layer and line width of a line or arc."""
+        return [[S("layer"), layer], [S("width"), width]]
+
+    def line (self, start, end, layer, width):
+        """Return a line from 'start' to 'end', given in mm."""
+        return [S("fp_line"),
+                [S("start"), start[0], start[1]],
+                [S("end"), end[0], end[1]]] + self.drawing (layer, width)
+
+    def arc (self, center, start, end, angle, layer, width):
+        """Return an arc around 'center' from 'start' to 'end', given in mm,
+        turning through 'angle' degrees.
+        """
+        return [S("fp_arc"),
+                [S("start"), center[0], center[1]],
+                [S("end"), start[0], start[1]],
+                [S("angle"), angle]] + self.drawing (layer, width)
+
+    def stamp (self, module, sexp):
+        """Add timestamps to the items of a footprint expression. Legacy
+        footprints don't have them.
+        """
+        pass
+
+class KiCad6Format (LegacyFormat):
+    """KiCad 6 syntax: (footprint ...) with a file version, arcs given by
+    three points, and a timestamp (a UUID) on every item.
+    """
+
+    Name = "kicad6"
+    Version = 20211014
+    ModelOffset = "offset"
+
+    # Items that get a timestamp
+    STAMPED = ("fp_text", "fp_line", "fp_arc", "pad")
+
+    # UUIDs are derived from the footprint name and the item's position, so
+    # they don't change between conversions
+    UUID_NAMESPACE = uuid.uuid5 (uuid.NAMESPACE_URL, "freepcb2pretty")
+
+    def header (self, module):
+        return [S("footprint"), module.Name,
+                [S("version"), self.Version],
+                [S("generator"), S("freepcb2pretty")],
+                [S("layer"), "F.Cu"],
+                [S("tedit"), S("%08X" % int (module.tedit))]]
+
+    def arc (self, center, start, end, angle, layer, width):
+        # The arcs converted are under 180 degrees, so the midpoint is on the
+        # far side of the chord from the center
+        mx = (start[0] + end[0]) / 2. - center[0]
+        my = (start[1] + end[1]) / 2. - center[1]
+        scale = math.hypot (start[0] - center[0], start[1] - center[1]) / \
+                math.hypot (mx, my)
+        mid = (center[0] + mx * scale, center[1] + my * scale)
+
+        return [S("fp_arc"),
+                [S("start"), start[0], start[1]],
+                [S("mid"), mid[0], mid[1]],
+                [S("end"), end[0], end[1]]] + self.drawing (layer, width)
+
+    def stamp (self, module, sexp):
+        for n, i in enumerate (sexp):
+            if sexp_head (i) in self.STAMPED:
+                i.append ([S("tstamp"), S(str (uuid.uuid5 (
+                    self.UUID_NAMESPACE, "%s/%d" % (module.Name, n))))])
+
+class KiCad7Format (KiCad6Format):
+    """KiCad 7 syntax: as KiCad 6, with line widths given as strokes and no
+    edit time.
+    """
+
+    Name = "kicad7"
+    Version = 20221018
+
+    def header (self, module):
+        return [S("footprint"), module.Name,
+                [S("version"), self.Version],
+                [S("generator"), S("freepcb2pretty")],
+                [S("layer"), "F.Cu"]]
+
+    def drawing (self, layer, width):
+        return [[S("stroke"), [S("width"), width], [S("type"), S("solid")]],
+                [S("layer"), layer]]
+
+LEGACY = LegacyFormat ()
+
+# name: format, for --format
+FORMATS = dict ((i.Name, i) for i in (LEGACY, KiCad6Format (), KiCad7Format ()))
+
+def output_targets (args):
+    """Return [(format, output directory)] from the --format options. The
+    first is the primary target, which the manifest describes.
+    """
+
+    specs = args.formats or ["legacy"]
+    targets = []
+    for spec in specs:
+        name, _, path = spec.partition ("=")
+        if name not in FORMATS:
+            raise Exception ("unknown format \"%s\" (choose from %s)" %
+                    (name, ", ".join (sorted (FORMATS))))
+        if not path:
+            path = args.outdir if len (specs) == 1 else \
+                    os.path.join (args.outdir, name)
+        targets.append ((FORMATS[name], path))
+    return targets
+
+class TreeWriter (object):
+    """Write files into one output directory from a few threads of its own,
+    so that writing overlaps with generating. With 'sync', each thread
+    fsyncs its files once they are all written, rather than one at a time,
+    and then the directory is synced.
+    """
+
+    # Files queued before write() waits
+    DEPTH = 64
+
+    def __init__ (self, path, threads=1, sync=False):
+        self.path = path
+        self.sync = sync
+        self.queue = queue.Queue (self.DEPTH)
+        self.error = None
+        self.threads = []
+        for i in range (max (threads, 1)):
+            thread = threading.Thread (target=self._run)
+            thread.daemon = True
+            thread.start ()
+            self.threads.append (thread)
+
+    def _run (self):
+        written = []
+        while True:
+            item = self.queue.get ()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            filename, text = item
+            try:
+                path = self.store (filename, text)
+            except Exception as e:
+                self.error = e
+                continue
+            if path is not None:
+                written.append (path)
+
+        if self.sync and self.error is None:
+            try:
+                for path in written:
+                    fsync_path (path)
+            except Exception as e:
+                self.error = e
+
+    def store (self, filename, text):
+        """Write one file, from a writer thread. Returns the path to sync."""
+        path = os.path.join (self.path, filename)
+        with open (path, 'w') as f:
+            f.write (text)
+        return path
+
+    def write (self, filename, text):
+        if self.error is not None:
+            raise self.error
+        self.queue.put ((filename, text))
+
+    def close (self):
+        """Wait for the queued files, raising the first error."""
+        for i in self.threads:
+            self.queue.put (None)
+        for i in self.threads:
+            i.join ()
+        if self.error is not None:
+            raise self.error
+        self.finish ()
+
+    def finish (self):
+        if self.sync:
+            fsync_path (self.path)
+
+# Archive outputs, by suffix; see ArchiveWriter
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.xz", ".tar.zst")
+
+# Archive member time when SOURCE_DATE_EPOCH isn't set: the start of 1980,
+# the earliest a zip can hold
+ARCHIVE_EPOCH = 315532800
+
+def archive_suffix (path):
+    """Return the archive suffix of an output path, or None for a
+    directory."""
+    for i in ARCHIVE_SUFFIXES:
+        if path.endswith (i):
+            return i
+    return None
+
+def set_default_mode (path, mode):
+    """Give a file made by tempfile the permissions it would have had if
+    created normally."""
+    umask = os.umask (0)
+    os.umask (umask)
+    os.chmod (path, mode & ~umask)
+
+class ArchiveWriter (TreeWriter):
+    """Streams files into a zip or tar archive instead of a directory, from
+    one thread. Members go under a directory named after the archive, in the
+    order written, with fixed times, owners and permissions, so the same
+    library always gives the same archive. The archive is written to a
+    temporary file beside 'path' and renamed over it by commit().
+    """
+
+    def __init__ (self, path, sync=False, keep_previous=False):
+        self.final = path
+        self.keep_previous = keep_previous
+        self.suffix = archive_suffix (path)
+        name = os.path.basename (path)
+        self.prefix = name[:-len (self.suffix)]
+        self.mtime = int (os.environ.get ("SOURCE_DATE_EPOCH", ARCHIVE_EPOCH))
+
+        self.stream = None
+        if self.suffix == ".tar.zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception ("writing .tar.zst needs the zstandard module")
+
+        fd, temp = tempfile.mkstemp (prefix=".%s." % name, suffix=".tmp",
+                dir=os.path.dirname (os.path.abspath (path)))
+        set_default_mode (temp, 0o666)
+        self.file = os.fdopen (fd, 'wb')
+
+        if self.suffix == ".zip":
+            import zipfile
+            self.archive = zipfile.ZipFile (self.file, 'w', zipfile.ZIP_DEFLATED)
         else:
-            raise Exception ("3D map (line %d): unknown key \"%s\"" %
-                    (ff.Lineno - 1, key))
+            if self.suffix in (".tar.gz", ".tgz"):
+                self.stream = gzip.GzipFile (filename="", mode="wb",
+                        fileobj=self.file, mtime=self.mtime)
+            elif self.suffix == ".tar.xz":
+                import lzma
+                self.stream = lzma.LZMAFile (self.file, "wb")
+            elif self.suffix == ".tar.zst":
+                self.stream = zstandard.ZstdCompressor ().stream_writer (
+                        self.file, closefd=False)
+            self.archive = tarfile.open (fileobj=self.stream or self.file,
+                    mode="w|", format=tarfile.GNU_FORMAT)
+
+        TreeWriter.__init__ (self, temp, 1, sync)
+
+    def store (self, filename, text):
+        data = text.encode ("utf8")
+        name = "%s/%s" % (self.prefix, filename)
+        if self.suffix == ".zip":
+            import zipfile
+            date = time.gmtime (max (self.mtime, ARCHIVE_EPOCH))[:6]
+            info = zipfile.ZipInfo (name, date_time=date)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.archive.writestr (info, data)
+        else:
+            info = tarfile.TarInfo (name)
+            info.size = len (data)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            self.archive.addfile (info, io.BytesIO (data))
+        return None
+
+    def finish (self):
+        self.archive.close ()
+        if self.stream is not None:
+            self.stream.close ()
+        self.file.flush ()
+        if self.sync:
+            os.fsync (self.file.fileno ())
+        self.file.close ()
+
+    def commit (self):
+        """Rename the finished archive into place."""
+        if self.keep_previous and os.path.exists (self.final):
+            previous = self.final + ".previous"
+            if os.path.exists (previous):
+                os.remove (previous)
+            try:
+                os.link (self.final, previous)
+            except (OSError, AttributeError):
+                shutil.copyfile (self.final, previous)
+        getattr (os, "replace", os.rename) (self.path, self.final)
+        if self.sync:
+            fsync_path (os.path.dirname (os.path.abspath (self.final)))
+
+    def abort (self):
+        """Delete the temporary file, leaving the output as it was."""
+        try:
+            self.file.close ()
+        except Exception:
+            pass
+        try:
+            os.remove (self.path)
+        except OSError:
+            pass
+
+def read_archive (path):
+    """Yield (filename, data) for the files in an archive written by
+    ArchiveWriter."""
+    suffix = archive_suffix (path)
+    if suffix == ".zip":
+        import zipfile
+        with zipfile.ZipFile (path) as zf:
+            for info in zf.infolist ():
+                yield info.filename.split ("/", 1)[-1], zf.read (info)
+        return
+
+    with open (path, 'rb') as f:
+        stream = f
+        if suffix == ".tar.zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception ("reading .tar.zst needs the zstandard module")
+            stream = zstandard.ZstdDecompressor ().stream_reader (f)
+        mode = "r|" if suffix in (".tar", ".tar.zst") else \
+                "r|xz" if suffix == ".tar.xz" else "r|gz"
+        with tarfile.open (fileobj=stream, mode=mode) as tf:
+            for info in tf:
+                if info.isfile ():
+                    yield (info.name.split ("/", 1)[-1],
+                            tf.extractfile (info).read ())
+
+def fsync_path (path):
+    """Flush a file or directory to disk. Directories can't be opened on
+    some systems; they are skipped there.
+    """
+    try:
+        fd = os.open (path, os.O_RDONLY)
+    except OSError:
+        if os.path.isdir (path):
+            return
+        raise
+    try:
+        os.fsync (fd)
+    finally:
+        os.close (fd)
+
+def exchange_paths (a, b):
+    """Swap two paths atomically with renameat2 (RENAME_EXCHANGE), where
+    available. Returns False if it isn't.
+    """
+    try:
+        import ctypes
+        renameat2 = ctypes.CDLL (None, use_errno=True).renameat2
+    except (ImportError, OSError, AttributeError):
+        return False
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
+    encode = getattr (os, "fsencode", str)
+    result = renameat2 (AT_FDCWD, encode (a), AT_FDCWD, encode (b),
+            RENAME_EXCHANGE)
+    return result == 0
+
+class StagedTree (object):
+    """An output directory that is written as a staging directory beside
+    it, and swapped into place once complete, so that nothing ever sees it
+    half written. The tree it replaces is deleted, or kept as
+    PATH.previous.
+    """
 
-def main (args=None, zipfile=None):
+    def __init__ (self, path, keep_previous=False):
+        self.path = os.path.normpath (path)
+        self.keep_previous = keep_previous
+        self.parent = os.path.dirname (os.path.abspath (self.path))
+        if not os.path.isdir (self.parent):
+            os.makedirs (self.parent)
+        self.staging = tempfile.mkdtemp (dir=self.parent,
+                prefix=".%s." % os.path.basename (self.path), suffix=".staging")
+
+        set_default_mode (self.staging, 0o777)
+
+    def commit (self):
+        """Swap the staging directory into place."""
+        old = None
+        if not os.path.exists (self.path):
+            os.rename (self.staging, self.path)
+        elif exchange_paths (self.staging, self.path):
+            old = self.staging
+        else:
+            # No atomic exchange: the path is missing for a moment instead
+            old = self.staging + ".old"
+            os.rename (self.path, old)
+            os.rename (self.staging, self.path)
+        fsync_path (self.parent)
+
+        if old is None:
+            return
+        if self.keep_previous:
+            previous = self.path + ".previous"
+            if os.path.exists (previous):
+                shutil.rmtree (previous)
+            os.rename (old, previous)
+        else:
+            shutil.rmtree (old)
+
+    def abort (self):
+        """Delete the staging directory, leaving the output as it was."""
+        shutil.rmtree (self.staging, ignore_errors=True)
+
+def set_hash_time (module):
+    """Set a fake edit time on a module using a hash of its contents."""
+    module.tedit = 0
+    md5 = hashlib.md5()
+    md5.update(str(module.kicad_sexp()).encode('utf8'))
+    md5sum = md5.digest()
+    module.tedit = struct.unpack("<L", md5sum[0:4])[0]
+
+def module_text (module, fmt=None):
+    """Return the text of a module's .kicad_mod file, in the syntax of 'fmt'
+    (default: LEGACY)."""
+    f = io.StringIO ()
+    SexpDump (module.kicad_sexp (fmt), f)
+    return f.getvalue ()
+
+def module_filename (module):
+    # sanitise the name
+    return module.Name.replace ("/", "_") + '.kicad_mod'
+
+def converter_hash ():
+    """Hash identifying this version of the converter."""
+    sha = hashlib.sha1 (VERSION.encode ('utf8'))
+    with open (__file__, 'rb') as f:
+        sha.update (f.read ())
+    return sha.hexdigest ()
+
+def file_hash (path):
+    """SHA-1 of a file's contents, or None if there is no file."""
+    if path is None:
+        return None
+    with open (path, 'rb') as f:
+        return hashlib.sha1 (f.read ()).hexdigest ()
+
+def text_hash (text):
+    return hashlib.sha1 (text.encode ('utf8')).hexdigest ()
+
+def input_keys (name, source_name, origin, args, blocks):
+    """Return the manifest input keys of a module: everything besides the
+    converter and its options that its output depends on. 'name' is the
+    output name, 'source_name' the name before stripping L/M/N and 'origin'
+    the (file, CRC) it was read from.
     """
-    When called from other Python code, 'zipfile' is accepted in lieu of a list
-    of files; the files will be pulled from the zipfile object.
+
+    inputs = {"source_name": source_name,
+            "source": origin[0], "crc": origin[1]}
+
+    entries = blocks.get (name) if blocks is not None else None
+    if entries:
+        inputs["3dmap"] = text_hash (repr ([i[:2] for i in entries]))
+    else:
+        inputs["3dmap"] = None
+
+    if args.roundedpads is not None:
+        rounding = [[i.pattern for i in args.rpexceptions
+                        if i.match (source_name)],
+                    [i.pattern for i in args.rcexceptions
+                        if i.match (source_name)]]
+        inputs["rounding"] = text_hash (repr (rounding))
+    else:
+        inputs["rounding"] = None
+    return inputs
+
+def module_inputs (module, args, blocks):
+    """Return the manifest input keys of a module. See input_keys."""
+    return input_keys (module.Name, module.SourceName, module.Origin,
+            args, blocks)
+
+def write_manifest (path, argv, zipfile, library, args, blocks, outputs):
+    """Write a manifest recording the output hash and the input keys of every
+    module, for later verification with manifest.py.
+    """
+
+    footprints = {}
+    for module in library.Modules:
+        entry = module_inputs (module, args, blocks)
+        entry["file"] = module_filename (module)
+        entry["output"] = outputs[module.Name]
+        footprints[module.Name] = entry
+
+    manifest = {
+        "manifest": MANIFEST_VERSION,
+        "converter": converter_hash (),
+        "args": argv,
+        "zip": getattr (zipfile, "filename", None),
+        "footprints": footprints,
+    }
+
+    with open (path, 'w') as f:
+        json.dump (manifest, f, indent=1, sort_keys=True)
+        f.write ("\n")
+
+# Classes counted by the --memory-report object census
+MEMORY_TYPES = ["PCBmodule", "Pin", "PinArray", "Pad", "Polyline",
+        "TextProperties", "TextStyle", "Point"]
+
+class MemoryTracker (object):
+    """Traces allocations with tracemalloc, for --memory-report. Each stage
+    records its peak and retained memory, and the allocation sites that
+    retained the most.
+    """
+
+    def __init__ (self, top=10):
+        if tracemalloc is None:
+            raise Exception ("--memory-report needs tracemalloc (Python 3.4+)")
+        self.top = top
+        self.stages = []
+        if not tracemalloc.is_tracing ():
+            tracemalloc.start ()
+
+    def begin (self):
+        if hasattr (tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak ()
+        return tracemalloc.get_traced_memory ()[0], tracemalloc.take_snapshot ()
+
+    def end (self, name, state):
+        before, snapshot = state
+        current, peak = tracemalloc.get_traced_memory ()
+        sites = []
+        for i in tracemalloc.take_snapshot ().compare_to (snapshot, "lineno")[:self.top]:
+            frame = i.traceback[0]
+            sites.append ({"site": "%s:%d" % (os.path.basename (frame.filename),
+                frame.lineno), "bytes": i.size_diff, "blocks": i.count_diff})
+        self.stages.append ({"name": name, "before": before, "after": current,
+            "retained": current - before, "peak": peak,
+            "peak_increase": peak - before, "sites": sites})
+
+    def census (self):
+        """Count live instances of the MEMORY_TYPES classes and their shallow
+        size (the object, plus its __dict__ if it has one).
+        """
+        import gc
+        types = tuple (globals ()[i] for i in MEMORY_TYPES)
+        counts = dict ((i, {"count": 0, "bytes": 0}) for i in MEMORY_TYPES)
+        counts["PinArray"]["pins"] = 0
+        for obj in gc.get_objects ():
+            if isinstance (obj, types):
+                entry = counts[type (obj).__name__]
+                entry["count"] += 1
+                if isinstance (obj, PinArray):
+                    entry["pins"] += obj.Count
+                entry["bytes"] += sys.getsizeof (obj)
+                if hasattr (obj, "__dict__"):
+                    entry["bytes"] += sys.getsizeof (obj.__dict__)
+        return counts
+
+    def report (self):
+        current, peak = tracemalloc.get_traced_memory ()
+        types = self.census ()
+
+        # Memory kept by loading, per pin: the figure of merit for the data
+        # model, as pins far outnumber everything else
+        pins = types["Pin"]["count"] + types["PinArray"]["pins"]
+        loaded = [i["retained"] for i in self.stages if i["name"] == "load"]
+        bytes_per_pin = loaded[0] / float (pins) if loaded and pins else None
+
+        return {"stages": self.stages, "types": types,
+                "pins": pins, "bytes_per_pin": bytes_per_pin,
+                "current": current, "peak": max ([peak] +
+                    [i["peak"] for i in self.stages])}
+
+    def write (self, path):
+        report = self.report ()
+        with open (path, 'w') as f:
+            json.dump (report, f, indent=1, sort_keys=True)
+            f.write ("\n")
+        return report
+
+    @staticmethod
+    def summary (report, f):
+        mb = 1024. * 1024.
+        f.write ("  %-10s %10s %10s %10s\n" % ("stage", "peak (MB)",
+            "+peak (MB)", "kept (MB)"))
+        for i in report["stages"]:
+            f.write ("  %-10s %10.1f %10.1f %10.1f\n" % (i["name"], i["peak"] / mb,
+                i["peak_increase"] / mb, i["retained"] / mb))
+        f.write ("  %-15s %10s %10s\n" % ("type", "count", "MB"))
+        for name in MEMORY_TYPES:
+            i = report["types"][name]
+            f.write ("  %-15s %10d %10.1f\n" % (name, i["count"], i["bytes"] / mb))
+        if report["bytes_per_pin"] is not None:
+            f.write ("  %d pins, %.0f bytes per pin after loading\n" % (
+                report["pins"], report["bytes_per_pin"]))
+
+class Profiler (object):
+    """Records wall and CPU time of conversion stages, input files and
+    modules, for --profile. A disabled profiler records nothing. With a
+    MemoryTracker, stages also record their memory use.
+    """
+
+    def __init__ (self, enabled=True, memory=None):
+        self.enabled = enabled or memory is not None
+        self.memory = memory
+        self.spans = []
+        self.modules = {}
+        self.origin = time.perf_counter ()
+
+    @contextlib.contextmanager
+    def span (self, category, name, **details):
+        """Time the body of a 'with' block. The block gets a dict it can add
+        details to.
+        """
+        if not self.enabled:
+            yield details
+            return
+        memory = None
+        if self.memory is not None and category == "stage":
+            memory = self.memory.begin ()
+        wall = time.perf_counter ()
+        cpu = time.process_time ()
+        yield details
+        if memory is not None:
+            self.memory.end (name, memory)
+        self.spans.append ({"category": category, "name": name,
+            "start": wall - self.origin,
+            "wall": time.perf_counter () - wall,
+            "cpu": time.process_time () - cpu,
+            "details": details})
+
+    def each (self, stage, modules):
+        """Iterate over modules as one stage, charging the time of each
+        loop body to its module.
+        """
+        if not self.enabled:
+            return modules
+        return self._each (stage, modules)
+
+    def _each (self, stage, modules):
+        with self.span ("stage", stage):
+            for i in modules:
+                start = time.perf_counter ()
+                yield i
+                times = self.modules.setdefault (i, {})
+                times[stage] = times.get (stage, 0.) + time.perf_counter () - start
+
+    def slowest (self, count):
+        """The 'count' modules that took longest over all stages."""
+        rows = []
+        for module, times in self.modules.items ():
+            rows.append ({"name": module.Name,
+                "wall": sum (times.values ()),
+                "stages": times,
+                "pins": module.pin_count (),
+                "polylines": sum (1 for i in module.Graphics
+                    if isinstance (i, Polyline))})
+        rows.sort (key=lambda i: -i["wall"])
+        return rows[:count]
+
+    def report (self, top=20):
+        def spans (category):
+            return [dict (i["details"], name=i["name"], start=i["start"],
+                wall=i["wall"], cpu=i["cpu"])
+                for i in self.spans if i["category"] == category]
+        return {"stages": spans ("stage"),
+                "members": spans ("member"),
+                "slowest_modules": self.slowest (top)}
+
+    def chrome_trace (self):
+        """Spans as Chrome trace events (chrome://tracing, Perfetto)."""
+        events = []
+        for i in self.spans:
+            events.append ({"name": i["name"], "cat": i["category"], "ph": "X",
+                "ts": i["start"] * 1e6, "dur": i["wall"] * 1e6,
+                "pid": os.getpid (), "tid": 1,
+                "args": dict (i["details"], cpu=i["cpu"])})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write (self, prefix, top=20):
+        with open (prefix + ".json", 'w') as f:
+            json.dump (self.report (top), f, indent=1, sort_keys=True)
+            f.write ("\n")
+        with open (prefix + ".trace.json", 'w') as f:
+            json.dump (self.chrome_trace (), f)
+            f.write ("\n")
+
+    def summary (self, f):
+        for i in self.spans:
+            if i["category"] == "stage":
+                f.write ("  %-10s %8.3f s wall %8.3f s cpu\n" % (i["name"],
+                    i["wall"], i["cpu"]))
+
+class Progress (object):
+    """A progress line for --quiet, updated at most every INTERVAL seconds."""
+
+    INTERVAL = 0.5
+
+    def __init__ (self, label, total, f=sys.stdout):
+        self.label = label
+        self.total = total
+        self.f = f
+        self.tty = hasattr (f, "isatty") and f.isatty ()
+        self.last = None
+
+    def update (self, count):
+        now = time.perf_counter ()
+        if self.last is not None and now - self.last < self.INTERVAL \
+                and count != self.total:
+            return
+        self.last = now
+        self.f.write ("%s %d/%d%s" % (self.label, count, self.total,
+            "\r" if self.tty else "\n"))
+        self.f.flush ()
+
+    def done (self):
+        if self.tty and self.last is not None:
+            self.f.write ("\n")
+
+class Watcher (object):
+    """Keeps a converted library in memory for --watch. When the 3D map or
+    an exceptions list changes, only the footprints whose entries in it
+    changed are updated and rewritten. What each module depends on is
+    tracked with the input keys the manifest records (see input_keys).
     """
 
+    def __init__ (self, library, args, blocks, targets, outputs, argv=None,
+            zipfile=None):
+        self.library = library
+        self.args = args
+        self.blocks = blocks
+        self.targets = targets
+        self.outputs = outputs
+        self.argv = argv
+        self.zipfile = zipfile
+
+        if any (archive_suffix (i[1]) for i in targets):
+            raise Exception ("--watch can't update archives")
+        self.paths = [i for i in (args.threedmap, args.rpexcept,
+            args.rcexcept) if i is not None]
+        if not self.paths:
+            raise Exception ("--watch needs --3dmap or an exceptions list")
+        self.stamps = dict ((i, self.stamp (i)) for i in self.paths)
+
+        # Modules are written in order, so a file holds the last module with
+        # its name; the 3D map applies to the first
+        self.files = {}
+        self.first = {}
+        for i in library.Modules:
+            self.files[module_filename (i)] = i
+            self.first.setdefault (i.Name, i)
+        self.keys = dict ((id (i), self.keys_of (i)) for i in library.Modules)
+
+    @staticmethod
+    def stamp (path):
+        try:
+            st = os.stat (path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def keys_of (self, module):
+        keys = module_inputs (module, self.args, self.blocks)
+        return (keys["3dmap"], keys["rounding"])
+
+    def reload (self, path):
+        args = self.args
+        if path == args.threedmap:
+            self.blocks = read_3dmap (path)
+            for name in sorted (set (self.blocks) - set (self.first)):
+                print ("3D map (line %d): couldn't find module \"%s\"" %
+                        (self.blocks[name][0][2], name))
+        if path == args.rpexcept:
+            args.rpexceptions = read_exceptions (path)
+        if path == args.rcexcept:
+            args.rcexceptions = read_exceptions (path)
+
+    def write (self, module):
+        filename = module_filename (module)
+        for n, (fmt, path) in enumerate (self.targets):
+            text = module_text (module, fmt)
+            with open (os.path.join (path, filename), 'w') as f:
+                f.write (text)
+            if n == 0:
+                self.outputs[module.Name] = text_hash (text)
+
+    def update (self):
+        """Re-read the config files that changed, and rewrite the footprints
+        they affect. Returns the rewritten modules, or None if nothing
+        changed.
+        """
+
+        changed = [i for i in self.paths if self.stamp (i) != self.stamps[i]]
+        if not changed:
+            return None
+        for i in changed:
+            self.stamps[i] = self.stamp (i)
+            self.reload (i)
+
+        rewritten = []
+        for module in self.library.Modules:
+            keys = self.keys_of (module)
+            old = self.keys[id (module)]
+            if keys == old:
+                continue
+            self.keys[id (module)] = keys
+
+            if keys[0] != old[0] and self.first[module.Name] is module:
+                module.reset_3d ()
+                apply_3dmap_entries (module, self.blocks.get (module.Name, []))
+            if keys[1] != old[1]:
+                module.Rounding = None
+            if self.args.hashtime:
+                set_hash_time (module)
+
+            if self.files[module_filename (module)] is module:
+                self.write (module)
+                rewritten.append (module)
+
+        if rewritten and self.args.manifest is not None:
+            write_manifest (self.args.manifest, self.argv, self.zipfile,
+                    self.library, self.args, self.blocks, self.outputs)
+        return rewritten
+
+    def run (self, interval):
+        """Poll the config files every 'interval' seconds, until Ctrl-C."""
+        print ("Watching %s for changes (Ctrl-C to stop)..." %
+                ", ".join (self.paths))
+        try:
+            while True:
+                time.sleep (interval)
+                start = time.time ()
+                try:
+                    rewritten = self.update ()
+                except Exception as e:
+                    print ("Error: %s" % e)
+                    continue
+                if rewritten is None:
+                    continue
+                for i in rewritten:
+                    print (os.path.join (self.targets[0][1], module_filename (i)))
+                print ("%d footprints rewritten in %.0f ms" % (len (rewritten),
+                    (time.time () - start) * 1000.))
+        except KeyboardInterrupt:
+            pass
+
+def make_parser ():
     from argparse import ArgumentParser
     description = "Read a FreePCB library file and convert it to Kicad " + \
             "format, with output to the specified directory. Uses the new " + \
@@ -943,7 +2906,8 @@ def main (args=None, zipfile=None):
     p.add_argument ("-v", "--version", action="version",
             version="%(prog)s " + VERSION)
 
-    p.add_argument ("outdir", metavar="DIR", type=str,              help="Output directory")
+    p.add_argument ("outdir", metavar="DIR", type=str,              help="Output directory, or archive to write the library into " + \
+                                                                         "(.zip, .tar, .tar.gz, .tar.xz or .tar.zst)")
     p.add_argument ("infile", metavar="FILE", type=str, nargs='*',  help="FreePCB-format input(s)")
     blurbp = p.add_mutually_exclusive_group ()
     blurbp.add_argument ("--blurb", dest="blurb", action="store_const",
@@ -970,87 +2934,180 @@ def main (args=None, zipfile=None):
             const=True, default=False,                              help="Strip final L/M/N specifiers from names")
     p.add_argument ("--add-courtyard", dest="courtyard", type=float,
             default=None,                                           help="Add a courtyard a fixed number of mm outside the bounding box")
+    p.add_argument ("--courtyard-mode", dest="courtyard_mode", type=str,
+            choices=["bbox", "hull"], default="bbox",               help="Courtyard shape: a rectangle around the bounding box, or the convex hull " + \
+                                                                         "of pads and outlines (needs NumPy) (default: bbox)")
+    p.add_argument ("--courtyard-grid", dest="courtyard_grid", type=float,
+            default=None,                                           help="Round courtyard corners outward to this grid, in mm")
     p.add_argument ("--hash-time", dest="hashtime", action="store_const",
             const=True, default=False,                              help="Set a fake edit time on the footprints using a hash")
-    args = p.parse_args (args)
+    p.add_argument ("--manifest", dest="manifest", type=str,
+            default=None,                                           help="Write a manifest of output hashes and their inputs to this file, " + \
+                                                                         "for checking with manifest.py")
+    p.add_argument ("--quiet", dest="quiet", action="store_const",
+            const=True, default=False,                              help="Show a progress line instead of every file name")
+    p.add_argument ("--profile", dest="profile", type=str,
+            default=None,                                           help="Time each stage, input file and module, writing PREFIX.json and " + \
+                                                                         "a Chrome trace, PREFIX.trace.json", metavar="PREFIX")
+    p.add_argument ("--profile-top", dest="profile_top", type=int,
+            default=20,                                             help="Number of slowest modules to report with --profile (default: 20)")
+    p.add_argument ("--memory-report", dest="memory_report", type=str,
+            default=None,                                           help="Trace memory per stage and object type with tracemalloc, writing " + \
+                                                                         "a JSON report to this file (slows conversion down)")
+    p.add_argument ("--format", dest="formats", type=str, action="append",
+            default=None, metavar="FORMAT[=DIR]",                   help="Footprint syntax to write: legacy, kicad6 or kicad7 (default: legacy). " + \
+                                                                         "Repeat to write several formats from one conversion; each goes to " + \
+                                                                         "DIR, or else to a subdirectory of the output directory named after it")
+    p.add_argument ("--atomic", dest="atomic", action="store_const",
+            const=True, default=False,                              help="Write into a staging directory and swap it into place when complete, " + \
+                                                                         "replacing the old output directory")
+    p.add_argument ("--keep-previous", dest="keep_previous", action="store_const",
+            const=True, default=False,                              help="With --atomic, keep the replaced directory as DIR.previous")
+    p.add_argument ("--writers", dest="writers", type=int,
+            default=4,                                              help="Threads writing files to each output directory (default: 4)")
+    p.add_argument ("--watch", dest="watch", action="store_const",
+            const=True, default=False,                              help="After converting, keep running, and rewrite the footprints affected " + \
+                                                                         "by changes to the 3D map and exceptions lists")
+    p.add_argument ("--watch-interval", dest="watch_interval", type=float,
+            default=0.2, metavar="SECONDS",                         help="How often --watch checks for changes (default: 0.2)")
+    p.add_argument ("--resolution", dest="resolution", type=int,
+            default=1, metavar="NM",                                help="Round numbers in the output to this many nanometres (default: 1)")
+    p.add_argument ("--no-pin-arrays", dest="pin_arrays", action="store_const",
+            const=False, default=True,                              help="Keep every pin separately instead of storing rows and grids of pins " + \
+                                                                         "as arrays (the output is the same)")
+    return p
+
+def parse_args (args=None):
+    """Parse command line arguments, loading the exceptions lists."""
+    args = make_parser ().parse_args (args)
 
     # Parse rounded pads exceptions file?
-    rpexceptions = []
-    if args.rpexcept is not None:
-        with open (args.rpexcept) as f:
-            for line in f:
-                line = line.strip ()
-                if not line:
-                    continue
-                rpexceptions.append (re.compile (line))
     # It's really an argument, so put it inside args
-    args.rpexceptions = rpexceptions
+    args.rpexceptions = read_exceptions (args.rpexcept)
 
     # Parse rounded center pads exceptions file?
-    rcexceptions = []
-    if args.rcexcept is not None:
-        with open (args.rcexcept) as f:
-            for line in f:
-                line = line.strip ()
-                if not line:
-                    continue
-                rcexceptions.append (re.compile (line))
-    # It's really an argument, so put it inside args
-    args.rcexceptions = rcexceptions
+    args.rcexceptions = read_exceptions (args.rcexcept)
+
+    if args.keep_previous and not args.atomic:
+        raise Exception ("--keep-previous needs --atomic")
+    return args
+
+def main (args=None, zipfile=None):
+    """
+    When called from other Python code, 'zipfile' is accepted in lieu of a list
+    of files; the files will be pulled from the zipfile object.
+    """
+
+    argv = list (sys.argv[1:] if args is None else args)
+    args = parse_args (argv)
+    set_resolution (args.resolution)
+
+    memory = None
+    if args.memory_report is not None:
+        memory = MemoryTracker ()
+    profiler = Profiler (enabled=args.profile is not None, memory=memory)
 
     # Main conversion
     print ("Loading FreePCB library...")
     library = Library ()
-    for filename in args.infile:
-        print (filename)
-        f = open (filename)
-        ff = FreePCBfile (f)
-        sublibrary = Library (ff, args)
-        library += sublibrary
-        f.close ()
-    if zipfile is not None:
-        for filename in zipfile.namelist ():
-            f = zipfile.open (filename, 'r')
-            f_wrapped = io.TextIOWrapper (f, 'utf8')
-            ff = FreePCBfile (f_wrapped)
-            sublibrary = Library (ff, args)
-            library += sublibrary
-            f.close ()
+    with profiler.span ("stage", "load"):
+        for filename in args.infile:
+            if not args.quiet:
+                print (filename)
+            library += load_file (filename, args, profiler)
+        if zipfile is not None:
+            library += load_zip (zipfile, args, profiler=profiler)
 
     # Strip L/M/N?
     if args.strip_lmn:
-        library.strip_lmn ()
+        with profiler.span ("stage", "strip_lmn"):
+            library.strip_lmn ()
 
     # Add 3D models
+    blocks = None
     if args.threedmap is not None:
-        process_3dmap (args.threedmap, library)
+        with profiler.span ("stage", "3dmap"):
+            blocks = process_3dmap (args.threedmap, library)
 
     # Add courtyards
     if args.courtyard is not None:
-        for i in library.Modules:
-            i.add_courtyard (args.courtyard)
+        if args.courtyard_mode == "hull":
+            with profiler.span ("stage", "courtyard"):
+                add_courtyards (library.Modules, args)
+        else:
+            add_courtyards (library.Modules, args,
+                    lambda modules: profiler.each ("courtyard", modules))
 
     # Fake timestamps?
     if args.hashtime:
-        import hashlib
-        import struct
-        for i in library.Modules:
-            i.tedit = 0
-            md5 = hashlib.md5()
-            md5.update(str(i.kicad_sexp()).encode('utf8'))
-            md5sum = md5.digest()
-            i.tedit = struct.unpack("<L", md5sum[0:4])[0]
+        for i in profiler.each ("hash_time", library.Modules):
+            set_hash_time (i)
 
     print ("Generating KiCad library...")
-    for i in library.Modules:
-        path = os.path.join (args.outdir, i.Name + '.kicad_mod')
-        print (path)
-        # sanitise the name
-        path = path.replace ("/", "_")
-        with open (path, 'w') as f:
-            sexp = i.kicad_sexp ()
-            SexpDump (sexp, f)
-            # sexpdata.dump (i.kicad_sexp (), f)
+    progress = None
+    if args.quiet:
+        progress = Progress ("Generating KiCad library...", len (library.Modules))
+    targets = output_targets (args)
+    stages = []
+    writers = []
+    for fmt, path in targets:
+        if archive_suffix (path) is not None:
+            writers.append (ArchiveWriter (path, args.atomic,
+                args.keep_previous))
+            stages.append (writers[-1])
+            continue
+        if args.atomic:
+            stages.append (StagedTree (path, args.keep_previous))
+            path = stages[-1].staging
+        elif len (targets) > 1 and not os.path.isdir (path):
+            os.makedirs (path)
+        writers.append (TreeWriter (path, args.writers, sync=args.atomic))
+    outputs = {}
+    try:
+        try:
+            for n, i in enumerate (profiler.each ("write", library.Modules)):
+                filename = module_filename (i)
+                if progress is None:
+                    print (os.path.join (targets[0][1], filename))
+                else:
+                    progress.update (n + 1)
+                for (fmt, path), writer in zip (targets, writers):
+                    text = module_text (i, fmt)
+                    writer.write (filename, text)
+                    if writer is writers[0]:
+                        outputs[i.Name] = text_hash (text)
+        finally:
+            for writer in writers:
+                writer.close ()
+    except:
+        for stage in stages:
+            stage.abort ()
+        raise
+    for stage in stages:
+        stage.commit ()
+    if progress is not None:
+        progress.done ()
+
+    if args.manifest is not None:
+        with profiler.span ("stage", "manifest"):
+            write_manifest (args.manifest, argv, zipfile, library, args, blocks,
+                    outputs)
+
+    if args.profile is not None:
+        profiler.write (args.profile, args.profile_top)
+        print ("Profile written to %s.json and %s.trace.json" % (args.profile,
+            args.profile))
+        profiler.summary (sys.stdout)
+
+    if memory is not None:
+        report = memory.write (args.memory_report)
+        print ("Memory report written to %s" % args.memory_report)
+        MemoryTracker.summary (report, sys.stdout)
+
+    if args.watch:
+        watcher = Watcher (library, args, blocks, targets, outputs, argv,
+                zipfile)
+        watcher.run (args.watch_interval)
 
 if __name__ == "__main__":
     main ()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# gen_synthetic
+
+# CC0 1.0 Universal
+
+# This script writes synthetic FreePCB libraries for scale testing of
+# freepcb2pretty, bench.py and friends. The real IPC7351 inputs are only a few
+# MB each; this can produce anything from a thousand to millions of modules.
+#
+# Output is a zip (one .fpl member per --modules-per-file modules), a
+# directory of .fpl files, or a single .fpl file, chosen by the name of OUT.
+# Everything is streamed, module by module, so corpora larger than memory
+# are fine (zips are written with zip64 extensions). The output is a pure
+# function of the options and --seed: the same command always writes the
+# same bytes.
+#
+# Modules are drawn from a few families, roughly like the real libraries:
+# BGAs (full or depopulated grids, up to 2000+ balls), quad and dual rows of
+# SMD pins, and through-hole rows. Outlines have a configurable number of
+# corners, some of them arcs. Each module uses one of the chosen units.
+#
+# Names can repeat (--dup-rate), but only within one file: Library accepts
+# that, while merging two files with the same name is an error. Names end in
+# N like the Nominal IPC library, so --strip-lmn behaves as usual. Generated
+# names don't match config/3dmap; use bench.py --no-3dmap.
+#
+# Examples:
+#   gen_synthetic.py --modules 100000 synthetic-100k.zip
+#   gen_synthetic.py --modules 1000 --pins 1000:2025 --family bga bga.zip
+
+import os
+import math
+import random
+import zipfile
+
+VERSION = "1.0"
+
+FAMILIES = ["bga", "quad", "dual", "tht"]
+
+UNITS = {
+    # name: (units per mm, formatting function)
+    "NM": (1000000., lambda v: "%d" % round (v)),
+    "MIL": (1 / 0.0254, lambda v: "%d" % round (v)),
+    "MM": (1., lambda v: "%.4f" % v),
+}
+
+# FreePCB pad shapes
+PAD_ROUND = 1
+PAD_SQUARE = 2
+PAD_RECT = 3
+PAD_RRECT = 4
+PAD_OVAL = 5
+
+BGA_ROWS = "ABCDEFGHJKLMNPRTUVWY"
+
+# Fixed timestamp for zip members, so output is reproducible
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+def bga_row_name (i):
+    """Ball row names: A..Y without I, O, Q, S, X, Z, then AA, AB..."""
+    n = len (BGA_ROWS)
+    if i < n:
+        return BGA_ROWS[i]
+    return bga_row_name (i // n - 1) + BGA_ROWS[i % n]
+
+class Generator (object):
+    """Writes modules to a text stream."""
+
+    def __init__ (self, opts):
+        self.opts = opts
+        self.rng = random.Random (opts.seed)
+        self.count = 0
+
+    def pin_count (self):
+        return self.rng.randint (self.opts.pins[0], self.opts.pins[1])
+
+    def pins_bga (self, npins):
+        rng = self.rng
+        side = max (2, int (math.ceil (math.sqrt (npins))))
+        pitch = rng.choice ([0.4, 0.5, 0.65, 0.8, 1.0, 1.27])
+        ball = pitch * rng.uniform (0.45, 0.6)
+        skip = set ()
+        if rng.random () < 0.3:
+            # Depopulated center
+            hole = side // 3
+            first = (side - hole) // 2
+            skip = set ((i, j) for i in range (first, first + hole)
+                    for j in range (first, first + hole))
+        offset = (side - 1) * pitch / 2
+        pins = []
+        for row in range (side):
+            for col in range (side):
+                if (row, col) in skip or len (pins) >= npins:
+                    continue
+                pins.append (("%s%d" % (bga_row_name (row), col + 1), 0.,
+                    col * pitch - offset, offset - row * pitch, 0.,
+                    (PAD_ROUND, ball, 0., 0.)))
+        size = side * pitch + pitch
+        return pins, size, size
+
+    def pins_rows (self, npins, sides, drill=0.):
+        rng = self.rng
+        per_side = max (1, npins // sides)
+        pitch = rng.choice ([0.4, 0.5, 0.65, 0.8, 1.27, 2.54] if not drill
+                else [1.27, 2.0, 2.54])
+        length = per_side * pitch
+        span = length + rng.uniform (2., 6.)
+        if drill:
+            pad = (PAD_ROUND, drill + rng.uniform (0.4, 0.8), 0., 0.)
+        else:
+            shape = rng.choice ([PAD_RECT, PAD_RRECT, PAD_OVAL])
+            half = rng.uniform (0.5, 1.2)
+            pad = (shape, pitch * rng.uniform (0.45, 0.65), half, half)
+
+        pins = []
+        number = 1
+        for side in range (sides):
+            # Sides go counterclockwise: left, bottom, right, top
+            angle = 0. if side % 2 == 0 else 90.
+            for k in range (per_side):
+                along = k * pitch - (per_side - 1) * pitch / 2
+                if side == 0:
+                    x, y = -span / 2, -along
+                elif side == 1:
+                    x, y = along, -span / 2
+                elif side == 2:
+                    x, y = span / 2, along
+                else:
+                    x, y = -along, span / 2
+                if sides == 2 and side == 1:
+                    x, y = span / 2, along
+                pins.append (("%d" % number, drill, x, y, angle, pad))
+                number += 1
+        if sides == 2:
+            return pins, span + 2., length + 1.
+        return pins, span + 2., span + 2.
+
+    def module (self, f, name):
+        rng = self.rng
+        opts = self.opts
+        family = rng.choice (opts.families)
+        units = rng.choice (opts.units)
+        scale, fmt = UNITS[units]
+        npins = self.pin_count ()
+
+        if family == "bga":
+            pins, w, h = self.pins_bga (npins)
+        elif family == "quad":
+            pins, w, h = self.pins_rows (max (4, npins), 4)
+        elif family == "dual":
+            pins, w, h = self.pins_rows (max (2, npins), 2)
+        else:
+            pins, w, h = self.pins_rows (max (2, npins), 2,
+                    drill=rng.choice ([0.8, 1.0, 1.2]))
+
+        def v (mm):
+            return fmt (mm * scale)
+
+        f.write ('name: "%s"\n' % name)
+        f.write ('author: "gen_synthetic"\n')
+        f.write ('source: "seed %d"\n' % opts.seed)
+        f.write ('description: "Synthetic %s, %d pins, %.2fmm X %.2fmm"\n'
+                % (family, len (pins), w, h))
+        f.write ("  units: %s\n" % units)
+        f.write ("  sel_rect: %s %s %s %s\n" % (v (-w / 2), v (-h / 2),
+            v (w / 2), v (h / 2)))
+        f.write ("  ref_text: %s 0 %s 0 %s\n" % (v (1.27), v (h / 2 + 1.), v (0.15)))
+        f.write ("  value_text: %s 0 %s 0 %s\n" % (v (1.27), v (-h / 2 - 2.), v (0.15)))
+        f.write ("  centroid: 0 0 0 0\n")
+
+        for k in range (opts.polylines):
+            self.polyline (f, v, w * (1. - 0.1 * k), h * (1. - 0.1 * k))
+
+        f.write ("  n_pins: %d\n" % len (pins))
+        for pin, drill, x, y, angle, pad in pins:
+            f.write ('    pin: "%s" %s %s %s %d\n' % (pin, v (drill), v (x),
+                v (y), angle))
+            shape, width, len1, len2 = pad
+            stack = "%d %s %s %s %s" % (shape, v (width), v (len1), v (len2),
+                    v (width / 4) if shape == PAD_RRECT else "0")
+            f.write ("      top_pad: %s\n" % stack)
+            if drill:
+                f.write ("      inner_pad: %s\n" % stack)
+                f.write ("      bottom_pad: %s\n" % stack)
+        f.write ("\n")
+
+    def polyline (self, f, v, w, h):
+        """An outline around the body: a rectangle with extra corners along
+        its edges, and arcs at some corners.
+        """
+        rng = self.rng
+        corners = max (4, self.opts.corners)
+        points = []
+        for side in range (4):
+            n = corners // 4 + (1 if side < corners % 4 else 0)
+            for k in range (n):
+                t = float (k) / n
+                if side == 0:
+                    points.append ((-w / 2 + t * w, -h / 2))
+                elif side == 1:
+                    points.append ((w / 2, -h / 2 + t * h))
+                elif side == 2:
+                    points.append ((w / 2 - t * w, h / 2))
+                else:
+                    points.append ((-w / 2, h / 2 - t * h))
+
+        f.write ("  outline_polyline: %s %s %s\n" % (v (0.2), v (points[0][0]),
+            v (points[0][1])))
+        for x, y in points[1:]:
+            style = rng.choice ((1, 2)) if rng.random () < self.opts.arc_rate else 0
+            f.write ("    next_corner: %s %s %d\n" % (v (x), v (y), style))
+        f.write ("    close_polyline: 0\n")
+
+    def write_file (self, f, count):
+        """Write 'count' modules, with repeated names at --dup-rate."""
+        names = []
+        for i in range (count):
+            if names and self.rng.random () < self.opts.dup_rate:
+                name = self.rng.choice (names)
+            else:
+                self.count += 1
+                name = "SYN%07dN" % self.count
+                names.append (name)
+            self.module (f, name)
+
+def file_sizes (total, per_file):
+    while total > 0:
+        yield min (total, per_file)
+        total -= per_file
+
+class ZipMember (object):
+    """Text stream into a zip member, encoding in chunks."""
+
+    def __init__ (self, zf, name):
+        info = zipfile.ZipInfo (name, date_time=ZIP_DATE)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.f = zf.open (info, "w", force_zip64=True)
+        self.buf = []
+        self.size = 0
+
+    def write (self, s):
+        self.buf.append (s)
+        self.size += len (s)
+        if self.size > 1 << 20:
+            self.flush ()
+
+    def flush (self):
+        self.f.write ("".join (self.buf).encode ("utf8"))
+        self.buf = []
+        self.size = 0
+
+    def close (self):
+        self.flush ()
+        self.f.close ()
+
+def parse_range (s):
+    low, delim, high = s.partition (":")
+    low = int (low)
+    high = int (high) if delim else low
+    if low < 1 or high < low:
+        raise ValueError ("expected N or MIN:MAX with 1 <= MIN <= MAX")
+    return low, high
+
+def parse_list (choices):
+    def parse (s):
+        items = [i.strip () for i in s.split (",") if i.strip ()]
+        for i in items:
+            if i not in choices:
+                raise ValueError ("%s is not one of %s" % (i, ", ".join (choices)))
+        return items
+    return parse
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Write a synthetic FreePCB library for scale testing."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("out", metavar="OUT", type=str,
+            help="Output: NAME.zip, NAME.fpl, or a directory for .fpl files")
+    p.add_argument ("--modules", dest="modules", type=int, default=1000,
+            help="Number of modules (default: 1000)")
+    p.add_argument ("--modules-per-file", dest="per_file", type=int, default=1000,
+            help="Modules per .fpl file (default: 1000)")
+    p.add_argument ("--pins", dest="pins", type=parse_range, default=(2, 64),
+            metavar="N|MIN:MAX", help="Pins per module (default: 2:64)")
+    p.add_argument ("--family", dest="families", type=parse_list (FAMILIES),
+            default=FAMILIES, metavar="LIST",
+            help="Module families to use (default: %s)" % ",".join (FAMILIES))
+    p.add_argument ("--units", dest="units", type=parse_list (sorted (UNITS)),
+            default=["NM"], metavar="LIST",
+            help="Units to choose from: NM, MIL, MM (default: NM)")
+    p.add_argument ("--polylines", dest="polylines", type=int, default=1,
+            help="Outline polylines per module (default: 1)")
+    p.add_argument ("--corners", dest="corners", type=int, default=4,
+            help="Corners per outline polyline (default: 4)")
+    p.add_argument ("--arc-rate", dest="arc_rate", type=float, default=0.1,
+            help="Fraction of outline sides drawn as arcs (default: 0.1)")
+    p.add_argument ("--dup-rate", dest="dup_rate", type=float, default=0.,
+            help="Fraction of modules reusing an earlier name (default: 0)")
+    p.add_argument ("--seed", dest="seed", type=int, default=0,
+            help="Random seed (default: 0)")
+    opts = p.parse_args ()
+
+    gen = Generator (opts)
+    out = opts.out
+    if out.endswith (".zip"):
+        prefix = os.path.basename (out)[:-4]
+        with zipfile.ZipFile (out, "w", allowZip64=True) as zf:
+            for k, count in enumerate (file_sizes (opts.modules, opts.per_file)):
+                f = ZipMember (zf, "%s/part%05d.fpl" % (prefix, k))
+                gen.write_file (f, count)
+                f.close ()
+    elif out.endswith (".fpl"):
+        with open (out, "w") as f:
+            gen.write_file (f, opts.modules)
+    else:
+        if not os.path.isdir (out):
+            os.makedirs (out)
+        for k, count in enumerate (file_sizes (opts.modules, opts.per_file)):
+            with open (os.path.join (out, "part%05d.fpl" % k), "w") as f:
+                gen.write_file (f, count)
+
+    print ("%d modules written to %s" % (opts.modules, out))
+
+if __name__ == "__main__":
+    main ()
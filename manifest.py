@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# manifest
+
+# CC0 1.0 Universal
+
+# This script checks a generated library against the manifest written by
+# freepcb2pretty --manifest, answering "is the library stale?" without a full
+# regeneration and diff.
+#
+# The manifest records, for every footprint, the hash of its output file and
+# the keys of everything it was built from: the converter (a hash of
+# freepcb2pretty.py), the converter arguments, the zip member and its CRC,
+# the footprint's 3D map entries and which rounded-pad exceptions matched it.
+#
+# 'verify' recomputes the input keys (zip CRCs come from the central
+# directory, so nothing is decompressed), then reconverts in memory only the
+# zip members holding footprints whose inputs changed, and compares those
+# against the files on disk. With --outputs it only re-hashes the output
+# files against the manifest, which catches hand edits. When the converter
+# wrote several formats, the manifest covers the first (see --format).
+# Libraries written as archives are checked inside the archive.
+#
+# Run it from the directory the conversion was run from, since the manifest
+# records paths as they were given to the converter.
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import zipfile
+
+import freepcb2pretty
+from freepcb2pretty import Library
+
+VERSION = "1.0"
+
+def load_manifest (path):
+    with open (path) as f:
+        manifest = json.load (f)
+    if manifest.get ("manifest") != freepcb2pretty.MANIFEST_VERSION:
+        raise Exception ("%s: unsupported manifest version %r" %
+                (path, manifest.get ("manifest")))
+    return manifest
+
+def source_crcs (manifest, args):
+    """Return {source: CRC} for the current inputs of a manifest."""
+    crcs = {}
+    for filename in args.infile:
+        with open (filename, 'rb') as f:
+            crcs[filename] = zlib.crc32 (f.read ()) & 0xffffffff
+    if manifest["zip"] is not None:
+        with zipfile.ZipFile (manifest["zip"]) as zf:
+            for info in zf.infolist ():
+                crcs[info.filename] = info.CRC
+    return crcs
+
+def changed_entries (manifest, args):
+    """Compare the recorded input keys with the current inputs. Returns
+    ({footprint: [reasons]}, [new sources], [problems]).
+    """
+
+    footprints = manifest["footprints"]
+    converter_changed = manifest["converter"] != freepcb2pretty.converter_hash ()
+    blocks = None
+    if args.threedmap is not None:
+        blocks = freepcb2pretty.read_3dmap (args.threedmap)
+    crcs = source_crcs (manifest, args)
+
+    changed = {}
+    for name, entry in footprints.items ():
+        reasons = []
+        if converter_changed:
+            reasons.append ("converter")
+
+        source = entry["source"]
+        if source not in crcs:
+            reasons.append ("source removed")
+        else:
+            keys = freepcb2pretty.input_keys (name, entry["source_name"],
+                    (source, crcs[source]), args, blocks)
+            for key in ("crc", "3dmap", "rounding"):
+                if keys[key] != entry[key]:
+                    reasons.append (key)
+        if reasons:
+            changed[name] = reasons
+
+    known = set (i["source"] for i in footprints.values ())
+    new_sources = sorted (set (crcs) - known)
+
+    problems = []
+    if blocks is not None:
+        for name in sorted (set (blocks) - set (footprints)):
+            problems.append ("3D map names unknown module \"%s\"" % name)
+    return changed, new_sources, problems
+
+def rebuild (manifest, args, sources):
+    """Convert just the given sources in memory, the same way freepcb2pretty
+    would. Returns {footprint: (filename, output hash)}.
+    """
+
+    freepcb2pretty.set_resolution (args.resolution)
+    library = Library ()
+    for filename in args.infile:
+        if filename in sources:
+            library += freepcb2pretty.load_file (filename, args)
+    if manifest["zip"] is not None:
+        with zipfile.ZipFile (manifest["zip"]) as zf:
+            library += freepcb2pretty.load_zip (zf, args, sources)
+
+    if args.strip_lmn:
+        library.strip_lmn ()
+
+    if args.threedmap is not None:
+        blocks = freepcb2pretty.read_3dmap (args.threedmap)
+        for i in library.Modules:
+            if i.Name in blocks:
+                freepcb2pretty.apply_3dmap_entries (i, blocks[i.Name])
+
+    if args.courtyard is not None:
+        freepcb2pretty.add_courtyards (library.Modules, args)
+
+    fmt, outdir = freepcb2pretty.output_targets (args)[0]
+    outputs = {}
+    for i in library.Modules:
+        if args.hashtime:
+            freepcb2pretty.set_hash_time (i)
+        text = freepcb2pretty.module_text (i, fmt)
+        outputs[i.Name] = (freepcb2pretty.module_filename (i),
+                freepcb2pretty.text_hash (text))
+    return outputs
+
+def archive_hashes (path):
+    """Return {filename: hash} for the files in an output archive."""
+    hashes = {}
+    if os.path.exists (path):
+        for filename, data in freepcb2pretty.read_archive (path):
+            hashes[filename] = hashlib.sha1 (data).hexdigest ()
+    return hashes
+
+def check_outputs (manifest, args):
+    """Re-hash the output files. Returns a list of problems."""
+    outdir = freepcb2pretty.output_targets (args)[0][1]
+    if freepcb2pretty.archive_suffix (outdir) is not None:
+        return check_archive (manifest, outdir)
+    problems = []
+    expected = set ()
+    for name, entry in sorted (manifest["footprints"].items ()):
+        path = os.path.join (outdir, entry["file"])
+        expected.add (entry["file"])
+        if not os.path.exists (path):
+            problems.append ("%s: missing" % path)
+        elif freepcb2pretty.file_hash (path) != entry["output"]:
+            problems.append ("%s: modified" % path)
+
+    if os.path.isdir (outdir):
+        for i in sorted (os.listdir (outdir)):
+            if i.endswith (".kicad_mod") and i not in expected:
+                problems.append ("%s: not in manifest" %
+                        os.path.join (outdir, i))
+    return problems
+
+def check_archive (manifest, path):
+    """check_outputs, for an archive. Returns a list of problems."""
+    hashes = archive_hashes (path)
+    problems = []
+    expected = set ()
+    for name, entry in sorted (manifest["footprints"].items ()):
+        expected.add (entry["file"])
+        if entry["file"] not in hashes:
+            problems.append ("%s: %s: missing" % (path, entry["file"]))
+        elif hashes[entry["file"]] != entry["output"]:
+            problems.append ("%s: %s: modified" % (path, entry["file"]))
+    for i in sorted (set (hashes) - expected):
+        problems.append ("%s: %s: not in manifest" % (path, i))
+    return problems
+
+def verify (path, outputs_only=False, quick=False):
+    """Verify one manifest, printing what is stale. Returns True if the
+    library is up to date.
+    """
+
+    if not os.path.exists (path):
+        print ("%s: no manifest; run 'make ipc' first" % path)
+        return False
+    manifest = load_manifest (path)
+    args = freepcb2pretty.parse_args (manifest["args"])
+
+    if outputs_only:
+        problems = check_outputs (manifest, args)
+        for i in problems:
+            print ("%s: %s" % (path, i))
+        return not problems
+
+    changed, new_sources, problems = changed_entries (manifest, args)
+    for i in problems:
+        print ("%s: %s" % (path, i))
+    for i in new_sources:
+        print ("%s: new source %s" % (path, i))
+
+    if quick or not changed and not new_sources:
+        for name in sorted (changed):
+            print ("%s: %s: inputs changed (%s)" % (path, name,
+                ", ".join (changed[name])))
+        return not (changed or new_sources or problems)
+
+    if not args.hashtime:
+        print ("%s: converted without --hash-time, so outputs can't be "
+                "reproduced; %d footprints have changed inputs"
+                % (path, len (changed)))
+        return False
+
+    footprints = manifest["footprints"]
+    outdir = freepcb2pretty.output_targets (args)[0][1]
+    archive = None
+    if freepcb2pretty.archive_suffix (outdir) is not None:
+        archive = archive_hashes (outdir)
+    sources = set (new_sources)
+    sources.update (footprints[i]["source"] for i in changed)
+    rebuilt = rebuild (manifest, args, sources)
+
+    stale = []
+    for name in sorted (set (changed) | set (rebuilt)):
+        if name not in rebuilt:
+            if name in changed:
+                stale.append ("%s: removed" % name)
+            continue
+        filename, output = rebuilt[name]
+        disk = os.path.join (outdir, filename)
+        if archive is not None:
+            current = archive.get (filename)
+        elif os.path.exists (disk):
+            current = freepcb2pretty.file_hash (disk)
+        else:
+            current = None
+        if current is None:
+            stale.append ("%s: missing from %s" % (name, outdir))
+        elif current != output:
+            reasons = changed.get (name, ["new"])
+            stale.append ("%s: stale (%s)" % (name, ", ".join (reasons)))
+
+    for i in stale:
+        print ("%s: %s" % (path, i))
+    return not (stale or problems)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Check generated libraries against freepcb2pretty manifests."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    sub = p.add_subparsers (dest="command")
+    sub.required = True
+
+    verifyp = sub.add_parser ("verify", help="Check whether libraries are stale")
+    verifyp.add_argument ("manifests", metavar="MANIFEST", type=str, nargs="+")
+    modep = verifyp.add_mutually_exclusive_group ()
+    modep.add_argument ("--outputs", dest="outputs_only", action="store_const",
+            const=True, default=False,
+            help="Only re-hash the output files against the manifest")
+    modep.add_argument ("--quick", dest="quick", action="store_const",
+            const=True, default=False,
+            help="Report changed inputs without reconverting anything")
+    args = p.parse_args ()
+
+    ok = True
+    for i in args.manifests:
+        if verify (i, args.outputs_only, args.quick):
+            print ("%s: up to date" % i)
+        else:
+            ok = False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit (main ())
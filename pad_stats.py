@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# pad_stats
+
+# CC0 1.0 Universal
+
+# This script reports copper and paste areas of footprints, for stencil and
+# assembly planning: per footprint, the pad counts, front and back copper
+# area, paste area and paste-to-copper ratio; per library, the totals and a
+# histogram of pad counts; and, given several libraries (the IPC7351
+# Least/Nominal/Most variants), the areas of each footprint side by side.
+#
+# Each library can be a .pretty directory or a FreePCB zip. Zips are loaded
+# through Library, and their pins turned into pads by Pin.kicad_sexp, so the
+# shapes and sizes are those freepcb2pretty would write (with its default
+# options). Every pad of every library goes into one set of NumPy arrays
+# (shape, size, corner ratio, drill, layers, paste margin), and the areas are
+# computed on the arrays in one pass, then summed per footprint with
+# bincount. Only the pads of a .kicad_mod file are parsed, not the whole
+# file, and pads differing only in name and position are parsed once.
+#
+# Areas are in mm^2. Copper area is the pad minus its drill. Paste area
+# applies solder_paste_margin and the paste ratio, from the pad or else from
+# the footprint. Trapezoid and custom pads are taken as their bounding
+# rectangle.
+#
+# Output (in OUTDIR):
+#   footprints.csv      one row per footprint
+#   libraries.csv       one row per library
+#   histogram.csv       footprints per pad count, one column per library
+#   compare.csv         copper and paste area per footprint and library
+#                       (with more than one library)
+#   footprints.npz      the footprint table as NumPy columns (with --npz)
+#
+# Examples:
+#   pad_stats.py stats IPC7351-Least.pretty IPC7351-Nominal.pretty IPC7351-Most.pretty
+#   pad_stats.py --npz stats IPC7351-Nominal_v2.zip
+
+import io
+import os
+import re
+import sys
+import csv
+import math
+import zipfile
+
+import freepcb2pretty
+from freepcb2pretty import SexpLoads, sexp_child, find_footprints
+
+VERSION = "1.0"
+
+# Default roundrect corner ratio, as in KiCad
+RRATIO = 0.25
+
+# Shape codes in the pad arrays
+SHAPES = {"rect": 0, "circle": 1, "oval": 2, "roundrect": 3,
+        "trapezoid": 4, "custom": 5}
+
+# Columns of a pad row
+PAD_COLUMNS = ("footprint", "shape", "w", "h", "rratio", "drill_w", "drill_h",
+        "front", "back", "paste", "margin", "ratio", "smd")
+
+# The start of a pad, or of a footprint's own paste settings
+PAD_START = re.compile (r"\(pad[\s)]")
+MODULE_PASTE = re.compile (r"\((solder_paste_margin|solder_paste_ratio)\s+([-+0-9.eE]+)\)")
+TOKEN = re.compile (r'[()]|"(?:[^"\\]|\\.)*"')
+
+# The parts of a pad that don't change its row: its name and position
+PAD_PLACE = re.compile (r'^\(pad\s+(?:"(?:[^"\\]|\\.)*"|[^\s()]+)|\(at\s[^()]*\)')
+
+# Pad text without name and position: pad row. Most pads of a library share
+# a handful of sizes, so most are never parsed.
+PAD_ROWS = {}
+
+def library_name (path):
+    name = os.path.basename (os.path.normpath (path))
+    for ext in (".pretty", ".zip"):
+        if name.endswith (ext):
+            name = name[:-len (ext)]
+    return name
+
+def split_pads (text):
+    """Return the text of the (pad ...) expressions of a footprint, and the
+    rest of the text.
+    """
+    pads = []
+    rest = []
+    pos = 0
+    while True:
+        m = PAD_START.search (text, pos)
+        if m is None:
+            break
+        start = m.start ()
+        depth = 0
+        for t in TOKEN.finditer (text, start):
+            if t.group () == "(":
+                depth += 1
+            elif t.group () == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+        end = t.end ()
+        rest.append (text[pos:start])
+        pads.append (text[start:end])
+        pos = end
+    rest.append (text[pos:])
+    return pads, "".join (rest)
+
+def number (node, name, default):
+    child = sexp_child (node, name)
+    return float (child[1]) if child is not None else default
+
+def pad_row (node, index):
+    """Reduce a (pad ...) node to a pad row. Paste margin and ratio are NaN
+    where the pad leaves them to the footprint.
+    """
+    kind = str (node[2])
+    shape = SHAPES.get (str (node[3]), SHAPES["rect"])
+    size = sexp_child (node, "size")
+    w, h = float (size[1]), float (size[2])
+    if shape == SHAPES["circle"]:
+        h = w
+
+    drill_w = drill_h = 0.
+    drill = sexp_child (node, "drill")
+    if drill is not None:
+        values = [float (i) for i in drill[1:] if isinstance (i, (int, float))]
+        if values:
+            drill_w = values[0]
+            drill_h = values[1] if len (values) > 1 else values[0]
+
+    layers = sexp_child (node, "layers")
+    layers = [str (i) for i in layers[1:]] if layers is not None else []
+    front = "F.Cu" in layers or "*.Cu" in layers
+    back = "B.Cu" in layers or "*.Cu" in layers
+    paste = any (i.endswith (".Paste") for i in layers)
+    if kind == "np_thru_hole":
+        front = back = paste = False
+
+    return (index, shape, w, h, number (node, "roundrect_rratio", RRATIO),
+            drill_w, drill_h, front, back, paste,
+            number (node, "solder_paste_margin", float ("nan")),
+            number (node, "solder_paste_margin_ratio", float ("nan")),
+            kind == "smd")
+
+def load_kicad_mod (path):
+    """Load the pads of one .kicad_mod file. Return (name, paste margin,
+    paste ratio, [pad row, ...]), with -1 for the footprint index.
+    """
+    with io.open (path, encoding="utf8") as f:
+        text = f.read ()
+    pads, rest = split_pads (text)
+    settings = dict (MODULE_PASTE.findall (rest))
+    rows = []
+    for i in pads:
+        key = PAD_PLACE.sub ("", i)
+        row = PAD_ROWS.get (key)
+        if row is None:
+            row = PAD_ROWS[key] = pad_row (SexpLoads (i), -1)
+        rows.append (row)
+    name = os.path.basename (path)[:-len (".kicad_mod")]
+    return (name, float (settings.get ("solder_paste_margin", 0.)),
+            float (settings.get ("solder_paste_ratio", 0.)), rows)
+
+def load_pretty (path, pool=None):
+    files = find_footprints ([path])
+    if pool is None:
+        return list (map (load_kicad_mod, files))
+    return list (pool.imap (load_kicad_mod, files, chunksize=32))
+
+def load_zip (path):
+    """Load the pads of a FreePCB zip, through Pin.kicad_sexp. Names have
+    their L/M/N suffix stripped, as in the .pretty libraries.
+    """
+    opts = freepcb2pretty.parse_args (["--strip-lmn", "unused"])
+    with zipfile.ZipFile (path) as zf:
+        library = freepcb2pretty.load_zip (zf, opts)
+    library.strip_lmn ()
+    footprints = []
+    for module in library.Modules:
+        rows = []
+        for pin in module.pins ():
+            for node in pin.kicad_sexp ():
+                rows.append (pad_row (node, -1))
+        footprints.append ((module.Name, 0., 0., rows))
+    return footprints
+
+def load_library (path, pool=None):
+    if os.path.isdir (path):
+        return load_pretty (path, pool)
+    return load_zip (path)
+
+class PadTable (object):
+    """The pads of several libraries as NumPy arrays, with one entry per
+    footprint in 'libraries', 'names', 'margin' and 'ratio'.
+    """
+
+    def __init__ (self, libraries):
+        """'libraries' is a list of (library name, footprints), as returned
+        by load_library.
+        """
+        import numpy
+
+        self.library_names = [i[0] for i in libraries]
+        library, names, margin, ratio, rows = [], [], [], [], []
+        for column, (_, footprints) in enumerate (libraries):
+            for name, fp_margin, fp_ratio, pads in footprints:
+                index = len (names)
+                library.append (column)
+                names.append (name)
+                margin.append (fp_margin)
+                ratio.append (fp_ratio)
+                rows.extend ((index,) + i[1:] for i in pads)
+
+        self.library = numpy.array (library, dtype=numpy.int32)
+        self.names = names
+        self.margin = numpy.array (margin, dtype=float)
+        self.ratio = numpy.array (ratio, dtype=float)
+
+        if rows:
+            pads = numpy.array (rows, dtype=float)
+        else:
+            pads = numpy.zeros ((0, len (PAD_COLUMNS)))
+        self.pads = dict ((name, pads[:, i])
+                for i, name in enumerate (PAD_COLUMNS))
+        self.pads["footprint"] = self.pads["footprint"].astype (numpy.int64)
+        self.pads["shape"] = self.pads["shape"].astype (numpy.int32)
+        for i in ("front", "back", "paste", "smd"):
+            self.pads[i] = self.pads[i].astype (bool)
+
+    def __len__ (self):
+        return len (self.names)
+
+    def areas (self):
+        """Return (copper area, paste area) per pad."""
+        import numpy
+
+        p = self.pads
+        w, h, shape = p["w"], p["h"], p["shape"]
+        short = numpy.minimum (w, h)
+
+        # Every shape is a rectangle with rounded corners of some radius
+        radius = numpy.zeros_like (w)
+        round_ends = (shape == SHAPES["circle"]) | (shape == SHAPES["oval"])
+        radius[round_ends] = short[round_ends] / 2
+        rr = shape == SHAPES["roundrect"]
+        radius[rr] = numpy.minimum (short[rr] * p["rratio"][rr], short[rr] / 2)
+
+        def rounded (w, h, r):
+            return w * h - (4 - math.pi) * r * r
+
+        # Drills are slots: a rectangle with fully rounded ends
+        drill = rounded (p["drill_w"], p["drill_h"],
+                numpy.minimum (p["drill_w"], p["drill_h"]) / 2)
+        copper = numpy.maximum (rounded (w, h, radius) - drill, 0.)
+
+        # Paste settings of the pad, else of its footprint
+        fp = p["footprint"]
+        margin = numpy.where (numpy.isnan (p["margin"]), self.margin[fp],
+                p["margin"])
+        ratio = numpy.where (numpy.isnan (p["ratio"]), self.ratio[fp],
+                p["ratio"])
+        # The ratio scales each side by its own length, as in KiCad
+        grow_w = margin + ratio * w
+        grow_h = margin + ratio * h
+        pw = numpy.maximum (w + 2 * grow_w, 0.)
+        ph = numpy.maximum (h + 2 * grow_h, 0.)
+        # Round ends stay round; corners move with the side that moves least
+        pr = numpy.where (radius > 0, numpy.clip (radius +
+            numpy.minimum (grow_w, grow_h), 0., numpy.minimum (pw, ph) / 2), 0.)
+        pr[round_ends] = numpy.minimum (pw, ph)[round_ends] / 2
+        paste = numpy.where (p["paste"], rounded (pw, ph, pr), 0.)
+        return copper, paste
+
+    def footprint_stats (self):
+        """Return a dict of NumPy columns, one entry per footprint."""
+        import numpy
+
+        p = self.pads
+        n = len (self)
+        fp = p["footprint"]
+        copper, paste = self.areas ()
+
+        def total (weights):
+            return numpy.bincount (fp, weights=weights, minlength=n)
+
+        pads = numpy.bincount (fp, minlength=n)
+        copper_front = total (numpy.where (p["front"], copper, 0.))
+        paste_area = total (paste)
+        with numpy.errstate (invalid="ignore", divide="ignore"):
+            paste_ratio = numpy.where (copper_front > 0,
+                    paste_area / copper_front, numpy.nan)
+
+        # Smallest and largest copper pad of each footprint
+        big = numpy.full (n, numpy.nan)
+        small = numpy.full (n, numpy.nan)
+        if len (fp):
+            order = numpy.lexsort ((copper, fp))
+            starts = numpy.flatnonzero (numpy.r_[True, fp[order][1:] != fp[order][:-1]])
+            ends = numpy.r_[starts[1:], len (order)] - 1
+            small[fp[order][starts]] = copper[order][starts]
+            big[fp[order][ends]] = copper[order][ends]
+
+        return {
+            "library": self.library,
+            "pads": pads,
+            "smd_pads": numpy.bincount (fp, weights=p["smd"], minlength=n).astype (int),
+            "th_pads": numpy.bincount (fp, weights=p["drill_w"] > 0, minlength=n).astype (int),
+            "copper_front": copper_front,
+            "copper_back": total (numpy.where (p["back"], copper, 0.)),
+            "paste": paste_area,
+            "paste_ratio": paste_ratio,
+            "min_pad": small,
+            "max_pad": big,
+        }
+
+def cell (value):
+    """Format a number for CSV: integers as such, NaN as empty."""
+    if isinstance (value, float):
+        if math.isnan (value):
+            return ""
+        return "%.6g" % value
+    return str (value)
+
+def write_csv (path, header, rows):
+    with open (path, "w") as f:
+        writer = csv.writer (f, lineterminator="\n")
+        writer.writerow (header)
+        for row in rows:
+            writer.writerow ([cell (i) for i in row])
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Report copper and paste areas per footprint and library."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("outdir", metavar="OUTDIR", type=str,
+            help="Directory for the CSV files")
+    p.add_argument ("libraries", metavar="LIBRARY", type=str, nargs="+",
+            help=".pretty directories or FreePCB zips")
+    p.add_argument ("--npz", dest="npz", action="store_const",
+            const=True, default=False,
+            help="Also write the footprint table as NumPy columns")
+    p.add_argument ("-j", "--jobs", dest="jobs", type=int, default=None,
+            help="Worker processes for .pretty directories (default: one per CPU)")
+    args = p.parse_args ()
+
+    try:
+        import numpy
+    except ImportError:
+        raise Exception ("pad_stats.py needs numpy")
+
+    names = [library_name (i) for i in args.libraries]
+    if len (set (names)) != len (names):
+        raise Exception ("two libraries with the same name")
+
+    pool = None
+    if args.jobs != 1 and any (os.path.isdir (i) for i in args.libraries):
+        import multiprocessing
+        pool = multiprocessing.Pool (args.jobs)
+    libraries = [(name, load_library (path, pool))
+            for name, path in zip (names, args.libraries)]
+    if pool is not None:
+        pool.close ()
+        pool.join ()
+
+    table = PadTable (libraries)
+    stats = table.footprint_stats ()
+    if not os.path.isdir (args.outdir):
+        os.makedirs (args.outdir)
+
+    columns = ["pads", "smd_pads", "th_pads", "copper_front", "copper_back",
+            "paste", "paste_ratio", "min_pad", "max_pad"]
+    write_csv (os.path.join (args.outdir, "footprints.csv"),
+            ["library", "footprint"] + columns,
+            ([names[stats["library"][i]], table.names[i]] +
+                [stats[c][i] for c in columns] for i in range (len (table))))
+
+    library = stats["library"]
+    rows = []
+    for column, name in enumerate (names):
+        mine = library == column
+        copper = stats["copper_front"][mine].sum ()
+        paste = stats["paste"][mine].sum ()
+        ratios = stats["paste_ratio"][mine]
+        ratios = ratios[~numpy.isnan (ratios)]
+        rows.append ([name, int (mine.sum ()), int (stats["pads"][mine].sum ()),
+            copper, stats["copper_back"][mine].sum (), paste,
+            paste / copper if copper else float ("nan"),
+            float (numpy.median (ratios)) if len (ratios) else float ("nan")])
+    write_csv (os.path.join (args.outdir, "libraries.csv"),
+            ["library", "footprints", "pads", "copper_front", "copper_back",
+                "paste", "paste_ratio", "median_paste_ratio"], rows)
+
+    # Footprints per pad count, one column per library
+    counts = numpy.zeros ((int (stats["pads"].max (initial=0)) + 1, len (names)),
+            dtype=int)
+    numpy.add.at (counts, (stats["pads"], library), 1)
+    used = numpy.flatnonzero (counts.any (axis=1))
+    write_csv (os.path.join (args.outdir, "histogram.csv"), ["pads"] + names,
+            ([int (i)] + [int (j) for j in counts[i]] for i in used))
+
+    if len (names) > 1:
+        # One row per footprint name, copper and paste per library
+        index = {}
+        for i, name in enumerate (table.names):
+            index.setdefault (name, [None] * len (names))[library[i]] = i
+        header = ["footprint"]
+        for name in names:
+            header += ["%s copper" % name, "%s paste" % name]
+        rows = []
+        for fpname in sorted (index):
+            row = [fpname]
+            for i in index[fpname]:
+                if i is None:
+                    row += ["", ""]
+                else:
+                    row += [stats["copper_front"][i], stats["paste"][i]]
+            rows.append (row)
+        write_csv (os.path.join (args.outdir, "compare.csv"), header, rows)
+
+    if args.npz:
+        numpy.savez_compressed (os.path.join (args.outdir, "footprints.npz"),
+                footprint=numpy.array (table.names),
+                library_names=numpy.array (names), **stats)
+
+    print ("%d libraries, %d footprints, %d pads" % (len (names), len (table),
+        len (table.pads["footprint"])))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
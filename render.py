@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# render
+
+# CC0 1.0 Universal
+
+# This script draws thumbnails of the footprints in .pretty directories, and
+# a contact sheet of them per library, for looking over a library by eye.
+# Each footprint is drawn to SVG: courtyard, fabrication and silk lines and
+# arcs, pads with their drills, and a mark at each text anchor.
+#
+# Images are cached by the hash of what is drawn, not of the file, so a
+# change that doesn't touch the drawing (a new 3D model, a new timestamp)
+# draws nothing, and footprints that look the same share one image (so the
+# images carry no names; the contact sheets do). The file hash of every
+# footprint is kept in OUTDIR/render-index.json, so an unchanged file isn't
+# even parsed; after a small config change only the footprints it touched
+# are drawn again. Footprints are parsed and drawn in a pool of processes.
+#
+# With --png, a PNG is made next to each SVG. This needs cairosvg, which is
+# imported only then.
+#
+# Output:
+#   OUTDIR/index.html           list of libraries
+#   OUTDIR/LIBRARY.html         contact sheet of one library
+#   OUTDIR/images/HASH.svg      thumbnails (and HASH.png with --png)
+#   OUTDIR/render-index.json    file hashes, for the next run
+#
+# Examples:
+#   render.py thumbs IPC7351-Nominal.pretty
+#   render.py --png --jobs 4 thumbs *.pretty
+
+import os
+import sys
+import json
+import math
+import hashlib
+import tempfile
+import multiprocessing
+
+from freepcb2pretty import SexpLoads, sexp_child, find_footprints, arc_through
+
+VERSION = "1.0"
+
+# Bump when the drawing changes, to invalidate cached images
+RENDER_VERSION = 1
+
+INDEX_NAME = "render-index.json"
+IMAGES = "images"
+
+# Default roundrect corner ratio, as in KiCad
+RRATIO = 0.25
+
+# Margin around the drawing (mm)
+MARGIN = 0.5
+
+# Size of a text anchor mark (mm)
+ANCHOR = 0.4
+
+BACKGROUND = "#001023"
+
+# Drawing order and colour of the graphic layers
+LAYER_COLORS = [
+    ("F.CrtYd", "#ff26e2"),
+    ("B.CrtYd", "#26e9ff"),
+    ("F.Fab", "#afafaf"),
+    ("B.Fab", "#585d84"),
+    ("F.SilkS", "#f2eda1"),
+    ("B.SilkS", "#e800c5"),
+]
+
+PAD_COLORS = {"F.Cu": "#c83434", "B.Cu": "#4d7fc4"}
+DRILL_COLOR = "#e3b72e"
+
+def fmt (value):
+    """Format a coordinate for SVG."""
+    text = "%.4f" % value
+    text = text.rstrip ("0").rstrip (".")
+    return "0" if text == "-0" else text
+
+def escape (text):
+    return text.replace ("&", "&amp;").replace ("<", "&lt;") \
+            .replace (">", "&gt;").replace ('"', "&quot;")
+
+def node_point (node, name):
+    at = sexp_child (node, name)
+    if at is None:
+        return None
+    return (float (at[1]), float (at[2]))
+
+def node_width (node):
+    """Line width of a graphic item, old style or new."""
+    width = sexp_child (node, "width")
+    if width is None:
+        stroke = sexp_child (node, "stroke")
+        if stroke is not None:
+            width = sexp_child (stroke, "width")
+    return float (width[1]) if width is not None else 0.
+
+def node_layer (node):
+    layer = sexp_child (node, "layer")
+    return str (layer[1]) if layer is not None else None
+
+def primitives (sexp):
+    """Reduce a footprint to the things that are drawn, as a list of tuples
+    of plain values. This is what images are cached by.
+    """
+
+    items = []
+    for node in sexp[1:]:
+        if not isinstance (node, list) or not node:
+            continue
+        head = str (node[0])
+        if head == "fp_line":
+            start, end = node_point (node, "start"), node_point (node, "end")
+            if start is None or end is None:
+                continue
+            items.append (("line", node_layer (node), start, end,
+                node_width (node)))
+        elif head == "fp_arc":
+            start, end = node_point (node, "start"), node_point (node, "end")
+            mid = node_point (node, "mid")
+            angle = sexp_child (node, "angle")
+            if mid is not None:
+                arc = arc_through (start, mid, end)
+                if arc is None:
+                    items.append (("line", node_layer (node), start, end,
+                        node_width (node)))
+                    continue
+                center, sweep = arc
+            elif angle is not None:
+                # Old style: start is the centre, end the start point
+                center, start, sweep = start, end, float (angle[1])
+            else:
+                continue
+            items.append (("arc", node_layer (node), center, start, sweep,
+                node_width (node)))
+        elif head == "fp_circle":
+            center, end = node_point (node, "center"), node_point (node, "end")
+            if center is None or end is None:
+                continue
+            items.append (("arc", node_layer (node), center, end, 360.,
+                node_width (node)))
+        elif head == "fp_text":
+            at = node_point (node, "at")
+            if at is not None and len (node) > 2:
+                items.append (("text", str (node[1]), at))
+        elif head == "pad":
+            at = sexp_child (node, "at")
+            size = sexp_child (node, "size")
+            if len (node) < 4 or at is None or size is None:
+                continue
+            angle = float (at[3]) if len (at) > 3 else 0.
+            layers = sexp_child (node, "layers")
+            layers = [str (i) for i in layers[1:]] if layers is not None else []
+            drill = sexp_child (node, "drill")
+            hole = None
+            if drill is not None:
+                values = [float (i) for i in drill[1:]
+                        if isinstance (i, (int, float))]
+                if len (values) == 1:
+                    hole = (values[0], values[0])
+                elif len (values) >= 2:
+                    hole = (values[0], values[1])
+            ratio = sexp_child (node, "roundrect_rratio")
+            ratio = float (ratio[1]) if ratio is not None else RRATIO
+            items.append (("pad", str (node[3]), (float (at[1]), float (at[2])),
+                angle, (float (size[1]), float (size[2])), ratio, hole,
+                "F.Cu" in layers or "*.Cu" in layers))
+    return items
+
+def image_hash (items):
+    text = "%d\n%r" % (RENDER_VERSION, items)
+    return hashlib.sha1 (text.encode ("utf8")).hexdigest ()
+
+def extent (items):
+    """Return the (left, top, right, bottom) box of the drawing."""
+    xs, ys = [], []
+    for item in items:
+        kind = item[0]
+        if kind == "line":
+            for x, y in item[2:4]:
+                xs.append (x)
+                ys.append (y)
+        elif kind == "arc":
+            (cx, cy), (sx, sy) = item[2], item[3]
+            r = math.hypot (sx - cx, sy - cy)
+            xs.extend ((cx - r, cx + r))
+            ys.extend ((cy - r, cy + r))
+        elif kind == "text":
+            xs.append (item[2][0])
+            ys.append (item[2][1])
+        elif kind == "pad":
+            (x, y), (w, h) = item[2], item[4]
+            r = math.hypot (w, h) / 2
+            xs.extend ((x - r, x + r))
+            ys.extend ((y - r, y + r))
+    if not xs:
+        return (-1., -1., 1., 1.)
+    return (min (xs), min (ys), max (xs), max (ys))
+
+def svg_arc (item, color):
+    _, _, (cx, cy), (sx, sy), sweep, width = item
+    r = math.hypot (sx - cx, sy - cy)
+    stroke = 'fill="none" stroke="%s" stroke-width="%s" stroke-linecap="round"' % \
+            (color, fmt (width))
+    if abs (sweep) >= 360:
+        return '<circle cx="%s" cy="%s" r="%s" %s/>' % (fmt (cx), fmt (cy),
+                fmt (r), stroke)
+    theta = math.radians (sweep)
+    dx, dy = sx - cx, sy - cy
+    ex = cx + dx * math.cos (theta) - dy * math.sin (theta)
+    ey = cy + dx * math.sin (theta) + dy * math.cos (theta)
+    return '<path d="M%s %s A%s %s 0 %d %d %s %s" %s/>' % (fmt (sx), fmt (sy),
+            fmt (r), fmt (r), abs (sweep) > 180, sweep > 0, fmt (ex), fmt (ey),
+            stroke)
+
+def svg_pad (item):
+    _, shape, (x, y), angle, (w, h), ratio, hole, front = item
+    color = PAD_COLORS["F.Cu" if front else "B.Cu"]
+    out = []
+    transform = ' transform="translate(%s %s)%s"' % (fmt (x), fmt (y),
+            " rotate(%s)" % fmt (-angle) if angle else "")
+    if shape == "circle":
+        out.append ('<circle r="%s" fill="%s"%s/>' % (fmt (w / 2), color,
+            transform))
+    else:
+        if shape == "oval":
+            r = min (w, h) / 2
+        elif shape == "roundrect":
+            r = min (w, h) * ratio
+        else:
+            r = 0.
+        out.append ('<rect x="%s" y="%s" width="%s" height="%s"%s fill="%s"%s/>' %
+                (fmt (-w / 2), fmt (-h / 2), fmt (w), fmt (h),
+                    ' rx="%s"' % fmt (r) if r else "", color, transform))
+    if hole is not None:
+        hw, hh = hole
+        out.append ('<rect x="%s" y="%s" width="%s" height="%s" rx="%s" fill="%s"%s/>' %
+                (fmt (-hw / 2), fmt (-hh / 2), fmt (hw), fmt (hh),
+                    fmt (min (hw, hh) / 2), DRILL_COLOR, transform))
+    return out
+
+def render_svg (items, size):
+    """Draw a footprint as an SVG document 'size' pixels across."""
+    left, top, right, bottom = extent (items)
+    left -= MARGIN
+    top -= MARGIN
+    width = right - left + MARGIN
+    height = bottom - top + MARGIN
+    scale = size / max (width, height)
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+            'viewBox="%s %s %s %s">' % (int (math.ceil (width * scale)),
+                int (math.ceil (height * scale)), fmt (left), fmt (top),
+                fmt (width), fmt (height)),
+        '<rect x="%s" y="%s" width="%s" height="%s" fill="%s"/>' %
+            (fmt (left), fmt (top), fmt (width), fmt (height), BACKGROUND)]
+
+    # Lines and arcs of the lower layers, then pads, then silk on top
+    for layer, color in LAYER_COLORS:
+        if layer.endswith (".SilkS"):
+            continue
+        out.extend (svg_graphic (items, layer, color))
+    for item in items:
+        if item[0] == "pad":
+            out.extend (svg_pad (item))
+    for layer, color in LAYER_COLORS:
+        if layer.endswith (".SilkS"):
+            out.extend (svg_graphic (items, layer, color))
+
+    for item in items:
+        if item[0] == "text":
+            x, y = item[2]
+            out.append ('<path d="M%s %sh%sM%s %sv%s" stroke="#ffffff" '
+                    'stroke-width="0.05"><title>%s</title></path>' %
+                    (fmt (x - ANCHOR / 2), fmt (y), fmt (ANCHOR),
+                        fmt (x), fmt (y - ANCHOR / 2), fmt (ANCHOR),
+                        escape (item[1])))
+    out.append ('</svg>')
+    return "\n".join (out) + "\n"
+
+def svg_graphic (items, layer, color):
+    out = []
+    for item in items:
+        if item[0] not in ("line", "arc") or item[1] != layer:
+            continue
+        if item[0] == "arc":
+            out.append (svg_arc (item, color))
+        else:
+            (x0, y0), (x1, y1), width = item[2], item[3], item[4]
+            out.append ('<line x1="%s" y1="%s" x2="%s" y2="%s" stroke="%s" '
+                    'stroke-width="%s" stroke-linecap="round"/>' %
+                    (fmt (x0), fmt (y0), fmt (x1), fmt (y1), color,
+                        fmt (width)))
+    return out
+
+# Files are written through mkstemp, which makes them private; they get the
+# permissions a plain open () would give instead
+UMASK = os.umask (0)
+os.umask (UMASK)
+
+def write_file (path, data):
+    """Write a file atomically. Images are named by their content, so
+    workers drawing the same one can race to write it; each writes its own
+    temporary file, and finding the image already there is success.
+    """
+    fd, temp = tempfile.mkstemp (dir=os.path.dirname (path),
+            prefix=os.path.basename (path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen (fd, 'wb') as f:
+            f.write (data)
+        os.chmod (temp, 0o666 & ~UMASK)
+        getattr (os, "replace", os.rename) (temp, path)
+    except OSError:
+        if os.path.exists (temp):
+            os.remove (temp)
+        if not os.path.exists (path):
+            raise
+
+def rasterize (svg, path):
+    try:
+        import cairosvg
+    except ImportError:
+        raise Exception ("--png needs cairosvg")
+    write_file (path, cairosvg.svg2png (bytestring=svg.encode ("utf8")))
+
+def render_file (work):
+    """Parse a footprint and draw it unless its image exists. Runs in the
+    pool; returns (filename, file hash, image hash, drawn).
+    """
+    filename, data, file_sha, images, size, png = work
+    items = primitives (SexpLoads (data.decode ("utf8")))
+    key = image_hash ((size, items))
+    svg_path = os.path.join (images, key + ".svg")
+    png_path = os.path.join (images, key + ".png")
+    drawn = False
+    if not os.path.exists (svg_path) or (png and not os.path.exists (png_path)):
+        svg = render_svg (items, size)
+        write_file (svg_path, svg.encode ("utf8"))
+        if png:
+            rasterize (svg, png_path)
+        drawn = True
+    return filename, file_sha, key, drawn
+
+def library_name (path):
+    name = os.path.basename (os.path.normpath (path))
+    if name.endswith (".pretty"):
+        name = name[:-len (".pretty")]
+    return name
+
+def load_index (path):
+    try:
+        with open (path) as f:
+            index = json.load (f)
+    except (IOError, ValueError):
+        return {}
+    if index.get ("version") != RENDER_VERSION:
+        return {}
+    return index.get ("files", {})
+
+def contact_sheet (library, entries, png):
+    """HTML page of the thumbnails of one library. 'entries' is a list of
+    (footprint name, image hash).
+    """
+    ext = ".png" if png else ".svg"
+    out = ['<!DOCTYPE html>',
+        '<html><head><meta charset="utf-8"><title>%s</title>' % escape (library),
+        '<style>body{background:#222;color:#ddd;font-family:sans-serif}'
+        'figure{display:inline-block;margin:4px;text-align:center;'
+        'vertical-align:top;width:%dpx}'
+        'figcaption{font-size:11px;word-break:break-all}'
+        'img{max-width:100%%}</style>' % 200,
+        '</head><body>',
+        '<h1>%s</h1>' % escape (library),
+        '<p><a href="index.html">Libraries</a> &middot; %d footprints</p>' %
+            len (entries)]
+    for name, key in entries:
+        image = "%s/%s%s" % (IMAGES, key, ext)
+        out.append ('<figure><a href="%s/%s.svg"><img src="%s" alt="%s" '
+                'loading="lazy"></a><figcaption>%s</figcaption></figure>' %
+                (IMAGES, key, image, escape (name), escape (name)))
+    out.append ('</body></html>')
+    return "\n".join (out) + "\n"
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Draw footprint thumbnails and per-library contact sheets."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("outdir", metavar="OUTDIR", type=str,
+            help="Directory for the images and contact sheets")
+    p.add_argument ("libraries", metavar="DIR", type=str, nargs="+",
+            help=".pretty directories to draw")
+    p.add_argument ("--size", dest="size", type=int, default=200,
+            help="Thumbnail size in pixels (default: 200)")
+    p.add_argument ("--png", dest="png", action="store_const",
+            const=True, default=False,
+            help="Also make PNG thumbnails (needs cairosvg)")
+    p.add_argument ("--jobs", dest="jobs", type=int, default=None,
+            help="Number of processes (default: one per CPU)")
+    p.add_argument ("--quiet", dest="quiet", action="store_const",
+            const=True, default=False, help="Don't print a summary")
+    args = p.parse_args ()
+
+    if args.png:
+        try:
+            import cairosvg
+        except ImportError:
+            raise Exception ("--png needs cairosvg")
+
+    images = os.path.join (args.outdir, IMAGES)
+    if not os.path.isdir (images):
+        os.makedirs (images)
+    index_path = os.path.join (args.outdir, INDEX_NAME)
+    old = load_index (index_path)
+
+    libraries = []
+    names = set ()
+    for path in args.libraries:
+        if not os.path.isdir (path):
+            raise Exception ("%s: not a directory" % path)
+        library = library_name (path)
+        if library in names:
+            raise Exception ("two libraries named \"%s\"" % library)
+        names.add (library)
+        libraries.append ((library, find_footprints ([path])))
+
+    # Files whose content and image are unchanged skip the pool altogether
+    known = {}
+    work = []
+    ext = ".png" if args.png else ".svg"
+    for library, files in libraries:
+        for filename in files:
+            with open (filename, 'rb') as f:
+                data = f.read ()
+            file_sha = hashlib.sha1 (data).hexdigest ()
+            entry = old.get (filename)
+            if entry is not None and entry[0] == file_sha and \
+                    entry[2] == args.size and \
+                    os.path.exists (os.path.join (images, entry[1] + ext)):
+                known[filename] = entry
+            else:
+                work.append ((filename, data, file_sha, images, args.size,
+                    args.png))
+
+    drawn = 0
+    if work:
+        if args.jobs == 1 or len (work) < 64:
+            results = map (render_file, work)
+            pool = None
+        else:
+            pool = multiprocessing.Pool (args.jobs)
+            results = pool.imap_unordered (render_file, work, chunksize=16)
+        for filename, file_sha, key, new in results:
+            known[filename] = [file_sha, key, args.size]
+            drawn += new
+        if pool is not None:
+            pool.close ()
+            pool.join ()
+
+    sheets = []
+    for library, files in libraries:
+        entries = [(os.path.basename (i)[:-len (".kicad_mod")], known[i][1])
+                for i in files]
+        write_file (os.path.join (args.outdir, library + ".html"),
+                contact_sheet (library, entries, args.png).encode ("utf8"))
+        sheets.append ((library, len (entries)))
+
+    out = ['<!DOCTYPE html>',
+        '<html><head><meta charset="utf-8"><title>Footprint libraries</title>'
+        '</head><body>', '<h1>Footprint libraries</h1>', '<ul>']
+    for library, count in sorted (sheets):
+        out.append ('<li><a href="%s.html">%s</a> (%d)</li>' % (escape (library),
+            escape (library), count))
+    out.append ('</ul></body></html>')
+    write_file (os.path.join (args.outdir, "index.html"),
+            ("\n".join (out) + "\n").encode ("utf8"))
+
+    # Keep entries of libraries not drawn this time
+    old.update (known)
+    write_file (index_path, (json.dumps ({"version": RENDER_VERSION,
+        "files": old}, indent=1, sort_keys=True) + "\n").encode ("utf8"))
+
+    if not args.quiet:
+        print ("%d footprints, %d drawn, %d unchanged" % (len (known), drawn,
+            len (known) - drawn))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+#!/usr/bin/env python3
+
+# serve
+
+# CC0 1.0 Universal
+
+# This script serves footprints over HTTP, for tools that want a few
+# footprints without a copy of the whole library. It serves the .kicad_mod
+# files of .pretty directories, and converts footprints from FreePCB zips on
+# demand, through the same PCBmodule/kicad_sexp path as freepcb2pretty.
+#
+# Nothing is read at startup. The first request for a zip footprint scans
+# the zip for module names (a regex over the member text, without parsing)
+# to find the member holding it; that member alone is then parsed and
+# converted, and kept in memory. Emitted bodies are kept in an LRU cache
+# bounded by size, and every response carries an ETag (a hash of the body),
+# so clients can revalidate with If-None-Match. Requests are handled in
+# threads. The name scan is done once, under a lock for the zip; after that
+# a request only waits while the member it needs is being parsed, and
+# footprints of parsed members are served without waiting.
+#
+# URLs:
+#   /                                   libraries, as JSON
+#   /LIBRARY/                           footprint names, as JSON
+#   /LIBRARY/FOOTPRINT.kicad_mod        a footprint
+#   /LIBRARY/FOOTPRINT.kicad_mod?format=kicad7
+#                                       a converted footprint in another
+#                                       syntax (zip libraries only)
+#   /stats                              cache statistics, as JSON
+#
+# Libraries are named after the directory or zip, without .pretty or .zip.
+# Zip footprints are converted with --convert-args, which takes the same
+# options as freepcb2pretty; to match 'make ipc', pass the options it uses.
+#
+# Examples:
+#   serve.py
+#   serve.py --zip IPC7351-Nominal_v2.zip --convert-args "--strip-lmn --hash-time"
+
+import os
+import re
+import sys
+import json
+import shlex
+import hashlib
+import threading
+import zipfile
+import collections
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+try:
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+import freepcb2pretty
+
+VERSION = "1.0"
+
+EXTENSION = ".kicad_mod"
+
+# Module names in FreePCB library text
+MODULE_NAME = re.compile (r'^name: "?([^"\r\n]*)"?\s*$', re.MULTILINE)
+
+class LRUCache (object):
+    """A thread-safe cache of byte strings, evicting the least recently used
+    when over 'limit' bytes.
+    """
+
+    def __init__ (self, limit):
+        self.limit = limit
+        self.size = 0
+        self.items = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+        self.hits = 0
+        self.misses = 0
+
+    def get (self, key):
+        with self.lock:
+            value = self.items.pop (key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put (self, key, value):
+        with self.lock:
+            old = self.items.pop (key, None)
+            if old is not None:
+                self.size -= len (old[0])
+            if len (value[0]) > self.limit:
+                return
+            self.items[key] = value
+            self.size += len (value[0])
+            while self.size > self.limit:
+                _, evicted = self.items.popitem (last=False)
+                self.size -= len (evicted[0])
+
+    def stats (self):
+        with self.lock:
+            return {"entries": len (self.items), "bytes": self.size,
+                    "limit": self.limit, "hits": self.hits,
+                    "misses": self.misses}
+
+class PrettySource (object):
+    """Footprints from a .pretty directory, served as they are."""
+
+    kind = "pretty"
+
+    def __init__ (self, path):
+        self.path = path
+        self.name = os.path.basename (os.path.normpath (path))
+        if self.name.endswith (".pretty"):
+            self.name = self.name[:-len (".pretty")]
+
+    def names (self):
+        return sorted (i[:-len (EXTENSION)] for i in os.listdir (self.path)
+                if i.endswith (EXTENSION))
+
+    def get (self, name, fmt):
+        if fmt is not None:
+            raise ValueError ("only converted libraries have formats")
+        if "/" in name or name.startswith ("."):
+            return None
+        try:
+            with open (os.path.join (self.path, name + EXTENSION), 'rb') as f:
+                return f.read ()
+        except IOError:
+            return None
+
+class ZipSource (object):
+    """Footprints converted on demand from a FreePCB zip. Each member is
+    parsed on the first request for one of its footprints, and kept.
+    """
+
+    kind = "zip"
+
+    def __init__ (self, path, args):
+        self.path = path
+        self.args = args
+        self.name = os.path.basename (path)
+        if self.name.endswith (".zip"):
+            self.name = self.name[:-len (".zip")]
+        self.lock = threading.Lock ()
+        self.index = None
+        self.blocks = None
+        # member: {name: PCBmodule}
+        self.members = {}
+        # member: lock held while it is parsed
+        self.member_locks = {}
+
+    def output_name (self, name):
+        if self.args.strip_lmn and name and name[-1] in "LMNlmn":
+            return name[:-1]
+        return name
+
+    def load_index (self):
+        """Map every footprint name to its zip member."""
+        index = {}
+        with zipfile.ZipFile (self.path) as zf:
+            for info in zf.infolist ():
+                text = zf.read (info).decode ("utf8", "replace")
+                for i in MODULE_NAME.findall (text):
+                    index.setdefault (self.output_name (i), info.filename)
+        if self.args.threedmap is not None:
+            self.blocks = freepcb2pretty.read_3dmap (self.args.threedmap)
+        return index
+
+    def load_member (self, member):
+        """Parse and prepare one member, the way freepcb2pretty would."""
+        args = self.args
+        with zipfile.ZipFile (self.path) as zf:
+            library = freepcb2pretty.load_zip (zf, args, set ([member]))
+        if args.strip_lmn:
+            library.strip_lmn ()
+        if self.blocks is not None:
+            for i in library.Modules:
+                if i.Name in self.blocks:
+                    freepcb2pretty.apply_3dmap_entries (i, self.blocks[i.Name])
+        if args.courtyard is not None:
+            freepcb2pretty.add_courtyards (library.Modules, args)
+        modules = {}
+        for i in library.Modules:
+            if args.hashtime:
+                freepcb2pretty.set_hash_time (i)
+            modules[i.Name] = i
+        return modules
+
+    def get_index (self):
+        """The name index, built by the first request; requests arriving
+        meanwhile wait for it.
+        """
+        index = self.index
+        if index is None:
+            with self.lock:
+                if self.index is None:
+                    self.index = self.load_index ()
+                index = self.index
+        return index
+
+    def module (self, name):
+        member = self.get_index ().get (name)
+        if member is None:
+            return None
+        modules = self.members.get (member)
+        if modules is None:
+            with self.lock:
+                lock = self.member_locks.setdefault (member, threading.Lock ())
+            with lock:
+                modules = self.members.get (member)
+                if modules is None:
+                    modules = self.load_member (member)
+                    self.members[member] = modules
+        return modules.get (name)
+
+    def names (self):
+        return sorted (self.get_index ())
+
+    def get (self, name, fmt):
+        if fmt is None:
+            fmt = freepcb2pretty.output_targets (self.args)[0][0]
+        else:
+            fmt = freepcb2pretty.FORMATS.get (fmt)
+            if fmt is None:
+                raise ValueError ("unknown format")
+        module = self.module (name)
+        if module is None:
+            return None
+        return freepcb2pretty.module_text (module, fmt).encode ("utf8")
+
+class FootprintServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__ (self, address, sources, cache, quiet=False):
+        HTTPServer.__init__ (self, address, Handler)
+        self.sources = sources
+        self.cache = cache
+        self.quiet = quiet
+
+class Handler (BaseHTTPRequestHandler):
+    server_version = "serve.py/" + VERSION
+
+    def log_message (self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message (self, format, *args)
+
+    def send_body (self, body, content_type, etag=None):
+        self.send_response (200)
+        self.send_header ("Content-Type", content_type)
+        self.send_header ("Content-Length", str (len (body)))
+        if etag is not None:
+            self.send_header ("ETag", etag)
+        self.end_headers ()
+        if self.command != "HEAD":
+            self.wfile.write (body)
+
+    def send_json (self, value):
+        body = (json.dumps (value, indent=1, sort_keys=True) + "\n").encode ("utf8")
+        self.send_body (body, "application/json")
+
+    def do_HEAD (self):
+        self.do_GET ()
+
+    def do_GET (self):
+        url = urlparse (self.path)
+        parts = [unquote (i) for i in url.path.split ("/")[1:]]
+        sources = self.server.sources
+
+        if parts in ([], [""]):
+            return self.send_json ({"libraries": [{"name": i.name,
+                "kind": i.kind} for i in sorted (sources.values (),
+                    key=lambda i: i.name)]})
+        if parts == ["stats"]:
+            return self.send_json (self.server.cache.stats ())
+
+        source = sources.get (parts[0])
+        if source is None or len (parts) != 2:
+            return self.send_error (404)
+        if parts[1] == "":
+            return self.send_json (source.names ())
+        if not parts[1].endswith (EXTENSION):
+            return self.send_error (404)
+
+        name = parts[1][:-len (EXTENSION)]
+        fmt = parse_qs (url.query).get ("format", [None])[0]
+        key = (source.name, name, fmt)
+        cached = self.server.cache.get (key)
+        if cached is None:
+            try:
+                body = source.get (name, fmt)
+            except ValueError as e:
+                return self.send_error (400, str (e))
+            if body is None:
+                return self.send_error (404)
+            cached = (body, '"%s"' % hashlib.sha1 (body).hexdigest ())
+            self.server.cache.put (key, cached)
+
+        body, etag = cached
+        if self.headers.get ("If-None-Match") == etag:
+            self.send_response (304)
+            self.send_header ("ETag", etag)
+            self.end_headers ()
+            return
+        self.send_body (body, "text/plain; charset=utf-8", etag)
+
+def main ():
+    from argparse import ArgumentParser
+    description = "Serve footprints over HTTP, converting FreePCB zips on demand."
+    p = ArgumentParser (description=description)
+    p.add_argument ("-v", "--version", action="version",
+            version="%(prog)s " + VERSION)
+    p.add_argument ("--bind", dest="bind", type=str, default="127.0.0.1",
+            help="Address to listen on (default: 127.0.0.1)")
+    p.add_argument ("--port", dest="port", type=int, default=8000,
+            help="Port to listen on (default: 8000)")
+    p.add_argument ("--pretty", dest="pretty", type=str, action="append",
+            default=[], metavar="DIR",
+            help="Serve a .pretty directory (default: all in the current directory)")
+    p.add_argument ("--zip", dest="zips", type=str, action="append",
+            default=[], metavar="ZIP",
+            help="Serve a FreePCB zip, converted on demand (default: all in the current directory)")
+    p.add_argument ("--convert-args", dest="convert_args", type=str, default="",
+            help="freepcb2pretty options for converting zip footprints")
+    p.add_argument ("--cache-mb", dest="cache_mb", type=float, default=64.,
+            help="Size of the cache of served footprints (default: 64 MB)")
+    p.add_argument ("--quiet", dest="quiet", action="store_const",
+            const=True, default=False, help="Don't log requests")
+    args = p.parse_args ()
+
+    if not args.pretty and not args.zips:
+        for i in sorted (os.listdir (".")):
+            if i.endswith (".pretty") and os.path.isdir (i):
+                args.pretty.append (i)
+            elif i.endswith (".zip"):
+                args.zips.append (i)
+
+    convert = freepcb2pretty.parse_args (shlex.split (args.convert_args) +
+            ["unused"])
+    freepcb2pretty.set_resolution (convert.resolution)
+
+    sources = {}
+    for source in [PrettySource (i) for i in args.pretty] + \
+            [ZipSource (i, convert) for i in args.zips]:
+        if source.name in sources:
+            raise Exception ("two libraries named \"%s\"" % source.name)
+        sources[source.name] = source
+
+    cache = LRUCache (int (args.cache_mb * 1024 * 1024))
+    server = FootprintServer ((args.bind, args.port), sources, cache, args.quiet)
+    print ("Serving %d libraries on http://%s:%d/" % (len (sources),
+        args.bind, server.server_address[1]))
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+    server.server_close ()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())